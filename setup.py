@@ -35,9 +35,11 @@ setup(
         "pyfaidx",
         "biopython",
         "scipy",
-        "click",
-        "progressbar2"
+        "click"
     ],
+    extras_require={
+        "numba": ["numba"]
+    },
     entry_points={
         "console_scripts": [
             "wisestork = wisestork.wisestork:main"
@@ -0,0 +1,69 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pytest
+
+from wisestork import api
+from wisestork.newref import newref
+from wisestork.utils import open_output
+from wisestork.ztest import ztest
+
+
+@pytest.fixture(scope="module")
+def tracks():
+    init = api.read_bed("test/data/gc_correct.bed")
+    return [init.with_values(init.values * x)
+            for x in [1.5, 2.0, 3.0, 3.5, 4.0]]
+
+
+class TestApi:
+
+    def test_count(self):
+        counts = api.count("test/data/test.bam", binsize=100)
+        expected = api.read_bed("test/data/count.bed")
+        assert np.array_equal(counts.starts, expected.starts)
+        assert np.array_equal(counts.values, expected.values)
+
+    def test_gc_correct(self):
+        counts = api.count("test/data/test.bam", binsize=100)
+        corrected = api.gc_correct(counts, "test/data/chrQ.fasta")
+        assert np.all((0.9 < corrected.values[:4]) &
+                      (corrected.values[:4] < 1.1))
+        assert 0.4 < corrected.values[4] < 0.6
+
+    def test_matches_files(self, tracks):
+        query = api.read_bed("test/data/gc_correct.bed")
+        index = api.build_reference(tracks, "test/data/chrQ.fasta",
+                                    binsize=100, n_bins=3)
+        scored = api.zscore(query, index)
+        with TemporaryDirectory() as tmp:
+            paths = []
+            for i, track in enumerate(tracks):
+                paths.append(join(tmp, "{0}.bed".format(i)))
+                with open_output(paths[-1]) as handle:
+                    api.write_bed(handle, track)
+            ref = join(tmp, "ref.bed")
+            newref(paths, ref, "test/data/chrQ.fasta", 100, n_bins=3)
+            out = join(tmp, "z.bed")
+            ztest("test/data/gc_correct.bed", out, ref)
+            expected = api.read_bed(out)
+            loaded = api.zscore(query, api.load_reference(ref))
+        assert np.allclose(scored.values, expected.values, equal_nan=True)
+        assert np.allclose(loaded.values, expected.values, equal_nan=True)
@@ -0,0 +1,142 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+from os.path import abspath, join
+from tempfile import TemporaryDirectory
+
+import pytest
+from pyfaidx import Fasta
+
+from wisestork.batch import (COUNT, GC_CORRECT, ZSCORE, BatchScheduler,
+                             Sample, batch, read_manifest, stage_memory,
+                             stage_path)
+from wisestork.gc_correct import GCTable, correct, correct_table
+from wisestork.utils import format_layout, layout_fingerprint, read_bed
+from wisestork.ztest import ztest
+
+BAM = abspath("test/data/test.bam")
+
+
+@pytest.fixture
+def tmp():
+    with TemporaryDirectory() as path:
+        yield path
+
+
+def samples(n):
+    return [Sample("s{0}".format(i), BAM) for i in range(n)]
+
+
+class TestManifest:
+
+    def test_read(self, tmp):
+        path = join(tmp, "manifest.tsv")
+        with open(path, "w") as handle:
+            handle.write("# comment\n\na\t/data/a.bam\n"
+                         "sub/b.bam\n")
+        assert read_manifest(path) == [Sample("a", "/data/a.bam"),
+                                       Sample("b", join(tmp, "sub/b.bam"))]
+
+    def test_duplicate(self, tmp):
+        path = join(tmp, "manifest.tsv")
+        with open(path, "w") as handle:
+            handle.write("a\tx.bam\na\ty.bam\n")
+        with pytest.raises(ValueError):
+            read_manifest(path)
+
+
+class TestScheduler:
+
+    def test_estimates(self):
+        for stage in (COUNT, GC_CORRECT, ZSCORE):
+            assert stage_memory(stage, 10 ** 6) > stage_memory(stage, 10)
+
+    def test_budget(self):
+        need = stage_memory(COUNT, 10)
+        scheduler = BatchScheduler(samples(3), 10, budget=2 * need, jobs=4)
+        first = scheduler.next()
+        second = scheduler.next()
+        assert first == (COUNT, Sample("s0", BAM))
+        assert second == (COUNT, Sample("s1", BAM))
+        assert scheduler.next() is None
+        scheduler.done(*first)
+        # the next stage of a started sample goes first
+        assert scheduler.next() == (GC_CORRECT, Sample("s0", BAM))
+
+    def test_jobs(self):
+        scheduler = BatchScheduler(samples(3), 10, jobs=1)
+        task = scheduler.next()
+        assert scheduler.next() is None
+        scheduler.done(*task, success=False)
+        assert scheduler.next() == (COUNT, Sample("s1", BAM))
+
+    def test_oversized(self):
+        scheduler = BatchScheduler(samples(2), 10, budget=1, jobs=2)
+        task = scheduler.next()
+        assert task is not None
+        assert scheduler.next() is None
+        while not scheduler.finished():
+            scheduler.done(*task)
+            task = scheduler.next()
+            assert task is not None or scheduler.finished()
+
+
+class TestGCTable:
+
+    def test_correct_table(self):
+        fasta = Fasta("test/data/chrQ.fasta")
+        track = read_bed("test/data/count.bed")
+        table = GCTable.from_fasta(track, fasta)
+        assert table.matches(track)
+        assert not table.matches(track[1:])
+        expected = correct(track, fasta, lowess_frac=1.0)
+        corrected = correct_table(track, table, lowess_frac=1.0)
+        assert corrected.values.tolist() == expected.values.tolist()
+        with pytest.raises(ValueError):
+            correct_table(track[1:], table)
+
+
+class TestBatch:
+
+    def test_batch(self, tmp):
+        manifest = join(tmp, "manifest.tsv")
+        with open(manifest, "w") as handle:
+            handle.write("a\t{0}\nb\t{0}\n".format(BAM))
+        output = join(tmp, "out")
+        batch(manifest, output, "test/data/chrQ.fasta",
+              "test/data/ref.bed.gz", binsize=100, jobs=2)
+        with open("test/data/count.bed") as handle:
+            counts = handle.read()
+        layout = layout_fingerprint(read_bed("test/data/count.bed"))
+        counts = format_layout(layout).decode() + counts
+        ztest(stage_path(output, "a", GC_CORRECT), join(tmp, "a.z.bed"),
+              "test/data/ref.bed.gz")
+        with open(join(tmp, "a.z.bed")) as handle:
+            expected = handle.read()
+        for name in ("a", "b"):
+            with open(stage_path(output, name, COUNT)) as handle:
+                assert handle.read() == counts
+            with open(stage_path(output, name, ZSCORE)) as handle:
+                assert handle.read() == expected
+
+    def test_failed(self, tmp):
+        manifest = join(tmp, "manifest.tsv")
+        with open(manifest, "w") as handle:
+            handle.write("a\t{0}\n".format(BAM))
+        with pytest.raises(ValueError):
+            # the layout does not match the dictionary
+            batch(manifest, join(tmp, "out"), "test/data/chrQ.fasta",
+                  "test/data/ref.bed.gz", binsize=50)
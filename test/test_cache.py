@@ -0,0 +1,165 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import os
+
+import pytest
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from wisestork.cache import (ResultCache, cached_path, content_hash,
+                             fingerprint, open_cache)
+from wisestork import precision
+from wisestork.count import count
+from wisestork.gc_correct import gc_correct
+
+
+@pytest.fixture
+def tmpdir_path():
+    with TemporaryDirectory() as tmp:
+        yield tmp
+
+
+def read(path):
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+def test_fingerprint():
+    assert fingerprint("test/data/test.bam") == \
+        fingerprint("test/data/test.bam")
+    assert fingerprint("test/data/test.bam") != \
+        fingerprint("test/data/count.bed")
+    assert content_hash("test/data/count.bed") == \
+        content_hash("test/data/count.bed")
+
+
+def test_key():
+    params = {"input": "abc", "binsize": 100}
+    assert ResultCache.key("count", params) == \
+        ResultCache.key("count", dict(params))
+    assert ResultCache.key("count", params) != \
+        ResultCache.key("count", {"input": "abc", "binsize": 200})
+    assert ResultCache.key("count", params) != \
+        ResultCache.key("gc-correct", params)
+
+
+def test_open_cache(tmpdir_path):
+    assert open_cache(None) is None
+    assert open_cache(tmpdir_path, input_path="-") is None
+    assert isinstance(open_cache(tmpdir_path, input_path="test/data/test.bam"),
+                      ResultCache)
+
+
+def test_cached_path(tmpdir_path):
+    cache = ResultCache(join(tmpdir_path, "cache"))
+    output = join(tmpdir_path, "out.bed")
+    with cached_path(output, cache, "stage", {"x": 1}) as target:
+        assert target == output
+        with open(target, "wb") as handle:
+            handle.write(b"result\n")
+    os.remove(output)
+    with cached_path(output, cache, "stage", {"x": 1}) as target:
+        assert target is None
+    assert read(output) == b"result\n"
+    with cached_path(output, cache, "stage", {"x": 2}) as target:
+        assert target == output
+
+
+def test_cached_path_failure(tmpdir_path):
+    cache = ResultCache(join(tmpdir_path, "cache"))
+    output = join(tmpdir_path, "out.bed")
+    with pytest.raises(RuntimeError):
+        with cached_path(output, cache, "stage", {"x": 1}):
+            raise RuntimeError("failed")
+    assert cache.get(cache.key("stage", {"x": 1})) is None
+
+
+def test_cached_path_stdout(tmpdir_path, capfd):
+    cache = ResultCache(join(tmpdir_path, "cache"))
+    with cached_path("-", cache, "stage", {"x": 1}) as target:
+        assert target != "-"
+        with open(target, "wb") as handle:
+            handle.write(b"result\n")
+    assert capfd.readouterr().out == "result\n"
+    assert os.listdir(cache.path) == [cache.key("stage", {"x": 1}) + ".bed"]
+    with cached_path("-", cache, "stage", {"x": 1}) as target:
+        assert target is None
+    assert capfd.readouterr().out == "result\n"
+
+
+def test_evict(tmpdir_path):
+    cache = ResultCache(tmpdir_path, max_size=None)
+    source = join(tmpdir_path, "source")
+    keys = ["a", "b", "c"]
+    for i, key in enumerate(keys):
+        with open(source, "wb") as handle:
+            handle.write(b"x" * 10)
+        cache.store(key, source)
+        os.utime(cache.entry(key), (i, i))
+    cache.get("a")
+    cache.max_size = 25
+    cache.evict()
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+
+def test_count_cached(tmpdir_path):
+    cache_dir = join(tmpdir_path, "cache")
+    first = join(tmpdir_path, "first.bed")
+    second = join(tmpdir_path, "second.bed")
+    count("test/data/test.bam", first, 100, "test/data/chrQ.fasta",
+          cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    count("test/data/test.bam", second, 100, "test/data/chrQ.fasta",
+          cache_dir=cache_dir)
+    assert read(first) == read(second)
+    assert len(os.listdir(cache_dir)) == 1
+    count("test/data/test.bam", second, 50, "test/data/chrQ.fasta",
+          cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+    assert read(first) != read(second)
+
+
+def test_gc_correct_cached(tmpdir_path):
+    cache_dir = join(tmpdir_path, "cache")
+    uncached = join(tmpdir_path, "uncached.bed")
+    cached = join(tmpdir_path, "cached.bed")
+    args = ("test/data/chrQ.fasta", 0.1, 0.1, 3, 0.1)
+    gc_correct("test/data/count.bed", uncached, *args)
+    for _ in range(2):
+        gc_correct("test/data/count.bed", cached, *args, cache_dir=cache_dir)
+        assert read(cached) == read(uncached)
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_precision_cached(tmpdir_path):
+    cache_dir = join(tmpdir_path, "cache")
+    output = join(tmpdir_path, "out.bed")
+    args = ("test/data/chrQ.fasta", 0.1, 0.1, 3, 0.1)
+    previous = precision.precision()
+    try:
+        for mode in (precision.DOUBLE, precision.SINGLE):
+            precision.use(mode)
+            count("test/data/test.bam", output, 100, "test/data/chrQ.fasta",
+                  cache_dir=cache_dir)
+            gc_correct("test/data/count.bed", output, *args,
+                       cache_dir=cache_dir)
+    finally:
+        precision.use(previous)
+    # every precision has its own counts and corrected values
+    assert len(os.listdir(cache_dir)) == 4
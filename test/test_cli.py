@@ -18,7 +18,13 @@
 from click.testing import CliRunner
 import pytest
 
-from wisestork.wisestork import count_cli, gcc_cli, newref_cli, zscore_cli
+from wisestork.wisestork import (cli, batch_cli, count_cli, gcc_cli,
+                                 newref_cli,
+                                 zscore_cli,
+                                 cohort_build_cli, serve_cli, submit_cli,
+                                 segment_cli, plot_cli,
+                                 validate_cli, newref_medians_cli,
+                                 newref_merge_cli)
 
 
 @pytest.fixture()
@@ -26,6 +32,18 @@ def runner():
     return CliRunner()
 
 
+def test_cli_env(runner):
+    result = runner.invoke(cli, ["count", "--help"],
+                           env={"WISESTORK_KERNELS": "bogus"})
+    assert result.exit_code == 2
+    assert "--kernels" in result.output
+    assert not isinstance(result.exception, ValueError)
+    result = runner.invoke(cli, ["count", "--help"],
+                           env={"WISESTORK_PRECISION": "half"})
+    assert result.exit_code == 2
+    assert "--precision" in result.output
+
+
 def test_cli_count_help(runner):
     result = runner.invoke(count_cli, "--help")
     assert result.exit_code == 0
@@ -41,6 +59,70 @@ def test_cli_newref_help(runner):
     assert result.exit_code == 0
 
 
+def test_cli_newref_medians_help(runner):
+    result = runner.invoke(newref_medians_cli, "--help")
+    assert result.exit_code == 0
+
+
+def test_cli_newref_merge_help(runner):
+    result = runner.invoke(newref_merge_cli, "--help")
+    assert result.exit_code == 0
+
+
 def test_cli_zscore_help(runner):
     result = runner.invoke(zscore_cli, "--help")
     assert result.exit_code == 0
+
+
+def test_cli_segment_help(runner):
+    result = runner.invoke(segment_cli, "--help")
+    assert result.exit_code == 0
+
+
+def test_cli_plot_help(runner):
+    result = runner.invoke(plot_cli, "--help")
+    assert result.exit_code == 0
+
+
+def test_cli_validate_help(runner):
+    result = runner.invoke(validate_cli, "--help")
+    assert result.exit_code == 0
+
+
+def test_cli_cohort_build_help(runner):
+    result = runner.invoke(cohort_build_cli, "--help")
+    assert result.exit_code == 0
+
+
+def test_cli_serve_help(runner):
+    result = runner.invoke(serve_cli, "--help")
+    assert result.exit_code == 0
+
+
+def test_cli_submit_help(runner):
+    result = runner.invoke(submit_cli, "--help")
+    assert result.exit_code == 0
+
+
+def test_cli_count_stdio(runner):
+    result = runner.invoke(count_cli, ["-I", "test/data/test.bam", "-R",
+                                       "test/data/chrQ.fasta",
+                                       "-O", "-", "--metrics", "-"])
+    assert result.exit_code == 2
+    assert "can not both be stdout" in result.output
+
+
+def test_cli_gc_correct_stdio(runner):
+    with open("test/data/count.bed", "rb") as handle:
+        data = handle.read()
+    result = runner.invoke(gcc_cli, ["-I", "-", "-O", "-", "-R",
+                                     "test/data/chrQ.fasta"], input=data)
+    assert result.exit_code == 0
+    lines = result.stdout.splitlines()
+    assert lines[0].startswith("#layout")
+    assert len(lines) == 6
+
+
+def test_cli_batch_help(runner):
+    result = runner.invoke(batch_cli, "--help")
+    assert result.exit_code == 0
@@ -0,0 +1,69 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pytest
+
+from wisestork.cohort import (CohortStore, cohort_build, is_cohort,
+                              sample_name)
+from wisestork.utils import read_bed
+
+
+@pytest.fixture
+def store_path():
+    with TemporaryDirectory() as tmp:
+        yield join(tmp, "cohort")
+
+
+class TestFunctions:
+
+    def test_sample_name(self):
+        assert sample_name("/a/b/sample1.gc.bed.gz") == "sample1.gc"
+        assert sample_name("sample2.bed") == "sample2"
+
+
+class TestCohortStore:
+
+    def test_build(self, store_path):
+        store = cohort_build(["test/data/gc_correct.bed",
+                              "test/data/count.bed"], store_path)
+        assert is_cohort(store_path)
+        assert store.samples == ["gc_correct", "count"]
+        matrix = CohortStore(store_path).matrix()
+        assert matrix.shape == (2, 5)
+        assert matrix[1].tolist() == [40, 52, 34, 42, 26]
+        assert np.allclose(matrix[0],
+                           read_bed("test/data/gc_correct.bed").values)
+
+    def test_append(self, store_path):
+        cohort_build(["test/data/count.bed"], store_path)
+        with pytest.raises(ValueError):
+            cohort_build(["test/data/gc_correct.bed"], store_path)
+        store = cohort_build(["test/data/gc_correct.bed"], store_path,
+                             append=True)
+        assert len(store) == 2
+        with pytest.raises(ValueError):
+            cohort_build(["test/data/gc_correct.bed"], store_path,
+                         append=True)
+
+    def test_layout_mismatch(self, store_path):
+        cohort_build(["test/data/count.bed"], store_path)
+        with pytest.raises(ValueError):
+            cohort_build(["test/data/test.bedgraph"], store_path,
+                         append=True)
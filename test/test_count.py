@@ -14,13 +14,23 @@
 
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import shutil
+
+import numpy as np
 import pysam
 import pyfaidx
+import pytest
 
-from tempfile import NamedTemporaryFile
+from os.path import exists, join
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from hashlib import sha1
+from wisestork.checkpoint import Checkpoint, file_identity
 from wisestork.count import (get_chromosomes_from_header, reads_per_bin,
-                             get_chromosomes_from_fasta, get_bins, count)
+                             get_chromosomes_from_fasta, get_bins, count,
+                             count_overlaps, count_stream, count_bins)
+from wisestork.utils import (Bin, BedTrack, SparseTrack, bin_track,
+                             format_layout, layout_fingerprint, read_bed,
+                             read_track)
 
 
 class TestFunctions:
@@ -49,6 +59,39 @@ class TestFunctions:
         assert reads_per_bin(sam, "chrQ", bins[4]) == 26
         assert reads_per_bin(sam, "NotExist", bins[0]) == 0
 
+    def test_count_overlaps(self):
+        read_starts = np.array([0, 5, 12, 30])
+        read_ends = np.array([10, 15, 20, 40])
+        starts = np.array([10, 0, 14, 40])
+        ends = np.array([20, 10, 16, 50])
+        assert count_overlaps(read_starts, read_ends, starts,
+                              ends).tolist() == [2, 2, 2, 0]
+
+    def test_count_stream(self):
+        sam = pysam.AlignmentFile("test/data/test.bam")
+        tracks = list(count_stream(sam, [bin_track("chrQ", 500, 100)]))
+        assert len(tracks) == 1
+        expected = read_bed("test/data/count.bed")
+        assert tracks[0].values.tolist() == expected.values.tolist()
+
+    def test_count_bins(self):
+        sam = pysam.AlignmentFile("test/data/test.bam")
+        rng = np.random.RandomState(0)
+        starts = rng.randint(0, 480, 200)
+        ends = np.minimum(starts + rng.randint(1, 60, 200), 500)
+        chroms = np.where(rng.rand(200) < 0.1, b"chrZ", b"chrQ")
+        counts = count_bins(sam, BedTrack(chroms, starts, ends))
+        expected = [reads_per_bin(sam, c.decode(), Bin(s, e))
+                    for c, s, e in zip(chroms, starts, ends)]
+        assert counts.tolist() == expected
+
+
+def counts_with_layout():
+    with open("test/data/count.bed", "rb") as handle:
+        counts = handle.read()
+    layout = layout_fingerprint(read_bed("test/data/count.bed"))
+    return format_layout(layout) + counts
+
 
 class TestMain:
 
@@ -56,7 +99,7 @@ class TestMain:
         tmp_file = NamedTemporaryFile()
         count("test/data/test.bam", tmp_file.name, 100, "test/data/chrQ.fasta")
         output = b"".join(open(tmp_file.name, "rb").readlines())
-        expected = b"".join(open("test/data/count.bed", "rb").readlines())
+        expected = counts_with_layout()
         assert sha1(output).hexdigest() == sha1(expected).hexdigest()
 
     def test_with_binfile(self):
@@ -64,5 +107,73 @@ class TestMain:
         count("test/data/test.bam", tmp_file.name, 100,
               "test/data/chrQ.fasta", "test/data/regions.bed")
         output = b"".join(open(tmp_file.name, "rb").readlines())
-        expected = b"".join(open("test/data/count.bed", "rb").readlines())
+        expected = counts_with_layout()
         assert sha1(output).hexdigest() == sha1(expected).hexdigest()
+
+    def test_resume(self):
+        with TemporaryDirectory() as tmp:
+            out = join(tmp, "out.bed")
+            count("test/data/test.bam", out, 100, "test/data/chrQ.fasta")
+            assert not exists(out + ".checkpoint")
+            # chrQ was completed before an interrupted write of garbage
+            checkpoint = Checkpoint(out, {
+                "command": "count",
+                "input": file_identity("test/data/test.bam"),
+                "binsize": 100})
+            with open(out, "ab") as handle:
+                checkpoint.update(handle, ["chrQ"])
+                handle.write(b"chrX\t0\t")
+            count("test/data/test.bam", out, 100, "test/data/chrQ.fasta",
+                  resume=True)
+            with open(out, "rb") as handle:
+                output = handle.read()
+            assert output == counts_with_layout()
+            assert not exists(out + ".checkpoint")
+            with open(out, "ab") as handle:
+                checkpoint.update(handle, ["chrQ"])
+            with pytest.raises(ValueError):
+                count("test/data/test.bam", out, 50, "test/data/chrQ.fasta",
+                      resume=True)
+
+    def test_read_groups(self):
+        with TemporaryDirectory() as tmp:
+            bam = join(tmp, "rg.bam")
+            src = pysam.AlignmentFile("test/data/test.bam")
+            header = src.header.to_dict()
+            header["RG"] = [{"ID": "a", "SM": "a"}, {"ID": "b", "SM": "b"},
+                            {"ID": "c", "SM": "c"}]
+            with pysam.AlignmentFile(bam, "wb", header=header) as out:
+                for i, read in enumerate(src.fetch(until_eof=True)):
+                    read.set_tag("RG", "ab"[i % 2])
+                    out.write(read)
+            pysam.index(bam)
+            template = join(tmp, "{group}.bed")
+            count(bam, template, 100, "test/data/chrQ.fasta", group_tag="RG")
+            tracks = [read_bed(join(tmp, x + ".bed")) for x in "abc"]
+            expected = read_bed("test/data/count.bed")
+            total = tracks[0].values + tracks[1].values
+            assert total.tolist() == expected.values.tolist()
+            assert tracks[0].values.sum() > 0 and tracks[1].values.sum() > 0
+            assert tracks[2].values.sum() == 0
+            with pytest.raises(ValueError):
+                count(bam, join(tmp, "out.bed"), 100, "test/data/chrQ.fasta",
+                      group_tag="RG")
+
+    def test_sparse(self):
+        tmp_file = NamedTemporaryFile()
+        with TemporaryDirectory() as tmp:
+            # a small subsample by read name leaves bins without reads,
+            # and is taken when the BAM file has no index
+            bam = join(tmp, "test.bam")
+            shutil.copy("test/data/test.bam", bam)
+            count(bam, tmp_file.name, 10, "test/data/chrQ.fasta",
+                  fraction=0.1, sparse=True)
+            dense_file = NamedTemporaryFile()
+            count(bam, dense_file.name, 10, "test/data/chrQ.fasta",
+                  fraction=0.1)
+        sparse = read_track(tmp_file.name)
+        dense = read_bed(dense_file.name)
+        assert isinstance(sparse, SparseTrack)
+        assert 0 < len(sparse.values) == np.count_nonzero(dense.values) < 50
+        assert np.array_equal(read_bed(tmp_file.name).values, dense.values)
+        assert np.array_equal(read_bed(tmp_file.name).starts, dense.starts)
@@ -17,8 +17,11 @@
 from pyfaidx import Fasta
 from pytest import fixture
 
-from wisestork.gc_correct import filter_bin, correct
-from wisestork.utils import BedLine, attempt_numeric
+import numpy as np
+
+from wisestork.gc_correct import (filter_bin, correct, correct_chunks,
+                                  correct_sparse)
+from wisestork.utils import BedLine, BedTrack, SparseTrack, attempt_numeric
 
 
 @fixture
@@ -45,3 +48,20 @@ class TestFunctions:
         for i in range(4):
             assert 0.9 < corrected[i].value < 1.1
         assert 0.4 < corrected[4].value < 0.6
+
+    def test_correct_sparse(self, bedlines, fasta):
+        track = BedTrack.from_bedlines(bedlines)
+        track = track.with_values(np.array([40, 0, 34, 42, 26]))
+        dense = correct(track, fasta, lowess_frac=1.0)
+        sparse = correct_sparse(SparseTrack.from_dense(track), fasta,
+                                lowess_frac=1.0)
+        assert sparse.indices.tolist() == [0, 2, 3, 4]
+        assert np.array_equal(sparse.to_dense().values, dense.values)
+
+    def test_correct_chunks(self, bedlines, fasta):
+        track = BedTrack.from_bedlines(bedlines)
+        expected = correct(track, fasta, lowess_frac=1.0)
+        chunked = correct_chunks([track[:2], track[2:3], track[3:]], fasta,
+                                 lowess_frac=1.0)
+        assert np.array_equal(chunked.values, expected.values)
+        assert np.array_equal(chunked.starts, expected.starts)
@@ -0,0 +1,130 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import numpy as np
+import pytest
+
+from wisestork import kernels
+from wisestork.count import count_overlaps
+from wisestork.newref import build_reference
+from wisestork.ztest import MEAN, ROBUST, padded_neighbours, z_scores
+
+needs_numba = pytest.mark.skipif(not kernels.available(),
+                                 reason="numba is not installed")
+
+
+@pytest.fixture
+def restore_backend():
+    previous = kernels.backend()
+    yield
+    kernels.use(previous)
+
+
+def both_backends(func):
+    kernels.use(kernels.NUMPY)
+    expected = func()
+    kernels.use(kernels.NUMBA)
+    return expected, func()
+
+
+def test_use(restore_backend):
+    kernels.use(kernels.NUMPY)
+    assert kernels.backend() == kernels.NUMPY
+    assert not kernels.compiled()
+    kernels.use(kernels.AUTO)
+    assert kernels.backend() == (kernels.NUMBA if kernels.available()
+                                 else kernels.NUMPY)
+    with pytest.raises(ValueError):
+        kernels.use("fortran")
+
+
+def test_use_without_numba(restore_backend, monkeypatch):
+    monkeypatch.setattr(kernels, "numba", None)
+    with pytest.raises(ValueError):
+        kernels.use(kernels.NUMBA)
+    kernels.use(kernels.AUTO)
+    assert kernels.backend() == kernels.NUMPY
+
+
+def test_use_environment(restore_backend, monkeypatch):
+    monkeypatch.setenv(kernels.BACKEND_ENV, kernels.NUMPY)
+    kernels.use_environment()
+    assert kernels.backend() == kernels.NUMPY
+    monkeypatch.setenv(kernels.BACKEND_ENV, "bogus")
+    with pytest.warns(UserWarning):
+        kernels.use_environment()
+    assert kernels.backend() == (kernels.NUMBA if kernels.available()
+                                 else kernels.NUMPY)
+
+
+def test_filter_window_numpy():
+    values = np.array([1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0,
+                       1.0, 100.0])
+    ids = np.arange(12)
+    assert kernels.filter_window_numpy(ids, values, 0).tolist() == \
+        list(range(1, 11))
+
+
+@needs_numba
+def test_count_overlaps_numba(restore_backend):
+    rng = np.random.RandomState(1)
+    read_starts = rng.randint(0, 10000, 5000)
+    read_ends = read_starts + rng.randint(1, 150, 5000)
+    starts = np.arange(0, 10000, 100)
+    expected, result = both_backends(
+        lambda: count_overlaps(read_starts, read_ends, starts, starts + 100))
+    assert np.array_equal(expected, result)
+
+
+@needs_numba
+def test_filter_window_numba(restore_backend):
+    rng = np.random.RandomState(2)
+    values = np.concatenate([rng.normal(100, 10, 500), [1000.0, -1000.0]])
+    ids = rng.permutation(len(values))[:300].astype(np.int64)
+    ids = np.concatenate([ids, [500, 501]])
+    for target in [int(ids[0]), 500, -1]:
+        expected, result = both_backends(
+            lambda: kernels.filter_window(ids, values, target))
+        assert np.array_equal(expected, result)
+
+
+@needs_numba
+@pytest.mark.parametrize("statistic", [MEAN, ROBUST])
+@pytest.mark.parametrize("width", [20, 400])
+def test_z_scores_numba(restore_backend, statistic, width):
+    rng = np.random.RandomState(3)
+    values = rng.normal(1, 0.1, (3, 500)) * 10 ** rng.uniform(-3, 3, 500)
+    values[:, 7] = 1.0
+    lists = [rng.choice(500, rng.randint(0, width), replace=False)
+             for _ in range(500)]
+    lists[7] = np.array([7, 7])
+    neighbours = padded_neighbours(lists)
+    expected, result = both_backends(
+        lambda: z_scores(values, neighbours, statistic))
+    assert np.array_equal(expected, result, equal_nan=True)
+    expected, result = both_backends(
+        lambda: z_scores(values[0], neighbours, statistic))
+    assert result.shape == (500,)
+    assert np.array_equal(expected, result, equal_nan=True)
+
+
+@needs_numba
+def test_build_reference_numba(restore_backend):
+    def build():
+        return build_reference(["test/data/gc_correct.bed"] * 3,
+                               "test/data/chrQ.fasta", 100, n_bins=3)
+    expected, result = both_backends(build)
+    assert np.array_equal(expected.neighbours, result.neighbours)
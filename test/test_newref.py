@@ -15,20 +15,28 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see {http://www.gnu.org/licenses/}.
 import hashlib
+import numpy as np
 from os import remove
-from tempfile import NamedTemporaryFile
+from os.path import exists, join
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 import pytest
 from pyfaidx import Fasta
 
+from wisestork.cohort import cohort_build
 from wisestork.newref import (build_main_list, get_unique_bins,
-                              ReferenceBinGenerator, newref)
-from wisestork.utils import BedReader, BedLine
+                              ReferenceBinGenerator, newref,
+                              compute_medians, bins_per_chunk,
+                              window_bounds, prepare_profiles,
+                              nearest_profiles,
+                              newref_medians, newref_merge, parse_shard,
+                              shard_bounds)
+from wisestork.utils import BedLine, read_bed, rechunk, iter_bed_chunks
 
 
 @pytest.fixture(scope="module")
 def fuzzed_files():
     multipliers = [1.5, 2.0, 3.0, 3.5, 4.0]
-    init = [x for x in BedReader("test/data/gc_correct.bed")]
+    init = list(read_bed("test/data/gc_correct.bed"))
     fs = []
     for multi in multipliers:
         tmp = NamedTemporaryFile(delete=False)
@@ -49,7 +57,7 @@ def fuzzed_files():
 def input_bins(fuzzed_files):
     inp = []
     for z in fuzzed_files:
-        inp += [x for x in BedReader(z)]
+        inp += list(read_bed(z))
     return inp
 
 
@@ -79,6 +87,62 @@ class TestFunctions:
                                    "test/data/regions.bed")
         assert [x.start for x in main_w_f] == [x.start for x in main]
 
+    def test_window_bounds(self):
+        assert window_bounds(0, 10, 4) == (0, 4)
+        assert window_bounds(5, 10, 4) == (3, 7)
+        assert window_bounds(9, 10, 4) == (6, 10)
+        assert window_bounds(3, 3, 5) == (0, 3)
+
+    def test_nearest_profiles(self):
+        rng = np.random.RandomState(42)
+        matrix = rng.normal(size=(6, 40))
+        for metric in ("euclidean", "correlation"):
+            profiles, sq = prepare_profiles(matrix, metric)
+            targets = np.array([0, 7, 39])
+            found = nearest_profiles(profiles, sq, targets, 5)
+            for t, nb in zip(targets, found):
+                if metric == "euclidean":
+                    d = ((matrix - matrix[:, [t]]) ** 2).sum(axis=0)
+                else:
+                    d = 1 - np.corrcoef(matrix.T)[t]
+                d[t] = np.inf
+                assert nb.tolist() == np.argsort(d)[:5].tolist()
+
+    def test_nearest_profiles_constant(self):
+        matrix = np.ones((4, 3))
+        matrix[:, 1] = [1, 2, 3, 4]
+        profiles, sq = prepare_profiles(matrix, "correlation")
+        found = nearest_profiles(profiles, sq, np.array([0, 1]), 2)
+        assert [len(x) for x in found] == [0, 0]
+
+    def test_shard_bounds(self):
+        assert parse_shard("2/3") == (2, 3)
+        for spec in ["0/3", "4/3", "a/b", "3"]:
+            with pytest.raises(ValueError):
+                parse_shard(spec)
+        bounds = [shard_bounds((i, 3), 10) for i in [1, 2, 3]]
+        assert bounds == [(0, 3), (3, 6), (6, 10)]
+        assert shard_bounds(None, 10) == (0, 10)
+
+    def test_bins_per_chunk(self):
+        assert bins_per_chunk(None, 10) > 1e9
+        assert bins_per_chunk(240, 10) == 1
+        assert bins_per_chunk(2400, 10) == 10
+
+    def test_rechunk(self):
+        chunks = list(rechunk(iter_bed_chunks("test/data/gc_correct.bed"),
+                              2))
+        assert [len(x) for x in chunks] == [2, 2, 1]
+
+    def test_compute_medians(self, fuzzed_files):
+        full, layout = compute_medians(fuzzed_files)
+        assert layout is None
+        assert len(full) == 5
+        chunked, _ = compute_medians(fuzzed_files, memory_limit=240)
+        assert np.array_equal(full, chunked)
+        with pytest.raises(ValueError):
+            compute_medians(fuzzed_files + ["test/data/test.bedgraph"])
+
 
 class TestReferenceBinGenerator:
 
@@ -105,6 +169,18 @@ class TestReferenceBinGenerator:
             filt = ref2.filter_bins(ref2.get_all_bins()[i], a)
             assert len(filt) == 2
 
+    def test_profile_selection(self, fuzzed_files, fasta):
+        ref = ReferenceBinGenerator(fuzzed_files, 3, fasta.filename, 100,
+                                    selection="profile")
+        refs = [x for x in ref]
+        assert len(refs) == 5
+        for target, neighbours in refs:
+            assert 0 < len(neighbours) <= 2
+            assert target not in neighbours
+        with pytest.raises(ValueError):
+            ReferenceBinGenerator(fuzzed_files, 3, fasta.filename, 100,
+                                  selection="other")
+
     def test_iteration(self, fuzzed_files, fasta):
         ref1 = ReferenceBinGenerator(fuzzed_files, 5, fasta.filename, 100)
         refs = [x for x in ref1]
@@ -122,5 +198,103 @@ class TestMain:
         with open(o.name) as handle:
             for l in handle:
                 m.update(l.encode('utf-8'))
-        assert m.hexdigest() == "a719c83e318f75c296bcf41adb50593a"
+        assert m.hexdigest() == "33361a87443726ad2e7f3c15b4a16ac9"
         remove(o.name)
+
+    def test_cohort_input(self, fuzzed_files, fasta):
+        with TemporaryDirectory() as tmp:
+            store = join(tmp, "cohort")
+            cohort_build(fuzzed_files, store)
+            o = join(tmp, "out.bed")
+            newref([store], o, reference=fasta.filename, binsize=100,
+                   n_bins=5)
+            m = hashlib.md5()
+            with open(o, "rb") as handle:
+                m.update(handle.read())
+        assert m.hexdigest() == "33361a87443726ad2e7f3c15b4a16ac9"
+
+    def test_memory_limit(self, fuzzed_files, fasta):
+        with TemporaryDirectory() as tmp:
+            o = join(tmp, "out.bed")
+            newref(fuzzed_files, o, reference=fasta.filename, binsize=100,
+                   n_bins=5, memory_limit=240)
+            m = hashlib.md5()
+            with open(o, "rb") as handle:
+                m.update(handle.read())
+        assert m.hexdigest() == "33361a87443726ad2e7f3c15b4a16ac9"
+
+    def test_update(self, fuzzed_files, fasta):
+        with TemporaryDirectory() as tmp:
+            store = join(tmp, "cohort")
+            o = join(tmp, "out.bed")
+            cohort_build(fuzzed_files[:3], store)
+            newref([store], o, reference=fasta.filename, binsize=100,
+                   n_bins=5)
+            newref([store] + fuzzed_files[3:], o, reference=fasta.filename,
+                   binsize=100, n_bins=5, update=True)
+            m = hashlib.md5()
+            with open(o, "rb") as handle:
+                m.update(handle.read())
+            assert m.hexdigest() == "33361a87443726ad2e7f3c15b4a16ac9"
+            with pytest.raises(ValueError):
+                newref(fuzzed_files, o, reference=fasta.filename,
+                       binsize=100, n_bins=5, update=True)
+            with pytest.raises(ValueError):
+                newref([store], o, reference=fasta.filename,
+                       binsize=100, n_bins=5, update=True, resume=True)
+
+    def test_shards(self, fuzzed_files, fasta):
+        with TemporaryDirectory() as tmp:
+            medians = join(tmp, "medians.npz")
+            newref_medians(fuzzed_files, medians, fasta.filename, 100)
+            shards = []
+            for i in [3, 1, 2]:
+                shards.append(join(tmp, "shard{0}.bed".format(i)))
+                newref([], shards[-1], reference=fasta.filename,
+                       binsize=100, n_bins=5, medians_path=medians,
+                       shard=(i, 3))
+            o = join(tmp, "out.bed")
+            newref_merge(shards, o)
+            m = hashlib.md5()
+            with open(o, "rb") as handle:
+                m.update(handle.read())
+            assert m.hexdigest() == "33361a87443726ad2e7f3c15b4a16ac9"
+            with pytest.raises(ValueError):
+                newref_merge(shards[:2], o)
+            with pytest.raises(ValueError):
+                newref_merge(shards + shards[:1], o)
+
+    def test_resume(self, fuzzed_files, fasta, monkeypatch):
+        original = ReferenceBinGenerator.neighbours_at_idx
+
+        def interrupted(self, idx):
+            if idx == 3:
+                raise KeyboardInterrupt
+            return original(self, idx)
+
+        with TemporaryDirectory() as tmp:
+            o = join(tmp, "out.bed")
+            monkeypatch.setattr("wisestork.newref.DEFAULT_WRITE_CHUNK", 2)
+            monkeypatch.setattr(ReferenceBinGenerator, "neighbours_at_idx",
+                                interrupted)
+            with pytest.raises(KeyboardInterrupt):
+                newref(fuzzed_files, o, reference=fasta.filename,
+                       binsize=100, n_bins=5)
+            # without --resume no checkpoint is kept
+            assert not exists(o + ".checkpoint")
+            with pytest.raises(KeyboardInterrupt):
+                newref(fuzzed_files, o, reference=fasta.filename,
+                       binsize=100, n_bins=5, resume=True)
+            assert exists(o + ".checkpoint")
+            monkeypatch.setattr(ReferenceBinGenerator, "neighbours_at_idx",
+                                original)
+            with pytest.raises(ValueError):
+                newref(fuzzed_files, o, reference=fasta.filename,
+                       binsize=100, n_bins=3, resume=True)
+            newref(fuzzed_files, o, reference=fasta.filename, binsize=100,
+                   n_bins=5, resume=True)
+            assert not exists(o + ".checkpoint")
+            m = hashlib.md5()
+            with open(o, "rb") as handle:
+                m.update(handle.read())
+            assert m.hexdigest() == "33361a87443726ad2e7f3c15b4a16ac9"
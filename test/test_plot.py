@@ -0,0 +1,60 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pytest
+
+from wisestork.plot import genome_positions, pixel_aggregate, plot
+from wisestork.utils import BedTrack
+
+
+class TestPlot:
+
+    def test_pixel_aggregate(self):
+        positions = np.array([0.5, 1.5, 2.5, 3.5, 6.5, 7.5])
+        values = np.array([1.0, 3.0, np.nan, 5.0, 2.0, 4.0])
+        centers, mins, maxs, means = pixel_aggregate(positions, values,
+                                                     0, 8, 4)
+        assert centers.tolist() == [1, 3, 5, 7]
+        assert mins[[0, 1, 3]].tolist() == [1, 5, 2]
+        assert maxs[[0, 1, 3]].tolist() == [3, 5, 4]
+        assert means[[0, 1, 3]].tolist() == [2, 5, 3]
+        assert np.isnan(mins[2]) and np.isnan(means[2])
+
+    def test_genome_positions(self):
+        track = BedTrack([b"chr1", b"chr1", b"chr2"], [0, 100, 0],
+                         [100, 200, 100], [1.0, 2.0, 3.0])
+        _, positions, extent, offsets = genome_positions(track)
+        assert positions.tolist() == [50, 150, 250]
+        assert extent == (0, 300)
+        assert offsets == [(b"chr1", 0), (b"chr2", 200)]
+        selected, positions, extent, _ = genome_positions(track, "chr2")
+        assert len(selected) == 1
+        assert extent == (0, 100)
+        with pytest.raises(ValueError):
+            genome_positions(track, "chr3")
+
+    @pytest.mark.parametrize("chromosome", [None, "chrQ"])
+    def test_plot(self, chromosome):
+        with TemporaryDirectory() as tmp:
+            out = join(tmp, "plot.png")
+            plot("test/data/gc_correct.bed", out, chromosome=chromosome,
+                 width=200, height=100)
+            with open(out, "rb") as handle:
+                assert handle.read(4) == b"\x89PNG"
@@ -0,0 +1,145 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import io
+
+import numpy as np
+import pytest
+
+from pyfaidx import Fasta
+from wisestork import kernels, precision
+from wisestork.count import count_track
+from wisestork.gc_correct import correct
+from wisestork.newref import build_reference, compute_medians
+from wisestork.utils import BedTrack, parse_bed, read_bed, write_bed
+from wisestork.ztest import MEAN, ROBUST, padded_neighbours, z_scores
+
+
+@pytest.fixture
+def restore_precision():
+    previous = precision.precision()
+    yield
+    precision.use(previous)
+
+
+def both_precisions(func):
+    precision.use(precision.DOUBLE)
+    expected = func()
+    precision.use(precision.SINGLE)
+    return expected, func()
+
+
+def test_use(restore_precision):
+    precision.use(precision.SINGLE)
+    assert precision.count_dtype() == np.uint32
+    assert precision.value_dtype() == np.float32
+    precision.use(precision.DOUBLE)
+    assert precision.count_dtype() == np.int64
+    assert precision.value_dtype() == np.float64
+    with pytest.raises(ValueError):
+        precision.use("half")
+
+
+def test_use_environment(restore_precision, monkeypatch):
+    monkeypatch.setenv(precision.PRECISION_ENV, precision.SINGLE)
+    precision.use_environment()
+    assert precision.precision() == precision.SINGLE
+    monkeypatch.setenv(precision.PRECISION_ENV, "half")
+    with pytest.warns(UserWarning):
+        precision.use_environment()
+    assert precision.precision() == precision.DOUBLE
+
+
+def test_counts(restore_precision):
+    expected, result = both_precisions(
+        lambda: count_track("test/data/test.bam", 100).values)
+    assert result.dtype == np.uint32
+    assert np.array_equal(expected, result)
+
+
+def test_correct(restore_precision):
+    fasta = Fasta("test/data/chrQ.fasta")
+    track = read_bed("test/data/count.bed")
+    expected, result = both_precisions(
+        lambda: correct(track, fasta).values)
+    assert result.dtype == np.float32
+    assert np.allclose(expected, result, rtol=1e-6, atol=0)
+
+
+def test_medians(restore_precision, tmpdir):
+    rng = np.random.RandomState(0)
+    layout = BedTrack(["chr1"] * 1000, np.arange(1000) * 100,
+                      np.arange(1, 1001) * 100)
+    paths = []
+    for i in range(7):
+        path = str(tmpdir.join("sample{0}.bed".format(i)))
+        with open(path, "wb") as handle:
+            write_bed(handle, layout.with_values(rng.lognormal(0, 0.2, 1000)))
+        paths.append(path)
+    expected, result = both_precisions(lambda: compute_medians(paths)[0])
+    assert result.dtype == np.float32
+    assert np.allclose(expected, result, rtol=1e-6, atol=0)
+
+
+@pytest.mark.parametrize("statistic", [MEAN, ROBUST])
+def test_z_scores(restore_precision, statistic):
+    rng = np.random.RandomState(1)
+    values = rng.lognormal(0, 0.2, (10, 2000))
+    neighbours = padded_neighbours(
+        [rng.choice(2000, 50, replace=False) for _ in range(2000)])
+    expected, result = both_precisions(
+        lambda: z_scores(values, neighbours, statistic))
+    assert result.dtype == np.float32
+    assert np.max(np.abs(expected - result)) < 1e-4
+
+
+@pytest.mark.parametrize("backend", [kernels.NUMPY, kernels.NUMBA])
+def test_newref_single(restore_precision, monkeypatch, backend):
+    if backend == kernels.NUMBA and not kernels.available():
+        pytest.skip("numba is not installed")
+    previous = kernels.backend()
+    kernels.use(backend)
+    name = ("_filter_window_numba" if backend == kernels.NUMBA
+            else "filter_window_numpy")
+    original = getattr(kernels, name)
+    seen = []
+
+    def spy(ids, values, target):
+        seen.append(values)
+        return original(ids, values, target)
+
+    monkeypatch.setattr(kernels, name, spy)
+    precision.use(precision.SINGLE)
+    try:
+        build_reference(["test/data/gc_correct.bed"] * 3,
+                        "test/data/chrQ.fasta", 100, n_bins=3)
+    finally:
+        kernels.use(previous)
+    assert len(seen) == 5
+    assert seen[0].dtype == np.float32
+    # the medians are not copied for every bin
+    assert all(x is seen[0] for x in seen)
+
+
+def test_format_single(restore_precision):
+    precision.use(precision.SINGLE)
+    values = precision.as_values(np.random.RandomState(2).rand(100))
+    track = BedTrack(["chr1"] * 100, np.arange(100), np.arange(1, 101),
+                     values)
+    buffer = io.BytesIO()
+    write_bed(buffer, track)
+    parsed = parse_bed(buffer.getvalue()).values
+    assert np.array_equal(parsed.astype(np.float32), values)
@@ -0,0 +1,117 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import json
+
+import numpy as np
+import pysam
+import pytest
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from wisestork.count import count
+from wisestork.qc import ReadMetrics, format_metrics, mapd, write_metrics
+from wisestork.utils import BedTrack
+
+
+@pytest.fixture
+def tmpdir_path():
+    with TemporaryDirectory() as tmp:
+        yield tmp
+
+
+def read(path):
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+def test_mapd():
+    assert mapd(np.array([10, 10, 10, 10])) == 0
+    assert mapd(np.array([10, 20, 10, 0])) == 1
+    assert np.isnan(mapd(np.array([0, 5])))
+
+
+def test_observe():
+    sam = pysam.AlignmentFile("test/data/test.bam")
+    reads = list(sam.fetch(until_eof=True))
+    metrics = ReadMetrics(["chrQ"])
+    assert len(list(metrics.observe(iter(reads)))) == len(reads)
+    result = metrics.to_dict()
+    assert result["total_reads"] == len(reads)
+    assert result["mapped_reads"] == sum(not x.is_unmapped for x in reads)
+    assert result["duplicate_fraction"] == \
+        sum(x.is_duplicate for x in reads) / float(len(reads))
+    assert result["secondary_fraction"] == \
+        sum(x.is_secondary for x in reads) / float(len(reads))
+    assert sum(result["mapq"].values()) == result["mapped_reads"]
+    assert result["chromosomes"]["chrQ"] == result["mapped_reads"]
+
+
+def test_observe_blocks(monkeypatch):
+    sam = pysam.AlignmentFile("test/data/test.bam")
+    reads = list(sam.fetch(until_eof=True))
+    whole = ReadMetrics(["chrQ"])
+    list(whole.observe(iter(reads)))
+    monkeypatch.setattr("wisestork.qc.TALLY_SIZE", 7)
+    blocks = ReadMetrics(["chrQ"])
+    list(blocks.observe(iter(reads)))
+    assert format_metrics(blocks.to_dict()) == \
+        format_metrics(whole.to_dict())
+
+
+def test_coverage_metrics():
+    metrics = ReadMetrics(["chrQ"])
+    metrics.add_counts(BedTrack(["chrQ"] * 4, [0, 10, 20, 30],
+                                [10, 20, 30, 40], [10, 10, 10, 0]))
+    result = metrics.to_dict()
+    assert result["bins"] == 4
+    assert result["empty_bin_fraction"] == 0.25
+    assert result["bin_mapd"] == 0
+
+
+def test_formats(tmpdir_path):
+    metrics = ReadMetrics(["chrQ"])
+    metrics.tally([0, 1024, 4], [60, 60, 0], [0, 0, -1])
+    tsv = format_metrics(metrics.to_dict()).decode().splitlines()
+    assert tsv[0] == "#metric\tvalue"
+    assert "total_reads\t3" in tsv
+    assert "mapq_60\t2" in tsv
+    assert "chromosome_chrQ\t2" in tsv
+    path = join(tmpdir_path, "metrics.json")
+    write_metrics(path, metrics)
+    result = json.loads(read(path))
+    assert result["total_reads"] == 3
+    assert result["bin_cv"] is None
+
+
+def test_count_metrics(tmpdir_path):
+    plain = join(tmpdir_path, "plain.bed")
+    counted = join(tmpdir_path, "counted.bed")
+    metrics = join(tmpdir_path, "metrics.json")
+    count("test/data/test.bam", plain, 100, "test/data/chrQ.fasta")
+    count("test/data/test.bam", counted, 100, "test/data/chrQ.fasta",
+          metrics_output=metrics)
+    assert read(plain) == read(counted)
+    result = json.loads(read(metrics))
+    assert result["bins"] == 5
+    assert result["chromosomes"]["chrQ"] <= result["mapped_reads"]
+
+
+def test_count_metrics_resume(tmpdir_path):
+    with pytest.raises(ValueError):
+        count("test/data/test.bam", join(tmpdir_path, "out.bed"), 100,
+              "test/data/chrQ.fasta", resume=True,
+              metrics_output=join(tmpdir_path, "metrics.tsv"))
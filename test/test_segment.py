@@ -0,0 +1,73 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import numpy as np
+import pytest
+
+from wisestork.segment import best_split, segment_track, segment_values
+from wisestork.utils import BedTrack
+
+
+def make_track(rng):
+    chroms, values = [], []
+    for name, levels in [(b"chr1", [0, 4, 0]), (b"chr2", [0]),
+                         (b"chr3", [-3, 0])]:
+        for level in levels:
+            values.append(rng.normal(level, 1, 100))
+            chroms += [name] * 100
+    values = np.concatenate(values)
+    starts = np.concatenate([np.arange(x) * 100
+                             for x in [300, 100, 200]])
+    return BedTrack(chroms, starts, starts + 100, values)
+
+
+class TestSegment:
+
+    def test_best_split(self):
+        values = np.array([0.0] * 10 + [5.0] * 6)
+        cumsum = np.concatenate([[0.0], np.cumsum(values)])
+        split, stat = best_split(cumsum, 0, len(values), 2)
+        assert split == 10
+        assert stat > 0
+        assert best_split(cumsum, 0, 3, 2) == (None, 0.0)
+
+    def test_segment_values(self):
+        rng = np.random.RandomState(1)
+        values = np.concatenate([rng.normal(0, 1, 200),
+                                 rng.normal(3, 1, 50),
+                                 rng.normal(0, 1, 200)])
+        bounds = segment_values(values)
+        assert len(bounds) == 4
+        assert abs(bounds[1] - 200) <= 2
+        assert abs(bounds[2] - 250) <= 2
+        assert segment_values(rng.normal(0, 1, 500)).tolist() == [0, 500]
+
+    @pytest.mark.parametrize("threads", [1, 2])
+    def test_segment_track(self, threads):
+        track = make_track(np.random.RandomState(2))
+        track.values[150] = np.nan
+        segments = segment_track(track, threads=threads)
+        assert segments.chromosomes.tolist() == [b"chr1"] * 3 + [b"chr2"] + \
+            [b"chr3"] * 2
+        assert segments.starts[0] == 0
+        assert segments.ends[-1] == 20000
+        assert np.allclose(segments.values, [0, 4, 0, 0, -3, 0], atol=0.5)
+
+    def test_ungrouped(self):
+        track = BedTrack([b"chr1", b"chr2", b"chr1"], [0, 0, 100],
+                         [100, 100, 200], [0.0, 0.0, 0.0])
+        with pytest.raises(ValueError):
+            segment_track(track)
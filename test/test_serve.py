@@ -0,0 +1,110 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import os
+import stat
+import threading
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from wisestork.serve import (ScoringService, is_loopback, make_server,
+                             parse_reference_spec, request, submit)
+from wisestork.ztest import ztest
+
+
+@pytest.fixture(scope="module")
+def service():
+    return ScoringService({"ref": "test/data/ref.bed.gz"})
+
+
+@pytest.fixture
+def socket_path(service):
+    with TemporaryDirectory() as tmp:
+        path = join(tmp, "wisestork.sock")
+        server = make_server(service, socket_path=path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield path
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class TestFunctions:
+
+    def test_parse_reference_spec(self):
+        assert parse_reference_spec("a=/x/y.bed.gz") == ("a", "/x/y.bed.gz")
+        assert parse_reference_spec("/x/y.bed.gz") == ("y", "/x/y.bed.gz")
+
+    def test_run(self, service):
+        with open("test/data/gc_correct.bed") as handle:
+            result = service.run({"bed": handle.read()})
+        lines = result["bed"].splitlines()
+        assert lines[0].startswith("#layout")
+        assert len(lines) == 6
+        with pytest.raises(ValueError):
+            service.run({"reference": "other",
+                         "input": "test/data/gc_correct.bed"})
+
+    def test_root(self, service):
+        with TemporaryDirectory() as tmp:
+            rooted = ScoringService({}, root=tmp)
+            rooted.references = service.references
+            with pytest.raises(ValueError):
+                rooted.run({"input": "test/data/gc_correct.bed"})
+            with pytest.raises(ValueError):
+                rooted.run({"bed": "", "output": join(tmp, "..", "z.bed")})
+            output = join(tmp, "z.bed")
+            with open("test/data/gc_correct.bed") as handle:
+                rooted.run({"bed": handle.read(), "output": output})
+            assert rooted.run({"input": output})["bed"]
+        with open("test/data/gc_correct.bed") as handle:
+            bed = handle.read()
+        assert service.run({"bed": bed})["bed"]
+        for job in ({"input": "-"}, {"bed": bed, "output": "-"}):
+            with pytest.raises(ValueError, match="stdin"):
+                service.run(job)
+
+    def test_loopback(self, service):
+        assert is_loopback("127.0.0.1")
+        assert is_loopback("localhost")
+        assert not is_loopback("0.0.0.0")
+        with pytest.raises(ValueError):
+            make_server(service, host="0.0.0.0", port=1)
+
+
+class TestService:
+
+    def test_submit(self, socket_path):
+        with TemporaryDirectory() as tmp:
+            expected = join(tmp, "expected.bed")
+            ztest("test/data/gc_correct.bed", expected,
+                  "test/data/ref.bed.gz")
+            served = join(tmp, "served.bed")
+            submit("test/data/gc_correct.bed", served,
+                   socket_path=socket_path)
+            with open(expected, "rb") as e, open(served, "rb") as s:
+                assert e.read() == s.read()
+
+    def test_socket_mode(self, socket_path):
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+    def test_error(self, socket_path):
+        with pytest.raises(ValueError):
+            request({"input": "test/data/test.bedgraph"},
+                    socket_path=socket_path)
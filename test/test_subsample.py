@@ -0,0 +1,252 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import shutil
+
+import numpy as np
+import pysam
+import pytest
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from wisestork.count import count, count_regions, sample_regions
+from wisestork.subsample import (MAX_WINDOWS, WINDOW_SPACING, ReadSampler,
+                                 read_hash)
+from wisestork.utils import BedTrack, read_bed
+
+
+@pytest.fixture
+def tmpdir_path():
+    with TemporaryDirectory() as tmp:
+        yield tmp
+
+
+def write_bam(path, lengths, positions):
+    """
+    Write an indexed BAM of 100 bp reads
+    :param lengths: list of chromosome lengths
+    :param positions: list of arrays of read positions per chromosome
+    """
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": "chr{0}".format(i + 1), "LN": x}
+                     for i, x in enumerate(lengths)]}
+    with pysam.AlignmentFile(path, "wb", header=header) as out:
+        for rid, pos in enumerate(positions):
+            for i, x in enumerate(np.sort(pos)):
+                read = pysam.AlignedSegment()
+                read.query_name = "r{0}_{1}".format(rid, i)
+                read.reference_id = rid
+                read.reference_start = int(x)
+                read.cigarstring = "100M"
+                read.query_sequence = "A" * 100
+                out.write(read)
+    pysam.index(path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def even_bam():
+    """
+    Indexed BAM with reads spread evenly over two chromosomes
+    """
+    rng = np.random.RandomState(0)
+    with TemporaryDirectory() as tmp:
+        yield write_bam(join(tmp, "even.bam"), [200000, 100000],
+                        [rng.randint(0, 199900, 20000),
+                         rng.randint(0, 99900, 10000)])
+
+
+@pytest.fixture(scope="module")
+def uneven_bam():
+    """
+    Indexed BAM with coverage that is uneven within 10 kb bins:
+    gaps at the start or end of a bin, and steps within a bin
+    """
+    rng = np.random.RandomState(1)
+    density = np.ones(100000)
+    for start in range(0, 100000, 10000):
+        kind = (start // 10000) % 4
+        if kind == 0:
+            density[start:start+4000] = 0
+        elif kind == 1:
+            density[start+6000:start+10000] = 0
+        elif kind == 2:
+            density[start+5000:start+10000] = 4
+        else:
+            density[start+2500:start+3000] = 20
+    positions = rng.choice(100000, 40000, p=density / density.sum())
+    with TemporaryDirectory() as tmp:
+        yield write_bam(join(tmp, "uneven.bam"), [100100],
+                        [positions])
+
+
+def unindexed(path, tmp):
+    copy = join(tmp, "unindexed.bam")
+    shutil.copy(path, copy)
+    return copy
+
+
+def test_read_hash():
+    assert read_hash("read1") == read_hash("read1")
+    assert read_hash("read1") != read_hash("read1", seed=1)
+    assert 0 <= read_hash("read1") < 1 << 32
+
+
+def test_filter_keeps_pairs():
+    sam = pysam.AlignmentFile("test/data/test.bam")
+    reads = list(sam.fetch(until_eof=True))
+    kept = list(ReadSampler([0.5]).filter(iter(reads)))
+    assert 0 < len(kept) < len(reads)
+    names = set(x.query_name for x in kept)
+    assert sum(x.query_name in names for x in reads) == len(kept)
+    again = list(ReadSampler([0.5]).filter(iter(reads)))
+    assert [x.query_name for x in again] == [x.query_name for x in kept]
+
+
+def test_filter_all():
+    sam = pysam.AlignmentFile("test/data/test.bam")
+    reads = list(sam.fetch(until_eof=True))
+    assert len(list(ReadSampler([1.0]).filter(iter(reads)))) == len(reads)
+    assert len(list(ReadSampler([0.0]).filter(iter(reads)))) == 0
+
+
+def test_scale():
+    track = BedTrack(["chrQ"] * 2, [0, 10], [10, 20], [3, 4])
+    assert ReadSampler([0.5]).scale(track, 0).values.tolist() == [6, 8]
+    assert ReadSampler([1.0]).scale(track, 0) is track
+
+
+def test_from_bam():
+    sam = pysam.AlignmentFile("test/data/test.bam")
+    assert ReadSampler.from_bam(sam, fraction=0.25).fractions.tolist() == \
+        [0.25]
+    assert ReadSampler.from_bam(sam, max_reads=30).fractions.tolist() == \
+        [0.25]
+    assert ReadSampler.from_bam(sam, max_reads=1000).fractions.tolist() == \
+        [1.0]
+    with pytest.raises(ValueError):
+        ReadSampler.from_bam(sam, fraction=0)
+
+
+def test_count_subsample(tmpdir_path):
+    full = join(tmpdir_path, "full.bed")
+    whole = join(tmpdir_path, "whole.bed")
+    half = join(tmpdir_path, "half.bed")
+    # without an index, reads are sampled by name
+    bam = unindexed("test/data/test.bam", tmpdir_path)
+    count("test/data/test.bam", full, 100, "test/data/chrQ.fasta")
+    count(bam, whole, 100, "test/data/chrQ.fasta", fraction=1.0)
+    assert np.array_equal(read_bed(full).values, read_bed(whole).values)
+    count(bam, half, 100, "test/data/chrQ.fasta", fraction=0.5)
+    full_values = read_bed(full).values
+    half_values = read_bed(half).values
+    assert len(half_values) == len(full_values)
+    assert abs(half_values.sum() - full_values.sum()) < \
+        0.5 * full_values.sum()
+
+
+class CountingFetch(object):
+    """
+    Alignment file proxy that counts the reads it fetches
+    """
+
+    def __init__(self, samfile):
+        self.samfile = samfile
+        self.fetched = 0
+
+    def fetch(self, *args):
+        for read in self.samfile.fetch(*args):
+            self.fetched += 1
+            yield read
+
+
+def test_region_windows():
+    sampler = ReadSampler([0.1, 1.0], seed=3)
+    assert sampler.region_windows(1, [0], [100]) is None
+    starts, ends, weights = sampler.region_windows(0, [0, 1000], [1000,
+                                                                  1003], 16)
+    assert starts.shape == (2, 16)
+    # one window in every stratum of the region
+    bounds = np.arange(16) * 1000 // 16
+    assert np.all(starts[0] >= bounds)
+    assert np.all(ends[0] <= np.append(bounds[1:], 1000))
+    assert np.all(ends[0] - starts[0] == 6)
+    assert np.allclose((ends[0] - starts[0]) * weights[0], np.diff(
+        np.append(bounds, 1000)))
+    # strata shorter than a window are taken whole, empty ones skipped
+    assert np.all(ends[1] - starts[1] <= 1)
+    assert np.all(weights[1][ends[1] > starts[1]] == 1)
+    again = ReadSampler([0.1, 1.0], seed=3).region_windows(0, [0], [1000],
+                                                           16)
+    assert np.array_equal(again[0][0], starts[0])
+    # windows are spaced for the index
+    assert sampler.region_windows(0, [0], [1000])[0].shape == (1, 1)
+    assert sampler.region_windows(
+        0, [0], [3 * WINDOW_SPACING])[0].shape == (1, 3)
+    assert sampler.region_windows(
+        0, [0], [100 * WINDOW_SPACING])[0].shape == (1, MAX_WINDOWS)
+
+
+def test_sample_regions(even_bam):
+    sam = pysam.AlignmentFile(even_bam)
+    starts = np.arange(0, 200000, 10000)
+    ends = starts + 10000
+    exact = count_regions(sam, "chr1", starts, ends)
+    proxy = CountingFetch(sam)
+    estimate = sample_regions(
+        proxy, "chr1", starts, ends,
+        ReadSampler([0.1]).region_windows(0, starts, ends, 4))
+    assert abs(estimate.sum() - exact.sum()) < 0.1 * exact.sum()
+    # only the reads reaching into the windows are read
+    assert proxy.fetched < 0.2 * exact.sum()
+
+
+def test_sample_uneven(uneven_bam):
+    sam = pysam.AlignmentFile(uneven_bam)
+    starts = np.arange(0, 100000, 10000)
+    ends = starts + 10000
+    exact = count_regions(sam, "chr1", starts, ends)
+    errors = np.array([
+        sample_regions(sam, "chr1", starts, ends,
+                       ReadSampler([0.1], seed=seed).region_windows(
+                           0, starts, ends, 16)) / exact - 1
+        for seed in range(16)])
+    # no systematic error in any bin, whatever its coverage
+    assert np.all(np.abs(errors.mean(axis=0)) < 0.1)
+    assert np.all(np.abs(errors) < 0.6)
+    # bins without focal spikes are also close in every run
+    assert np.all(np.abs(errors[:, (starts // 10000) % 4 != 3]) < 0.25)
+
+
+def test_count_indexed_subsample(tmpdir_path, even_bam, monkeypatch):
+    full = join(tmpdir_path, "full.bed")
+    sampled = join(tmpdir_path, "sampled.bed")
+    count(even_bam, full, 10000, "test/data/chrQ.fasta")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("all reads are counted")
+
+    monkeypatch.setattr("wisestork.count.reads_per_bin", fail)
+    monkeypatch.setattr("wisestork.count.count_stream", fail)
+    count(even_bam, sampled, 10000, "test/data/chrQ.fasta", fraction=0.1)
+    full_values = read_bed(full).values
+    sampled_values = read_bed(sampled).values
+    assert len(sampled_values) == len(full_values)
+    assert abs(sampled_values.sum() - full_values.sum()) < \
+        0.1 * full_values.sum()
+    count(even_bam, sampled, 10000, "test/data/chrQ.fasta", max_reads=1000)
+    assert abs(read_bed(sampled).values.sum() - full_values.sum()) < \
+        0.2 * full_values.sum()
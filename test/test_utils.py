@@ -14,9 +14,19 @@
 
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+import gzip
+import io
+from tempfile import NamedTemporaryFile
+
+import numpy as np
 import pytest
 from wisestork.utils import (BedLine, utf8, as_str, attempt_numeric,
-                             get_bins, BedReader)
+                             get_bins, BedReader, BedTrack, parse_bed,
+                             read_bed, iter_bed_chunks, write_bed,
+                             SparseTrack, bin_track, layout_runs,
+                             parse_sparse, read_track, write_track,
+                             prefetch, BinIndex, layout_fingerprint,
+                             open_bed, peek_fingerprint)
 
 
 @pytest.fixture
@@ -81,16 +91,226 @@ class TestBedline(object):
 class TestBedReader:
 
     def test_bed(self):
-        reader = BedReader(filename="test/data/test.bed")
+        with pytest.deprecated_call():
+            reader = BedReader(filename="test/data/test.bed")
         records = [x for x in reader]
         assert len(records) == 5
         assert all([x.value == "NA" for x in records])
         assert all([x.chromosome == b"chr1" for x in records])
 
     def test_bedgraph(self):
-        reader = BedReader(filename="test/data/test.bedgraph")
+        with pytest.deprecated_call():
+            reader = BedReader(filename="test/data/test.bedgraph")
         records = [x for x in reader]
         assert len(records) == 5
         assert records[0].value == 10
         assert records[-1].value == 40
         assert all([x.chromosome == b"chr1" for x in records])
+
+
+class TestBulkBed:
+
+    def test_parse_bed(self):
+        track = parse_bed(b"chr1\t0\t10\t5\n\n# comment\nchr1\t10\t20\t7\n")
+        assert len(track) == 2
+        assert track.values.dtype == np.int64
+        assert track[1] == BedLine(b"chr1", 10, 20, 7)
+        assert track[1].value == 7
+
+    def test_parse_three_columns(self):
+        track = parse_bed(b"chr1\t0\t10\n")
+        assert np.isnan(track.values[0])
+
+    def test_parse_malformed(self):
+        with pytest.raises(ValueError):
+            parse_bed(b"chr1\t0\t10\t5\nchr1\t10\t20\n")
+        with pytest.raises(ValueError):
+            parse_bed(b"chr1\tfoo\t10\t5\n")
+
+    def test_read_bedgraph(self):
+        track = read_bed("test/data/test.bedgraph")
+        with pytest.deprecated_call():
+            old = [x for x in BedReader("test/data/test.bedgraph")]
+        assert list(track) == old
+        assert track.values.tolist() == [x.value for x in old]
+
+    def test_read_gzip(self):
+        track = read_bed("test/data/ref.bed.gz")
+        assert len(track) == 5
+        assert track.values.dtype == object
+
+    def test_chunks(self):
+        chunks = list(iter_bed_chunks("test/data/test.bedgraph", 40))
+        assert len(chunks) > 1
+        assert list(BedTrack.concatenate(chunks)) == list(
+            read_bed("test/data/test.bedgraph"))
+
+    def test_write_roundtrip(self):
+        track = read_bed("test/data/gc_correct.bed")
+        handle = io.BytesIO()
+        write_bed(handle, track, chunk_size=2)
+        with open("test/data/gc_correct.bed", "rb") as expected:
+            assert handle.getvalue() == expected.read()
+
+    def test_read_written_gzip(self):
+        tmp = NamedTemporaryFile(suffix=".gz")
+        with gzip.open(tmp.name, "wb") as handle:
+            write_bed(handle, read_bed("test/data/count.bed"))
+        assert read_bed(tmp.name).values.tolist() == [40, 52, 34, 42, 26]
+
+
+@pytest.fixture
+def dense_track():
+    track = BedTrack.concatenate([bin_track("chrQ", 500, 100),
+                                  bin_track("chr2", 250, 100)])
+    return track.with_values(np.array([0, 5, 0, 0, 3, 0, 0, 7]))
+
+
+class TestSparseTrack:
+
+    def test_from_dense(self, dense_track):
+        sparse = SparseTrack.from_dense(dense_track)
+        assert len(sparse) == 8
+        assert sparse.run_chromosomes.tolist() == [b"chrQ", b"chr2"]
+        assert sparse.run_ends.tolist() == [500, 250]
+        assert sparse.indices.tolist() == [1, 4, 7]
+        assert sparse.values.tolist() == [5, 3, 7]
+        stored = sparse.stored()
+        assert stored.starts.tolist() == [100, 400, 200]
+        assert stored.ends.tolist() == [200, 500, 250]
+
+    def test_to_dense(self, dense_track):
+        dense = SparseTrack.from_dense(dense_track).to_dense()
+        assert np.array_equal(dense.chromosomes, dense_track.chromosomes)
+        assert np.array_equal(dense.starts, dense_track.starts)
+        assert np.array_equal(dense.ends, dense_track.ends)
+        assert np.array_equal(dense.values, dense_track.values)
+        part = SparseTrack.from_dense(dense_track).to_dense(3, 6)
+        assert part.values.tolist() == [0, 3, 0]
+        assert part.starts.tolist() == [300, 400, 0]
+
+    def test_layout_runs(self):
+        track = BedTrack(["chr1"] * 6, [0, 100, 150, 200, 500, 520],
+                         [100, 150, 200, 250, 520, 540])
+        chroms, starts, ends, sizes = layout_runs(track)
+        assert starts.tolist() == [0, 150, 200, 500]
+        assert ends.tolist() == [150, 200, 250, 540]
+        assert sizes.tolist() == [100, 50, 50, 20]
+        sparse = SparseTrack(chroms, starts, ends, sizes, [], [])
+        assert np.array_equal(sparse.layout().starts, track.starts)
+        assert np.array_equal(sparse.layout().ends, track.ends)
+
+    def test_overlapping(self):
+        track = BedTrack(["chr1"] * 2, [0, 50], [100, 150], [1, 2])
+        with pytest.raises(ValueError):
+            SparseTrack.from_dense(track)
+
+    def test_roundtrip(self, dense_track):
+        buffer = io.BytesIO()
+        write_track(buffer, SparseTrack.from_dense(dense_track))
+        lines = buffer.getvalue().splitlines()
+        assert lines[0] == b"#sparse\t0"
+        assert len(lines) == 6
+        sparse = parse_sparse(buffer.getvalue())
+        assert sparse.indices.tolist() == [1, 4, 7]
+        assert sparse.values.tolist() == [5, 3, 7]
+
+    def test_index_of(self, dense_track):
+        sparse = SparseTrack.from_dense(dense_track)
+        assert sparse.index_of([b"chr2", b"chrQ"], [100, 0],
+                               [200, 100]).tolist() == [6, 0]
+        with pytest.raises(ValueError):
+            sparse.index_of([b"chrQ"], [50], [150])
+        with pytest.raises(ValueError):
+            sparse.index_of([b"chr3"], [0], [100])
+
+    def test_read(self, dense_track):
+        tmp = NamedTemporaryFile(suffix=".gz")
+        with gzip.open(tmp.name, "wb") as handle:
+            write_track(handle, SparseTrack.from_dense(dense_track))
+        assert isinstance(read_track(tmp.name), SparseTrack)
+        assert read_bed(tmp.name).values.tolist() == \
+            dense_track.values.tolist()
+        chunks = list(iter_bed_chunks(tmp.name, chunk_size=96))
+        assert [len(x) for x in chunks] == [3, 3, 2]
+        assert isinstance(read_track("test/data/count.bed"), BedTrack)
+
+
+class TestLayout:
+
+    def test_fingerprint(self, dense_track):
+        sparse = SparseTrack.from_dense(dense_track)
+        assert layout_fingerprint(dense_track) == layout_fingerprint(sparse)
+        assert len(layout_fingerprint(dense_track)) == 16
+        # values are not part of the layout
+        assert layout_fingerprint(dense_track) == \
+            layout_fingerprint(dense_track.with_values(None))
+        assert layout_fingerprint(dense_track) != \
+            layout_fingerprint(dense_track[::-1])
+        assert layout_fingerprint(dense_track) != \
+            layout_fingerprint(dense_track[1:])
+
+    def test_bin_index(self, dense_track):
+        index = BinIndex(dense_track)
+        assert index.positions([b"chr2", b"chrQ", b"chrQ"], [100, 0, 400],
+                               [200, 100, 500]).tolist() == [6, 0, 4]
+        assert index.positions([], [], []).tolist() == []
+        with pytest.raises(ValueError):
+            index.positions([b"chrQ"], [50], [150])
+        with pytest.raises(ValueError):
+            index.positions([b"chr3"], [0], [100])
+
+    def test_peek_fingerprint(self, dense_track):
+        def read_fingerprint(path):
+            with open_bed(path) as handle:
+                return peek_fingerprint(handle)
+
+        assert read_fingerprint("test/data/count.bed") is None
+        for track in (dense_track, SparseTrack.from_dense(dense_track)):
+            tmp = NamedTemporaryFile(suffix=".gz")
+            with gzip.open(tmp.name, "wb") as handle:
+                write_track(handle, track, layout=True)
+            assert read_fingerprint(tmp.name) == \
+                layout_fingerprint(dense_track)
+            assert read_bed(tmp.name).values.tolist() == \
+                dense_track.values.tolist()
+
+
+class TestPrefetch:
+
+    def test_items(self):
+        assert list(prefetch(iter(range(100)), depth=3)) == list(range(100))
+        assert list(prefetch(iter(range(10)), depth=0)) == list(range(10))
+        assert list(prefetch(iter([]))) == []
+
+    def test_exception(self):
+        def failing():
+            yield 1
+            raise ValueError("broken")
+        items = prefetch(failing())
+        assert next(items) == 1
+        with pytest.raises(ValueError):
+            next(items)
+
+    def test_early_stop(self):
+        closed = []
+
+        def produce():
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                closed.append(True)
+        items = prefetch(produce(), depth=2)
+        assert next(items) == 0
+        items.close()
+        assert closed == [True]
+
+    def test_bed_chunks(self):
+        direct = list(iter_bed_chunks("test/data/test.bedgraph", 40,
+                                      depth=0))
+        ahead = list(iter_bed_chunks("test/data/test.bedgraph", 40))
+        assert len(direct) == len(ahead) > 1
+        for a, b in zip(direct, ahead):
+            assert np.array_equal(a.starts, b.starts)
+            assert np.array_equal(a.values, b.values)
@@ -0,0 +1,80 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from wisestork.cohort import cohort_build
+from wisestork.newref import newref
+from wisestork.utils import open_output, read_bed, write_bed
+from wisestork.validate import bin_statistics, sample_statistics, validate
+from wisestork.ztest import ztest
+
+
+class TestValidate:
+
+    def test_bin_statistics(self):
+        z = np.array([[0.0, 4.0, np.nan],
+                      [1.0, 0.0, np.nan],
+                      [-1.0, 5.0, np.nan]])
+        mean, sd, fraction, unstable = bin_statistics(z, 3.0, 0.5)
+        assert np.allclose(mean[:2], [0, 3])
+        assert np.isclose(sd[0], np.sqrt(2 / 3.0))
+        assert np.allclose(fraction[:2], [0, 2 / 3.0])
+        assert unstable.tolist() == [False, True, False]
+
+    def test_sample_statistics(self):
+        z = np.array([[0.0, 4.0, np.nan], [np.nan, np.nan, np.nan]])
+        counts, mean, sd, mad, fraction = sample_statistics(z, 3.0)
+        assert counts.tolist() == [2, 0]
+        assert mean[0] == 2 and sd[0] == 2 and mad[0] == 2
+        assert fraction[0] == 0.5
+        assert np.isnan(mean[1])
+
+    def test_validate(self):
+        init = read_bed("test/data/gc_correct.bed")
+        with TemporaryDirectory() as tmp:
+            paths = []
+            for i, multi in enumerate([1.5, 2.0, 3.0, 3.5, 4.0]):
+                paths.append(join(tmp, "s{0}.bed".format(i)))
+                values = init.values * multi
+                values[i] += 0.5
+                with open_output(paths[-1]) as handle:
+                    write_bed(handle, init.with_values(values))
+            ref = join(tmp, "ref.bed")
+            newref(paths, ref, "test/data/chrQ.fasta", 100, n_bins=3)
+            store = join(tmp, "store")
+            cohort_build(paths[2:], store)
+            out, samples = join(tmp, "bins.tsv"), join(tmp, "samples.tsv")
+            validate(paths[:2] + [store], ref, out, samples)
+            expected = []
+            for path in paths:
+                ztest(path, join(tmp, "z.bed"), ref)
+                expected.append(read_bed(join(tmp, "z.bed")).values)
+            expected = np.array(expected)
+            bins = np.genfromtxt(out, usecols=(3, 4, 5, 6))
+            with open(samples) as handle:
+                rows = [x.split("\t") for x in handle if
+                        not x.startswith("#")]
+        assert np.allclose(bins[:, 0], np.nanmean(expected, axis=0),
+                           equal_nan=True)
+        assert np.allclose(bins[:, 1], np.nanstd(expected, axis=0),
+                           equal_nan=True)
+        assert [x[0] for x in rows] == ["s0", "s1", "s2", "s3", "s4"]
+        assert np.allclose([float(x[3]) for x in rows],
+                           np.nanstd(expected, axis=1))
@@ -17,24 +17,23 @@
 from collections import namedtuple
 import random
 from math import isnan
+from os.path import join
+from tempfile import TemporaryDirectory
 
-from wisestork.ztest import create_key,  get_z_score
-from wisestork.utils import BedLine
+import numpy as np
+import pytest
+
+from wisestork.newref import format_reference_ids
+from wisestork.ztest import (ReferenceIndex, get_z_score,
+                             padded_neighbours, z_scores, ztest)
+from wisestork.utils import (BedTrack, format_layout,
+                             layout_fingerprint, read_bed, write_bed)
 
 ValueObject = namedtuple("ValueObject", ['value'])  # little helper object
 
 
 class TestFunctions:
 
-    def test_create_key(self):
-        bline = BedLine(b"chr1", 1, 100, 0)
-        bline2 = BedLine(b"chr1", b"1", b"100", 0)
-        assert create_key(bline) == b"chr1|1|100"
-        assert create_key(bline2) == b"chr1|1|100"
-
-    def test_build_reference_index(self):
-        pass
-
     def test_get_z_score(self):
         assert isnan(get_z_score(None, []))
         objects = [ValueObject(random.normalvariate(100, 20)) for _ in
@@ -49,5 +48,125 @@ class TestFunctions:
                     range(2000)]
         assert isnan(get_z_score(zero_test, zero_std))
 
+    def test_padded_neighbours(self):
+        padded = padded_neighbours([[1, 2], [], [0]])
+        assert padded.tolist() == [[1, 2], [-1, -1], [0, -1]]
+
+    def test_z_scores_mean(self):
+        rng = np.random.RandomState(1)
+        values = rng.normal(100, 20, 50)
+        lists = [rng.choice(50, rng.randint(0, 10), replace=False).tolist()
+                 for _ in range(50)]
+        z = z_scores(values, padded_neighbours(lists), chunk_size=7)
+        for i, lst in enumerate(lists):
+            expected = get_z_score(ValueObject(values[i]),
+                                   [ValueObject(values[x]) for x in lst])
+            if isnan(expected):
+                assert isnan(z[i])
+            else:
+                assert abs(z[i] - expected) < 1e-9
+
+    def test_z_scores_robust(self):
+        rng = np.random.RandomState(2)
+        values = rng.normal(100, 20, 50)
+        lists = [rng.choice(50, rng.randint(0, 10), replace=False).tolist()
+                 for _ in range(50)]
+        z = z_scores(values, padded_neighbours(lists), "robust",
+                     chunk_size=7)
+        for i, lst in enumerate(lists):
+            ref = values[lst]
+            if len(ref) == 0:
+                assert isnan(z[i])
+                continue
+            med = np.median(ref)
+            mad = np.median(np.abs(ref - med)) * 1.4826
+            if mad == 0:
+                assert isnan(z[i])
+            else:
+                assert abs(z[i] - (values[i] - med) / mad) < 1e-9
+
+    def test_z_scores_robust_outlier(self):
+        # a gained bin is masked by one outlier neighbour
+        # with the mean statistic, but not with the robust statistic
+        values = np.array([1.5, 1.1, 0.9, 1.0, 1.05, 0.95, 100.0])
+        neighbours = padded_neighbours([[1, 2, 3, 4, 5, 6]] + [[]] * 6)
+        assert abs(z_scores(values, neighbours, "mean")[0]) < 1
+        assert z_scores(values, neighbours, "robust")[0] > 3
+
     def test_ztest(self):
         pass
+
+
+class TestReferenceIndex:
+
+    def write_positional(self, path, index, fingerprint=None):
+        targets = np.arange(len(index))[::-1]
+        neighbours = [x[x >= 0] for x in index.neighbours[targets]]
+        with open(path, "wb") as handle:
+            handle.write(format_layout(
+                fingerprint or layout_fingerprint(index.layout)))
+            handle.write(format_reference_ids(index.layout, targets,
+                                              neighbours))
+
+    def test_formats(self):
+        legacy = ReferenceIndex.load("test/data/ref.bed.gz")
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, "ref.bed")
+            self.write_positional(path, legacy)
+            positional = ReferenceIndex.load(path)
+            assert positional.fingerprint == legacy.fingerprint
+            assert np.array_equal(positional.layout.starts,
+                                  legacy.layout.starts)
+            assert np.array_equal(positional.neighbours, legacy.neighbours)
+            self.write_positional(path, legacy, "0" * 16)
+            with pytest.raises(ValueError):
+                ReferenceIndex.load(path)
+
+    def test_align(self):
+        index = ReferenceIndex.load("test/data/ref.bed.gz")
+        track = read_bed("test/data/gc_correct.bed")
+        assert index.align(track) is index.neighbours
+        reordered = track[::-1]
+        aligned = index.align(reordered)
+        expected = index.score(track).values[::-1]
+        assert np.allclose(index.score(reordered).values, expected,
+                           equal_nan=True)
+        assert index.align(reordered) is aligned
+        with pytest.raises(ValueError):
+            index.align(track[1:])
+        # same size, but one bin twice
+        duplicated = BedTrack.concatenate([track[:1], track[:-1]])
+        with pytest.raises(ValueError):
+            index.align(duplicated)
+
+    def test_stale_header(self):
+        track = read_bed("test/data/gc_correct.bed")
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, "query.bed")
+            with open(path, "wb") as handle:
+                # header of the full track on a truncated track
+                handle.write(format_layout(layout_fingerprint(track)))
+                write_bed(handle, track[1:])
+            with pytest.raises(ValueError):
+                ztest(path, join(tmp, "z.bed"), "test/data/ref.bed.gz")
+
+            # a dictionary in which neighbours depend on the bin order
+            layout = track.with_values(None)
+            database = join(tmp, "ref.bed")
+            with open(database, "wb") as handle:
+                handle.write(format_layout(layout_fingerprint(layout)))
+                handle.write(format_reference_ids(
+                    layout, np.arange(5),
+                    [np.array([(i+1) % 5, (i+2) % 5, (i+3) % 5])
+                     for i in range(5)]))
+            query = track.with_values(np.array([1.0, 2.0, 4.0, 8.0, 16.0]))
+            # same bins, re-sorted below the header of the original order
+            with open(path, "wb") as handle:
+                handle.write(format_layout(layout_fingerprint(query)))
+                write_bed(handle, query[::-1])
+            ztest(path, join(tmp, "z.bed"), database)
+            expected = ReferenceIndex.load(database).score(query)[::-1]
+            scored = read_bed(join(tmp, "z.bed"))
+            assert np.array_equal(scored.starts, expected.starts)
+            assert np.allclose(scored.values, expected.values,
+                               equal_nan=True)
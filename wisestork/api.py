@@ -0,0 +1,112 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.api
+~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+
+In-memory interface to the pipeline.
+All stages take and return BedTracks, so they can be chained
+without reading or writing intermediate files:
+
+    >>> counts = count("sample.bam", binsize=50000)
+    >>> corrected = gc_correct(counts, "reference.fa")
+    >>> index = load_reference("dictionary.bed.gz")
+    >>> z = zscore(corrected, index)
+"""
+from pyfaidx import Fasta
+
+from .count import count_track
+from .gc_correct import correct, correct_sparse
+from .newref import MEDIAN, EUCLIDEAN, build_reference as _build_reference
+from .utils import (BedTrack, SparseTrack, read_bed, read_track, write_bed,
+                    write_track)
+from .ztest import MEAN, ReferenceIndex
+
+__all__ = ["BedTrack", "ReferenceIndex", "SparseTrack", "build_reference",
+           "count", "gc_correct", "load_reference", "read_bed", "read_track",
+           "write_bed", "write_track", "zscore"]
+
+
+def count(bam, binsize=50000, bin_file=None):
+    """
+    Count reads per bin
+    :param bam: path to indexed BAM, or an instance of pysam.AlignmentFile
+    :param binsize: binsize
+    :param bin_file: optional path to region BED file, or BedTrack
+    :return: BedTrack of counts
+    """
+    return count_track(bam, binsize, bin_file)
+
+
+def gc_correct(track, reference, frac_n=0.1, frac_r=0.0001, iter=3,
+               frac_lowess=0.1):
+    """
+    GC-correct a track of counts
+    :param track: BedTrack or SparseTrack of counts
+    :param reference: path to reference fasta, or an instance of
+        pyfaidx.Fasta
+    :param frac_n: maximal fraction of N-bases per bin
+    :param frac_r: minimum fraction of reads per bin
+    :param iter: number of iterations of LOWESS function
+    :param frac_lowess: fraction of data used for LOWESS function
+    :return: BedTrack of corrected values, or SparseTrack for sparse input
+    """
+    fasta = reference if isinstance(reference, Fasta) else Fasta(reference)
+    if isinstance(track, SparseTrack):
+        return correct_sparse(track, fasta, frac_n, frac_r, iter,
+                              frac_lowess)
+    return correct(track, fasta, frac_n, frac_r, iter, frac_lowess)
+
+
+def build_reference(tracks, reference, binsize=50000, n_bins=250,
+                    bin_file=None, selection=MEDIAN, metric=EUCLIDEAN):
+    """
+    Build a reference from gc-corrected tracks of normal samples
+    :param tracks: list of BedTracks, paths to gc-corrected BED files
+        and/or cohort stores
+    :param reference: path to reference fasta
+    :param binsize: binsize
+    :param n_bins: number of neighbour bins to consider
+    :param bin_file: optional path to region BED file
+    :param selection: neighbour selection mode, 'median' or 'profile'
+    :param metric: distance metric for profile selection
+    :return: ReferenceIndex
+    """
+    return _build_reference(tracks, reference, binsize, n_bins, bin_file,
+                            selection=selection, metric=metric)
+
+
+def load_reference(path):
+    """
+    Load a reference dictionary file
+    :param path: path to (possibly gzipped) reference dictionary
+    :return: ReferenceIndex
+    """
+    return ReferenceIndex.load(path)
+
+
+def zscore(track, reference, statistic=MEAN):
+    """
+    Calculate z-scores of a gc-corrected track
+    :param track: BedTrack or SparseTrack of gc-corrected values
+    :param reference: ReferenceIndex
+    :param statistic: 'mean' or 'robust'
+    :return: BedTrack of z-scores
+    """
+    return reference.score(track, statistic)
@@ -0,0 +1,342 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.batch
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pysam
+from pyfaidx import Fasta
+
+from . import kernels, precision
+from .count import READ_BLOCK_SIZE, count, get_chromosomes_from_header
+from .gc_correct import GCTable, correct_table
+from .utils import BedTrack, bin_track, open_output, read_bed, write_track
+from .ztest import MEAN, ReferenceIndex
+
+COUNT = "count"
+GC_CORRECT = "gc-correct"
+ZSCORE = "zscore"
+STAGES = (COUNT, GC_CORRECT, ZSCORE)
+SUFFIXES = {COUNT: ".count.bed", GC_CORRECT: ".gc.bed", ZSCORE: ".z.bed"}
+
+# Rough peak memory of a worker in bytes: the interpreter with its
+# libraries, and per stage a fixed part and a part per bin.
+# The GC table and reference dictionary are held once by the parent
+# and shared with the workers, so they are not part of these
+WORKER_MEMORY = 100 << 20
+STAGE_MEMORY = {
+    # blocks of read positions, and the track of counts
+    COUNT: (READ_BLOCK_SIZE * 80, 100),
+    # the track, the selected bins and the LOWESS arrays
+    GC_CORRECT: (0, 300),
+    # gathered neighbour values of one chunk of bins (see ztest.z_scores)
+    ZSCORE: (3 << 26, 250)
+}
+
+Sample = namedtuple("Sample", ["name", "bam"])
+
+
+def read_manifest(path):
+    """
+    Read a manifest of samples.
+    Every line holds a sample name and the path to its BAM file,
+    separated by a tab, or only the path, in which case the name is
+    the file name without .bam. Empty lines and lines starting with
+    # are skipped. Relative paths are relative to the manifest
+    :param path: path to manifest
+    :return: list of Sample
+    :raises ValueError: on duplicate or invalid sample names
+    """
+    samples = []
+    root = os.path.dirname(os.path.abspath(path))
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) == 1:
+                name = os.path.basename(fields[0])
+                if name.endswith(".bam"):
+                    name = name[:-len(".bam")]
+                fields = [name] + fields
+            if len(fields) != 2 or not fields[0] or os.sep in fields[0]:
+                raise ValueError("Invalid manifest line: {0}".format(line))
+            samples.append(Sample(fields[0], os.path.join(root, fields[1])))
+    names = [x.name for x in samples]
+    if len(set(names)) != len(names):
+        raise ValueError("Manifest has duplicate sample names")
+    return samples
+
+
+def stage_path(output_dir, name, stage):
+    """
+    Output path of a stage of a sample
+    :param output_dir: path to output directory
+    :param name: sample name
+    :param stage: name of stage
+    :return: path
+    """
+    return os.path.join(output_dir, name + SUFFIXES[stage])
+
+
+def stage_memory(stage, n_bins):
+    """
+    Estimated peak memory of a worker running a stage
+    :param stage: name of stage
+    :param n_bins: number of bins
+    :return: bytes
+    """
+    fixed, per_bin = STAGE_MEMORY[stage]
+    return WORKER_MEMORY + fixed + per_bin * n_bins
+
+
+def physical_memory():
+    """
+    Physical memory of this machine
+    :return: bytes, or None when unknown
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def batch_layout(samples, binsize, binfile=None):
+    """
+    Bin layout shared by all samples of a batch
+    :param samples: list of Sample
+    :param binsize: binsize
+    :param binfile: optional path to region BED file
+    :return: BedTrack of bins, in the order count writes them
+    :raises ValueError: when the BAM files have different
+        reference sequences
+    """
+    chromosomes = None
+    for sample in samples:
+        with pysam.AlignmentFile(sample.bam, "rb") as samfile:
+            these = get_chromosomes_from_header(samfile.header)
+        if chromosomes is None:
+            chromosomes = these
+        elif these != chromosomes:
+            raise ValueError("BAM file of sample {0} has different reference "
+                             "sequences".format(sample.name))
+    if binfile:
+        return read_bed(binfile).with_values(None)
+    return BedTrack.concatenate(bin_track(ch, ln, binsize)
+                                for ch, ln in chromosomes or [])
+
+
+class BatchScheduler(object):
+    """
+    Order in which the stages of a batch are started.
+
+    A stage is started when a worker is free and its memory estimate
+    fits in what the running stages leave of the budget. Later stages
+    go first, so that samples are finished before new ones are
+    started, and a smaller stage may overtake a larger one that does
+    not fit. A stage that does not fit the budget on its own is
+    started when nothing else runs.
+    """
+
+    def __init__(self, samples, n_bins, budget=None, jobs=1):
+        """
+        Create instance of BatchScheduler
+        :param samples: list of Sample
+        :param n_bins: number of bins, for the memory estimates
+        :param budget: memory budget of the workers in bytes,
+            or None for no bound
+        :param jobs: number of workers
+        """
+        self.tasks = [(0, x) for x in samples]
+        self.estimates = [stage_memory(x, n_bins) for x in STAGES]
+        self.budget = budget
+        self.jobs = jobs
+        self.running = {}
+
+    @property
+    def reserved(self):
+        return sum(self.running.values())
+
+    def finished(self):
+        return len(self.tasks) == 0 and len(self.running) == 0
+
+    def next(self):
+        """
+        Next stage to start
+        :return: 2-tuple of (stage, Sample), or None when no stage
+            can be started now
+        """
+        if len(self.running) >= self.jobs:
+            return None
+        for task in sorted(self.tasks, key=lambda x: -x[0]):
+            need = self.estimates[task[0]]
+            if (len(self.running) == 0 or self.budget is None or
+                    self.reserved + need <= self.budget):
+                self.tasks.remove(task)
+                self.running[task] = need
+                return STAGES[task[0]], task[1]
+        return None
+
+    def done(self, stage, sample, success=True):
+        """
+        Record that a stage has ended. On success, the next stage of
+        the sample becomes ready
+        :param stage: name of stage
+        :param sample: Sample
+        :param success: whether the stage succeeded
+        """
+        i = STAGES.index(stage)
+        del self.running[(i, sample)]
+        if success and i + 1 < len(STAGES):
+            self.tasks.append((i + 1, sample))
+
+
+_shared = {}
+
+
+def _init_worker(params, table, index):
+    """
+    Set up a worker process. With the fork start method, the table
+    and index are shared with the parent instead of copied
+    """
+    kernels.use(params["kernels"])
+    precision.use(params["precision"])
+    _shared.update(params=params, table=table, index=index)
+
+
+def run_stage(stage, sample, output_dir):
+    """
+    Run one stage of one sample in a worker
+    :param stage: name of stage
+    :param sample: Sample
+    :param output_dir: path to output directory
+    :return: 2-tuple of (stage, sample name)
+    """
+    params = _shared["params"]
+    output = stage_path(output_dir, sample.name, stage)
+    if stage == COUNT:
+        count(sample.bam, output, params["binsize"], params["reference"],
+              params["binfile"])
+    elif stage == GC_CORRECT:
+        path = stage_path(output_dir, sample.name, COUNT)
+        track = read_bed(path)
+        corrected = correct_table(track, _shared["table"], params["frac_n"],
+                                  params["frac_r"], params["iter"],
+                                  params["frac_lowess"])
+        with open_output(output) as ohandle:
+            write_track(ohandle, corrected, layout=True)
+    else:
+        path = stage_path(output_dir, sample.name, GC_CORRECT)
+        scored = _shared["index"].score(read_bed(path), params["statistic"])
+        with open_output(output) as ohandle:
+            write_track(ohandle, scored, layout=True)
+    return stage, sample.name
+
+
+def run_batch(samples, output_dir, reference, database_path, binsize=50000,
+              binfile=None, frac_n=0.1, frac_r=0.0001, iter=3,
+              frac_lowess=0.1, statistic=MEAN, jobs=1, memory_limit=None):
+    """
+    Count, gc-correct and score all samples of a batch in a pool of
+    worker processes. The GC content of the bins and the reference
+    dictionary are loaded once, before the workers start.
+    A failing sample does not stop the others
+    :param samples: list of Sample
+    :param output_dir: path to output directory. Every sample gets
+        <name>.count.bed, <name>.gc.bed and <name>.z.bed
+    :param reference: path to reference fasta
+    :param database_path: path to reference dictionary
+    :param binsize: binsize
+    :param binfile: optional path to region BED file
+    :param frac_n: maximal fraction of N-bases per bin
+    :param frac_r: minimum fraction of reads per bin
+    :param iter: number of iterations of LOWESS function
+    :param frac_lowess: fraction of data used for LOWESS function
+    :param statistic: 'mean' or 'robust'
+    :param jobs: number of worker processes
+    :param memory_limit: memory budget in bytes, or None for no bound
+    :return: dict of sample name: error message, of failed samples
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    layout = batch_layout(samples, binsize, binfile)
+    print("Reading GC content of {0} bins".format(len(layout)),
+          file=sys.stderr)
+    table = GCTable.from_fasta(layout, Fasta(reference))
+    database = ReferenceIndex.load(database_path)
+    index = ReferenceIndex(layout, database.align(layout))
+    budget = None
+    if memory_limit is not None:
+        budget = memory_limit - table.nbytes - index.neighbours.nbytes
+    scheduler = BatchScheduler(samples, len(layout), budget, jobs)
+    params = {"binsize": binsize, "reference": reference,
+              "binfile": binfile, "frac_n": frac_n, "frac_r": frac_r,
+              "iter": iter, "frac_lowess": frac_lowess,
+              "statistic": statistic, "kernels": kernels.backend(),
+              "precision": precision.precision()}
+    failed = {}
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(params, table, index)) as pool:
+        futures = {}
+        while not scheduler.finished():
+            task = scheduler.next()
+            while task is not None:
+                futures[pool.submit(run_stage, task[0], task[1],
+                                    output_dir)] = task
+                task = scheduler.next()
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, sample = futures.pop(future)
+                error = future.exception()
+                if error is None:
+                    print("{0}: {1} done".format(sample.name, stage),
+                          file=sys.stderr)
+                else:
+                    failed[sample.name] = "{0}: {1}".format(stage, error)
+                    print("{0}: {1} failed: {2}".format(sample.name, stage,
+                                                        error),
+                          file=sys.stderr)
+                scheduler.done(stage, sample, error is None)
+    return failed
+
+
+def batch(manifest, output_dir, reference, database_path, binsize=50000,
+          binfile=None, frac_n=0.1, frac_r=0.0001, iter=3, frac_lowess=0.1,
+          statistic=MEAN, jobs=1, memory_limit=None):
+    """
+    Main function for running a manifest of BAM files through count,
+    gc-correct and zscore. See run_batch for the parameters
+    :param manifest: path to manifest (see read_manifest)
+    :raises ValueError: when any sample failed
+    """
+    samples = read_manifest(manifest)
+    if len(samples) == 0:
+        raise ValueError("Manifest has no samples")
+    failed = run_batch(samples, output_dir, reference, database_path,
+                       binsize, binfile, frac_n, frac_r, iter, frac_lowess,
+                       statistic, jobs, memory_limit)
+    if failed:
+        raise ValueError("{0} of {1} samples failed: {2}".format(
+            len(failed), len(samples),
+            "; ".join("{0} ({1})".format(*x) for x in sorted(failed.items()))))
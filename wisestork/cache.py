@@ -0,0 +1,217 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.cache
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+
+from . import version
+from .utils import STDIO, open_output
+
+CACHE_SUFFIX = ".bed"
+FINGERPRINT_BYTES = 1 << 16
+DEFAULT_CACHE_SIZE = 10 << 30
+
+
+def fingerprint(path):
+    """
+    Fingerprint of a file: its size, modification time and a checksum
+    of its first bytes. For a BAM file, the first bytes hold the
+    header. For a Fasta file, the checksum of the index is included
+    :param path: path to file
+    :return: hex string
+    """
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    digest.update("{0}:{1}".format(stat.st_size,
+                                   stat.st_mtime_ns).encode())
+    with open(path, "rb") as handle:
+        digest.update(handle.read(FINGERPRINT_BYTES))
+    if os.path.exists(path + ".fai"):
+        with open(path + ".fai", "rb") as handle:
+            digest.update(handle.read())
+    return digest.hexdigest()
+
+
+def content_hash(path):
+    """
+    Checksum of the full contents of a (small) file
+    :param path: path to file
+    :return: hex string
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Directory of stage outputs, stored under a key derived from
+    everything that determines them: the stage, the identity of its
+    inputs, its parameters and the wisestork version.
+
+    Entries are evicted least recently used first when the total size
+    exceeds the bound. Using an entry refreshes its modification time.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        """
+        Open a cache directory, creating it if needed
+        :param path: path to cache directory
+        :param max_size: maximum total size in bytes, or None for no bound
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(stage, params):
+        """
+        Cache key of a stage
+        :param stage: name of stage
+        :param params: JSON-serializable dict of input fingerprints
+            and parameters
+        :return: hex string
+        """
+        content = json.dumps({"stage": stage, "params": params,
+                              "version": version()}, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, key + CACHE_SUFFIX)
+
+    def get(self, key):
+        """
+        Path of a cached output
+        :param key: cache key
+        :return: path, or None on a miss
+        """
+        path = self.entry(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def store(self, key, source, move=False):
+        """
+        Store an output under a key
+        :param key: cache key
+        :param source: path to output file
+        :param move: move the file into the cache instead of copying it
+        """
+        tmp = self.temporary(key)
+        if move:
+            os.replace(source, tmp)
+        else:
+            shutil.copyfile(source, tmp)
+        os.replace(tmp, self.entry(key))
+        self.evict(keep=key)
+
+    def temporary(self, key):
+        return "{0}.{1}.tmp".format(self.entry(key), os.getpid())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits its bound
+        :param keep: key of an entry that is never removed
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(CACHE_SUFFIX):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(x[1] for x in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            if keep is not None and name == keep + CACHE_SUFFIX:
+                continue
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+
+def copy_output(source, output_path):
+    """
+    Copy a file to an output path
+    :param source: path to file
+    :param output_path: path to output, or '-' for stdout
+    """
+    with open(source, "rb") as ihandle, open_output(output_path) as ohandle:
+        shutil.copyfileobj(ihandle, ohandle)
+
+
+@contextmanager
+def cached_path(output_path, cache, stage, params):
+    """
+    Produce the output of a stage through a cache.
+    On a hit, the cached output is copied to the output path and the
+    context yields None, so the stage can be skipped. On a miss, it
+    yields the path the stage should write to, and the result is
+    stored afterwards. Without a cache, it yields the output path
+    :param output_path: path to output, or '-' for stdout
+    :param cache: ResultCache, or None to disable caching
+    :param stage: name of stage
+    :param params: dict of input fingerprints and parameters
+    :return: context manager yielding a path or None
+    """
+    if cache is None:
+        yield output_path
+        return
+    key = cache.key(stage, params)
+    hit = cache.get(key)
+    if hit is not None:
+        print("Using cached {0} output".format(stage), file=sys.stderr)
+        copy_output(hit, output_path)
+        yield None
+    elif output_path == STDIO:
+        tmp = cache.temporary(key) + ".out"
+        try:
+            yield tmp
+            copy_output(tmp, STDIO)
+            cache.store(key, tmp, move=True)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    else:
+        yield output_path
+        cache.store(key, output_path)
+
+
+def open_cache(cache_dir, max_size=DEFAULT_CACHE_SIZE, input_path=None):
+    """
+    Open a cache, unless caching is disabled or impossible
+    :param cache_dir: path to cache directory, or None
+    :param max_size: maximum total size in bytes
+    :param input_path: input path of the stage. Input on stdin
+        can not be fingerprinted, and is never cached
+    :return: ResultCache or None
+    """
+    if cache_dir is None or input_path == STDIO:
+        return None
+    return ResultCache(cache_dir, max_size)
@@ -0,0 +1,128 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.checkpoint
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import json
+import os
+from contextlib import contextmanager
+
+from .utils import STDIO
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+def file_identity(path):
+    """
+    Identity of an input file, by absolute path, size and
+    modification time. Directories are identified by their files
+    :param path: path to file or directory
+    :return: list
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return [path] + [file_identity(os.path.join(path, x))
+                         for x in sorted(os.listdir(path))]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+class Checkpoint(object):
+    """
+    Progress record of an output file that is written in one pass.
+
+    Next to the output, a small JSON file records the parameters of
+    the job, the number of output bytes that are complete and how
+    far the job got. A resumed job truncates the output to the
+    completed bytes and continues from there.
+    """
+
+    def __init__(self, output_path, params):
+        """
+        Create instance of Checkpoint
+        :param output_path: path to output file. Can not be stdout
+        :param params: JSON-serializable description of the job.
+            A checkpoint is only resumed by a job with equal params
+        """
+        if output_path == STDIO:
+            raise ValueError("Can not checkpoint output to stdout")
+        self.output_path = output_path
+        self.path = output_path + CHECKPOINT_SUFFIX
+        self.params = json.loads(json.dumps(params))
+        self.progress = None
+
+    def load(self):
+        """
+        Load the progress of an earlier run of this job
+        :return: progress, or None when there is no checkpoint
+        :raises ValueError: when the checkpoint is of a different job
+            or the output is shorter than recorded
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as handle:
+            record = json.load(handle)
+        if record["params"] != self.params:
+            raise ValueError("Checkpoint {0} is of a different "
+                             "job".format(self.path))
+        if not (os.path.exists(self.output_path) and
+                os.path.getsize(self.output_path) >= record["offset"]):
+            raise ValueError("Output {0} is shorter than its "
+                             "checkpoint".format(self.output_path))
+        self.offset = record["offset"]
+        self.progress = record["progress"]
+        return self.progress
+
+    @contextmanager
+    def open(self, resume=False):
+        """
+        Open the output for writing. When resuming from a checkpoint,
+        incomplete output is truncated and writing continues after
+        the completed bytes. On success, the checkpoint is removed
+        :param resume: continue from an existing checkpoint
+        :return: context manager yielding a binary file handle
+        """
+        if resume and self.load() is not None:
+            handle = open(self.output_path, "r+b")
+            handle.truncate(self.offset)
+            handle.seek(self.offset)
+        else:
+            self.progress = None
+            handle = open(self.output_path, "wb")
+        with handle:
+            yield handle
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def update(self, handle, progress):
+        """
+        Record that all output written so far is complete
+        :param handle: output handle
+        :param progress: JSON-serializable progress of the job
+        """
+        handle.flush()
+        os.fsync(handle.fileno())
+        record = {"params": self.params, "offset": handle.tell(),
+                  "progress": progress}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as ohandle:
+            json.dump(record, ohandle)
+        os.replace(tmp, self.path)
+        self.progress = progress
@@ -0,0 +1,201 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.cohort
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import json
+import os
+
+import numpy as np
+
+from . import precision
+from .utils import STDIO, BedTrack, read_bed
+
+META_FILE = "cohort.json"
+LAYOUT_FILE = "layout.npz"
+MATRIX_FILE = "matrix.dat"
+FORMAT_VERSION = 1
+
+
+def is_cohort(path):
+    """
+    Whether a path points to a cohort store
+    :param path: path
+    :return: Boolean
+    """
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+def sample_name(path):
+    """
+    Derive a sample name from a BED path by stripping
+    directories and BED/compression extensions
+    :param path: path to BED file
+    :return: string
+    """
+    name = os.path.basename(path)
+    for ext in (".gz", ".bed"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+class CohortStore(object):
+    """
+    On-disk samples x bins matrix of gc-corrected values.
+
+    A store is a directory containing the shared bin layout,
+    the sample names and a raw C-ordered matrix file with one row
+    per sample, so that rows can be appended and the whole matrix
+    can be memory-mapped.
+    """
+
+    def __init__(self, path):
+        """
+        Open an existing cohort store
+        :param path: path to store directory
+        """
+        if not is_cohort(path):
+            raise ValueError("{0} is not a cohort store".format(path))
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as handle:
+            self.meta = json.load(handle)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported cohort store version "
+                             "{0}".format(self.meta["version"]))
+        self.dtype = np.dtype(self.meta["dtype"])
+        with np.load(os.path.join(path, LAYOUT_FILE)) as layout:
+            self.layout = BedTrack(layout["chromosomes"], layout["starts"],
+                                   layout["ends"])
+
+    @classmethod
+    def create(cls, path, layout, dtype=np.float64):
+        """
+        Create a new, empty cohort store
+        :param path: path to store directory. Must not be a store already
+        :param layout: BedTrack of bins shared by all samples
+        :param dtype: dtype of matrix values
+        :return: CohortStore
+        """
+        if is_cohort(path):
+            raise ValueError("Cohort store {0} already exists".format(path))
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, LAYOUT_FILE),
+                 chromosomes=layout.chromosomes, starts=layout.starts,
+                 ends=layout.ends)
+        open(os.path.join(path, MATRIX_FILE), "wb").close()
+        meta = {"version": FORMAT_VERSION, "dtype": np.dtype(dtype).str,
+                "n_bins": len(layout), "samples": []}
+        cls._write_meta(path, meta)
+        return cls(path)
+
+    @staticmethod
+    def _write_meta(path, meta):
+        tmp = os.path.join(path, META_FILE + ".tmp")
+        with open(tmp, "w") as handle:
+            json.dump(meta, handle)
+        os.replace(tmp, os.path.join(path, META_FILE))
+
+    @property
+    def samples(self):
+        return list(self.meta["samples"])
+
+    @property
+    def n_bins(self):
+        return self.meta["n_bins"]
+
+    def __len__(self):
+        return len(self.meta["samples"])
+
+    def matrix(self, mode="r"):
+        """
+        Memory-map the samples x bins matrix
+        :param mode: numpy.memmap mode
+        :return: numpy.memmap of shape (samples, bins)
+        """
+        shape = (len(self), self.n_bins)
+        if shape[0] == 0:
+            return np.empty(shape, dtype=self.dtype)
+        return np.memmap(os.path.join(self.path, MATRIX_FILE),
+                         dtype=self.dtype, mode=mode, shape=shape)
+
+    def check_layout(self, track):
+        """
+        Raise a ValueError if a track does not share the bin layout
+        :param track: BedTrack
+        """
+        if not (len(track) == len(self.layout) and
+                np.array_equal(track.starts, self.layout.starts) and
+                np.array_equal(track.ends, self.layout.ends) and
+                np.array_equal(track.chromosomes, self.layout.chromosomes)):
+            raise ValueError("Track does not match the bin layout "
+                             "of cohort {0}".format(self.path))
+
+    def append(self, name, track):
+        """
+        Append a sample to the store
+        :param name: unique sample name
+        :param track: BedTrack with the same layout as the store
+        """
+        if name in self.meta["samples"]:
+            raise ValueError("Sample {0} already present in "
+                             "cohort".format(name))
+        self.check_layout(track)
+        row = np.ascontiguousarray(track.values, dtype=self.dtype)
+        with open(os.path.join(self.path, MATRIX_FILE), "r+b") as handle:
+            # drop any partial row left behind by an interrupted append
+            handle.truncate(len(self) * self.n_bins * self.dtype.itemsize)
+            handle.seek(0, os.SEEK_END)
+            handle.write(row.tobytes())
+        self.meta["samples"].append(name)
+        self._write_meta(self.path, self.meta)
+
+
+def cohort_build(input_paths, output_path, names=None, append=False):
+    """
+    Pack gc-corrected BED files into a cohort store
+    :param input_paths: paths to gc-corrected BED files
+    :param output_path: path to cohort store directory
+    :param names: optional sample names, one per input.
+        Defaults to file names without extensions
+    :param append: append to an existing store
+    :return: CohortStore
+    """
+    input_paths = list(input_paths)
+    if names is None or len(names) == 0:
+        names = [sample_name(x) for x in input_paths]
+    if len(names) != len(input_paths):
+        raise ValueError("Number of sample names does not match "
+                         "number of inputs")
+    if list(input_paths).count(STDIO) > 1:
+        raise ValueError("Only one input can be read from stdin")
+    store = None
+    if is_cohort(output_path):
+        if not append:
+            raise ValueError("Cohort store {0} already exists; "
+                             "use append to add samples".format(output_path))
+        store = CohortStore(output_path)
+    for path, name in zip(input_paths, names):
+        track = read_bed(path)
+        if store is None:
+            store = CohortStore.create(output_path, track,
+                                       dtype=precision.value_dtype())
+        store.append(name, track)
+    return store
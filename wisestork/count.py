@@ -20,9 +20,24 @@ wisestork.count
 :copyright: (c) 2016-2019 Sander Bollen
 :license: GPL-3.0
 """
+import os
+
+import numpy as np
 import pysam
 
-from .utils import get_bins, BedReader, BedLine
+from . import kernels, precision
+from .cache import (DEFAULT_CACHE_SIZE, cached_path, content_hash,
+                    fingerprint, open_cache)
+from .checkpoint import Checkpoint, file_identity
+from .qc import ReadMetrics, write_metrics
+from .subsample import ReadSampler
+from .utils import (STDIO, BedTrack, SparseTrack, bin_track, format_layout,
+                    get_bins, layout_fingerprint, read_bed, open_output,
+                    utf8, write_bed, write_track)
+
+READ_BLOCK_SIZE = 1 << 20
+READ_GROUP_TAG = "RG"
+GROUP_PLACEHOLDER = "{group}"
 
 
 def reads_per_bin(bam_reader, chromosome, bin):
@@ -59,27 +74,533 @@ def get_chromosomes_from_fasta(fa):
     return [(x, len(fa[x])) for x in fa.keys()]
 
 
-def count(input, output, binsize, reference, binfile=None):
+def count_overlaps(read_starts, read_ends, starts, ends):
+    """
+    Number of reads overlapping each region.
+    A read [rs, re) overlaps a region [s, e) when rs < e and re > s.
+    Reads ending at or before s are a subset of the reads starting
+    before e, so the count is a difference of two sorted searches.
+    This holds for unsorted and overlapping regions alike.
+    :param read_starts: array of 0-based read start positions
+    :param read_ends: array of exclusive read end positions
+    :param starts: array of region start positions
+    :param ends: array of region end positions
+    :return: int64 array of counts per region
+    """
+    return kernels.count_overlaps(read_starts, read_ends, starts, ends)
+
+
+def iter_read_blocks(reads, block_size=READ_BLOCK_SIZE):
+    """
+    Group aligned reads into blocks of positions.
+    A block never spans more than one reference sequence.
+    Reads without a position are skipped; reads without an alignment
+    end (placed unmapped reads) are given a length of 1
+    :param reads: iterable of pysam.AlignedSegment
+    :param block_size: maximum number of reads per block
+    :return: generator of (reference_id, starts, ends) tuples
+    """
+    current = -1
+    starts = []
+    ends = []
+    for read in reads:
+        rid = read.reference_id
+        if rid < 0:
+            continue
+        if rid != current or len(starts) == block_size:
+            if starts:
+                yield current, np.array(starts, np.int64), np.array(ends,
+                                                                    np.int64)
+            current = rid
+            starts = []
+            ends = []
+        start = read.reference_start
+        end = read.reference_end
+        starts.append(start)
+        ends.append(end if end is not None else start + 1)
+    if starts:
+        yield current, np.array(starts, np.int64), np.array(ends, np.int64)
+
+
+def iter_tagged_blocks(reads, tag, codes, block_size=READ_BLOCK_SIZE):
+    """
+    Group aligned reads into blocks of positions, with the group
+    of every read taken from one of its tags.
+    Reads without the tag are skipped, otherwise the same as
+    iter_read_blocks
+    :param reads: iterable of pysam.AlignedSegment
+    :param tag: two-letter tag, e.g. RG
+    :param codes: dict of tag value: group code. New values are added
+    :param block_size: maximum number of reads per block
+    :return: generator of (reference_id, starts, ends, group codes)
+    """
+    current = -1
+    starts = []
+    ends = []
+    groups = []
+    for read in reads:
+        rid = read.reference_id
+        if rid < 0 or not read.has_tag(tag):
+            continue
+        if rid != current or len(starts) == block_size:
+            if starts:
+                yield (current, np.array(starts, np.int64),
+                       np.array(ends, np.int64), np.array(groups, np.int64))
+            current = rid
+            starts = []
+            ends = []
+            groups = []
+        start = read.reference_start
+        end = read.reference_end
+        starts.append(start)
+        ends.append(end if end is not None else start + 1)
+        groups.append(codes.setdefault(str(read.get_tag(tag)), len(codes)))
+    if starts:
+        yield (current, np.array(starts, np.int64), np.array(ends, np.int64),
+               np.array(groups, np.int64))
+
+
+def count_groups(samfile, layouts, tag=READ_GROUP_TAG):
+    """
+    Count reads per region for every group of reads, in a single
+    sequential pass. The input must be sorted by coordinate.
+    With the RG tag, all read groups in the header get a track,
+    including those without reads.
+    :param samfile: an instance of pysam.AlignmentFile
+    :param layouts: list of BedTrack, regions per reference sequence
+        in header order
+    :param tag: tag whose value defines the group of a read
+    :return: dict of group: list of count arrays, one per layout
+    """
+    codes = {}
+    if tag == READ_GROUP_TAG:
+        for group in samfile.header.to_dict().get("RG", []):
+            codes.setdefault(str(group["ID"]), len(codes))
+    counts = []
+    last = 0
+    for rid, starts, ends, groups in iter_tagged_blocks(
+            samfile.fetch(until_eof=True), tag, codes):
+        if rid < last:
+            raise ValueError("Input BAM must be sorted by coordinate")
+        last = rid
+        while len(counts) < len(codes):
+            counts.append([np.zeros(len(x), np.int64) for x in layouts])
+        order = np.argsort(groups, kind="mergesort")
+        bounds = np.searchsorted(groups[order], np.arange(len(codes) + 1))
+        for code in np.flatnonzero(np.diff(bounds)):
+            sel = order[bounds[code]:bounds[code + 1]]
+            counts[code][rid] += count_overlaps(starts[sel], ends[sel],
+                                                layouts[rid].starts,
+                                                layouts[rid].ends)
+    while len(counts) < len(codes):
+        counts.append([np.zeros(len(x), np.int64) for x in layouts])
+    return {group: counts[code] for group, code in codes.items()}
+
+
+def group_tracks(samfile, binsize, binfile=None, tag=READ_GROUP_TAG):
+    """
+    Count reads per bin for every group of reads in one pass
+    :param samfile: an instance of pysam.AlignmentFile
+    :param binsize: binsize
+    :param binfile: optional path to region BED file, or BedTrack
+        of regions
+    :param tag: tag whose value defines the group of a read
+    :return: dict of group: BedTrack with counts
+    """
+    chromosomes = get_chromosomes_from_header(samfile.header)
+    if binfile is None:
+        layouts = [bin_track(ch, ln, binsize) for ch, ln in chromosomes]
+        tracks = {}
+        for group, counts in count_groups(samfile, layouts, tag).items():
+            tracks[group] = BedTrack.concatenate(
+                x.with_values(precision.as_counts(c))
+                for x, c in zip(layouts, counts))
+        return tracks
+    bins = binfile if isinstance(binfile, BedTrack) else read_bed(binfile)
+    idxs = [np.flatnonzero(bins.chromosomes == utf8(ch))
+            for ch, _ in chromosomes]
+    tracks = {}
+    for group, counts in count_groups(samfile, [bins[x] for x in idxs],
+                                      tag).items():
+        values = np.zeros(len(bins), np.int64)
+        for idx, c in zip(idxs, counts):
+            values[idx] = c
+        tracks[group] = bins.with_values(precision.as_counts(values))
+    return tracks
+
+
+def group_path(template, group):
+    """
+    Output path of a group of reads
+    :param template: path containing {group}
+    :param group: group name. Path separators are replaced
+    :return: path
+    """
+    return template.replace(GROUP_PLACEHOLDER,
+                            group.replace(os.sep, "_"))
+
+
+def count_stream(samfile, layouts, metrics=None, sampler=None):
+    """
+    Count reads per region in a single sequential pass.
+    This does not require an index, so it works on streamed input,
+    but the input must be sorted by coordinate.
+    :param samfile: an instance of pysam.AlignmentFile
+    :param layouts: list of BedTrack, regions per reference sequence
+        in header order
+    :param metrics: optional ReadMetrics, which observes every read
+        of the pass, including unmapped reads at the end of the file
+    :param sampler: optional ReadSampler. Only its subsample of reads
+        is counted, and the counts are scaled back to full depth
+    :return: generator of BedTrack with counts, one per reference sequence,
+        yielded as soon as that reference sequence is complete
+    """
+    counts = [np.zeros(len(x), np.int64) for x in layouts]
+    done = 0
+    reads = samfile.fetch(until_eof=True)
+    if metrics is not None:
+        reads = metrics.observe(reads)
+    if sampler is not None:
+        reads = sampler.filter(reads)
+
+    def result(rid):
+        track = layouts[rid].with_values(counts[rid])
+        if sampler is not None:
+            track = sampler.scale(track, rid)
+        return track.with_values(precision.as_counts(track.values))
+
+    for rid, starts, ends in iter_read_blocks(reads):
+        if rid < done:
+            raise ValueError("Input BAM must be sorted by coordinate")
+        while done < rid:
+            yield result(done)
+            done += 1
+        counts[rid] += count_overlaps(starts, ends, layouts[rid].starts,
+                                      layouts[rid].ends)
+    while done < len(layouts):
+        yield result(done)
+        done += 1
+
+
+def count_regions(samfile, chromosome, starts, ends):
+    """
+    Count reads per region of one chromosome in one sequential pass.
+    Only the span covered by the regions is fetched, once, and every
+    block of reads is assigned to all regions it overlaps, so regions
+    may be unsorted and overlapping.
+    :param samfile: an instance of pysam.AlignmentFile
+    :param chromosome: chromosome name
+    :param starts: array of region start positions
+    :param ends: array of region end positions
+    :return: int64 array of counts per region
+    """
+    counts = np.zeros(len(starts), np.int64)
+    if len(starts) == 0:
+        return counts
+    reads = samfile.fetch(chromosome, int(starts.min()), int(ends.max()))
+    for _, read_starts, read_ends in iter_read_blocks(reads):
+        counts += count_overlaps(read_starts, read_ends, starts, ends)
+    return counts
+
+
+def sample_regions(samfile, chromosome, starts, ends, windows):
+    """
+    Estimate the reads per region of one chromosome from part of its
+    reads. Only the windows of every region are fetched (see
+    ReadSampler.region_windows), and the reads starting in them
+    estimate the reads starting in the region. The reads reaching into
+    the region from before its start are added from that density and
+    the mean aligned length of the sampled reads
+    :param samfile: an instance of pysam.AlignmentFile with an index
+    :param chromosome: chromosome name
+    :param starts: array of region start positions
+    :param ends: array of region end positions
+    :param windows: 3-tuple of (window starts, window ends, window
+        weights), with a row of windows per region
+    :return: int64 array of estimated counts per region
+    """
+    counts = np.zeros(len(starts), np.int64)
+    for i, (start, end, win_starts, win_ends, weights) in enumerate(zip(
+            starts.tolist(), ends.tolist(), windows[0].tolist(),
+            windows[1].tolist(), windows[2].tolist())):
+        within = 0.0
+        n = length = 0
+        for win_start, win_end, weight in zip(win_starts, win_ends, weights):
+            if win_end <= win_start:
+                continue
+            k = 0
+            for read in samfile.fetch(chromosome, win_start, win_end):
+                read_start = read.reference_start
+                if read_start >= win_start:
+                    k += 1
+                    length += (read.reference_end or
+                               read_start + 1) - read_start
+            within += weight * k
+            n += k
+        if n > 0:
+            within *= 1 + (length / n - 1) / (end - start)
+        counts[i] = int(round(within))
+    return counts
+
+
+def count_bins(samfile, bins, sampler=None):
+    """
+    Count reads for arbitrary regions, grouped by chromosome
+    :param samfile: an instance of pysam.AlignmentFile
+    :param bins: BedTrack of regions
+    :param sampler: optional indexed ReadSampler. Counts are then
+        estimated from a subsample (see sample_regions)
+    :return: int64 array of counts, in region order.
+        Regions on chromosomes not in the BAM header get 0
+    """
+    counts = np.zeros(len(bins), np.int64)
+    known = {utf8(ch): (rid, ln) for rid, (ch, ln) in enumerate(
+        get_chromosomes_from_header(samfile.header))}
+    names, inverse = np.unique(bins.chromosomes, return_inverse=True)
+    order = np.argsort(inverse, kind="mergesort")
+    groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+    for name, idx in zip(names, groups):
+        if bytes(name) not in known:
+            continue
+        chromosome = bytes(name).decode()
+        starts, ends = bins.starts[idx], bins.ends[idx]
+        windows = None
+        if sampler is not None:
+            windows = sampler.region_windows(known[bytes(name)][0], starts,
+                                             ends)
+        if windows is None:
+            counts[idx] = count_regions(samfile, chromosome, starts, ends)
+        else:
+            counts[idx] = sample_regions(samfile, chromosome, starts, ends,
+                                         windows)
+    return counts
+
+
+def iter_counts(samfile, binsize, binfile=None, streaming=False, skip=(),
+                metrics=None, sampler=None):
+    """
+    Count reads per bin
+    :param samfile: an instance of pysam.AlignmentFile
+    :param binsize: binsize
+    :param binfile: optional path to region BED file, or BedTrack
+        of regions
+    :param streaming: read the alignments in one sequential pass
+        instead of using the index
+    :param skip: names of chromosomes not to count. Only used when
+        counting with the index and without a binfile
+    :param metrics: optional ReadMetrics to accumulate. The reads are
+        then always counted in one sequential pass
+    :param sampler: optional ReadSampler, to count a subsample of the
+        reads. With an index, the counts of every bin are estimated
+        from windows spread over it; otherwise the reads are sampled
+        by name in one sequential pass
+    :return: generator of BedTrack with counts. One per chromosome,
+        or a single track in region order when a binfile is given
+    """
+    chromosomes = get_chromosomes_from_header(samfile.header)
+    streaming = (streaming or metrics is not None or
+                 (sampler is not None and not sampler.indexed))
+    if binfile is not None:
+        bins = binfile if isinstance(binfile, BedTrack) else read_bed(binfile)
+        if streaming:
+            names = [utf8(ch) for ch, _ in chromosomes]
+            idxs = [np.flatnonzero(bins.chromosomes == x) for x in names]
+            counts = np.zeros(len(bins), np.int64)
+            for idx, track in zip(idxs, count_stream(
+                    samfile, [bins[x] for x in idxs], metrics, sampler)):
+                counts[idx] = track.values
+        else:
+            counts = count_bins(samfile, bins, sampler)
+        yield bins.with_values(precision.as_counts(counts))
+    elif streaming:
+        layouts = [bin_track(ch, ln, binsize) for ch, ln in chromosomes]
+        for track in count_stream(samfile, layouts, metrics, sampler):
+            yield track
+    else:
+        for rid, (ch, ln) in enumerate(chromosomes):
+            if ch in skip:
+                continue
+            track = bin_track(ch, ln, binsize)
+            windows = None
+            if sampler is not None:
+                windows = sampler.region_windows(rid, track.starts,
+                                                 track.ends)
+            if windows is None:
+                counts = [reads_per_bin(samfile, ch, bin) for bin in
+                          get_bins(ln, binsize)]
+            else:
+                counts = sample_regions(samfile, ch, track.starts,
+                                        track.ends, windows)
+            yield track.with_values(precision.as_counts(counts))
+
+
+def count_layout(samfile, binsize, binfile=None):
+    """
+    Bins of the counts of a BAM file, in output order
+    :param samfile: an instance of pysam.AlignmentFile
+    :param binsize: binsize
+    :param binfile: optional path to region BED file, or BedTrack
+        of regions
+    :return: BedTrack with NaN values
+    """
+    if binfile is not None:
+        bins = binfile if isinstance(binfile, BedTrack) else read_bed(binfile)
+        return bins.with_values(None)
+    return BedTrack.concatenate(
+        bin_track(ch, ln, binsize)
+        for ch, ln in get_chromosomes_from_header(samfile.header))
+
+
+def count_track(input, binsize, binfile=None):
+    """
+    Count reads per bin into a single track
+    :param input: path to input BAM, '-' for a BAM stream on stdin,
+        or an instance of pysam.AlignmentFile
+    :param binsize: binsize
+    :param binfile: optional path to region BED file, or BedTrack
+        of regions
+    :return: BedTrack with counts
+    """
+    if isinstance(input, pysam.AlignmentFile):
+        samfile = input
+    else:
+        samfile = pysam.AlignmentFile(input, 'rb')
+    return BedTrack.concatenate(iter_counts(samfile, binsize, binfile,
+                                            streaming=input == STDIO))
+
+
+def write_counts(samfile, output, binsize, binfile=None, streaming=False,
+                 resume=False, metrics=None, sampler=None, sparse=False):
+    """
+    Count reads per bin and write them to a BED file, which starts
+    with the fingerprint of its bin layout.
+    When counting from an indexed BAM file to an output file, a
+    checkpoint is recorded after every chromosome
+    :param samfile: an instance of pysam.AlignmentFile
+    :param output: path to output BED, or '-' for stdout
+    :param binsize: binsize
+    :param binfile: optional path to region BED file
+    :param streaming: read the alignments in one sequential pass
+    :param resume: continue from the checkpoint of an interrupted run
+    :param metrics: optional ReadMetrics to accumulate during counting
+    :param sampler: optional ReadSampler, to count a subsample of reads
+    :param sparse: write a sparse BED file, without the bins
+        without reads
+    """
+    sequential = metrics is not None or sampler is not None
+    if streaming or output == STDIO or binfile or sequential or sparse:
+        if resume:
+            raise ValueError("Resuming requires an input and output file, "
+                             "no bin file, no metrics, no subsampling and "
+                             "dense output")
+        if binfile:
+            binfile = read_bed(binfile)
+        tracks = iter_counts(samfile, binsize, binfile or None,
+                             streaming=streaming, metrics=metrics,
+                             sampler=sampler)
+        with open_output(output) as ohandle:
+            if sparse:
+                # the layout of all bins goes before the first record
+                tracks = [BedTrack.concatenate(tracks)]
+            else:
+                ohandle.write(format_layout(layout_fingerprint(
+                    count_layout(samfile, binsize, binfile or None))))
+            for track in tracks:
+                if metrics is not None:
+                    metrics.add_counts(track)
+                if sparse:
+                    track = SparseTrack.from_dense(track)
+                write_track(ohandle, track, layout=sparse)
+        return
+    input = samfile.filename.decode()
+    checkpoint = Checkpoint(output, {"command": "count",
+                                     "input": file_identity(input),
+                                     "binsize": binsize})
+    with checkpoint.open(resume) as ohandle:
+        if checkpoint.progress is None:
+            ohandle.write(format_layout(layout_fingerprint(
+                count_layout(samfile, binsize))))
+        done = list(checkpoint.progress or [])
+        names = [ch for ch, _ in get_chromosomes_from_header(samfile.header)
+                 if ch not in done]
+        for name, track in zip(names, iter_counts(samfile, binsize,
+                                                  skip=set(done))):
+            write_bed(ohandle, track)
+            done.append(name)
+            checkpoint.update(ohandle, done)
+
+
+def count(input, output, binsize, reference, binfile=None, resume=False,
+          group_tag=None, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+          metrics_output=None, fraction=None, max_reads=None, seed=0,
+          sparse=False):
     """
     Main function for counting reads per bin
-    :param input: Path to input BAM
-    :param output: path to output BED
+    :param input: Path to input BAM, or '-' for a BAM stream on stdin
+    :param output: path to output BED, or '-' for stdout
     :param binsize: binsize
     :param reference: path to reference fasta
+    :param resume: continue from the checkpoint of an interrupted run
+    :param group_tag: optional tag, e.g. RG. Reads are then counted per
+        value of this tag in a single pass. The output path must contain
+        {group}, which is replaced by the value of each group
+    :param cache_dir: optional path to a result cache directory
+    :param cache_size: maximum size of the result cache in bytes
+    :param metrics_output: optional path to a QC metrics file, written
+        from the same pass over the reads as the counts. Paths ending
+        in .json get JSON, other paths TSV. The result cache is not
+        used when writing metrics
+    :param fraction: optional fraction of reads to count. With an
+        index, every bin is estimated from windows spread over it (see
+        sample_regions). Otherwise reads are sampled by a hash of their
+        name, and counts are scaled back to full depth
+    :param max_reads: optional approximate number of reads to count
+        per chromosome. Requires an indexed BAM file
+    :param seed: seed of the subsample: of the name hash without an
+        index, and of the sampled windows with one
+    :param sparse: write sparse BED files, which only hold the bins
+        with reads
     """
     # TODO: check whether chromosome names in reference match those in bam file
     samfile = pysam.AlignmentFile(input, 'rb')
-    chromosomes = get_chromosomes_from_header(samfile.header)
-    with open(output, "wb") as ohandle:
-        if binfile:
-            bin_reader = BedReader(binfile)
-            for bin in bin_reader:
-                val = reads_per_bin(samfile, bin.chromosome, bin)
-                bed = BedLine(bin.chromosome, bin.start, bin.end, val)
-                ohandle.write(bytes(bed) + b"\n")
-        else:
-            for ch, ln in chromosomes:
-                for bin in get_bins(ln, binsize):
-                    val = reads_per_bin(samfile, ch, bin)
-                    bed = BedLine(ch, bin.start, bin.end, val)
-                    ohandle.write(bytes(bed) + b"\n")
+    streaming = input == STDIO
+    if group_tag is not None:
+        if GROUP_PLACEHOLDER not in output:
+            raise ValueError("Output path must contain {0} when counting "
+                             "per group".format(GROUP_PLACEHOLDER))
+        if resume:
+            raise ValueError("Can not resume counting per group")
+        if metrics_output is not None:
+            raise ValueError("Can not write metrics when counting per group")
+        if fraction is not None or max_reads is not None:
+            raise ValueError("Can not subsample when counting per group")
+        tracks = group_tracks(samfile, binsize, binfile or None, group_tag)
+        for group in sorted(tracks):
+            track = tracks[group]
+            if sparse:
+                track = SparseTrack.from_dense(track)
+            with open_output(group_path(output, group)) as ohandle:
+                write_track(ohandle, track, layout=True)
+        return
+    sampler = None
+    if fraction is not None or max_reads is not None:
+        sampler = ReadSampler.from_bam(samfile, fraction, max_reads, seed)
+    if metrics_output is not None:
+        metrics = ReadMetrics(
+            [ch for ch, _ in get_chromosomes_from_header(samfile.header)])
+        write_counts(samfile, output, binsize, binfile, streaming, resume,
+                     metrics, sampler, sparse)
+        write_metrics(metrics_output, metrics)
+        return
+    cache = open_cache(cache_dir, cache_size, input)
+    params = None
+    if cache is not None:
+        params = {"input": fingerprint(input), "binsize": binsize,
+                  "binfile": content_hash(binfile) if binfile else None,
+                  "fraction": fraction, "max_reads": max_reads,
+                  "seed": seed, "sparse": sparse,
+                  "precision": precision.precision()}
+    with cached_path(output, cache, "count", params) as target:
+        if target is not None:
+            write_counts(samfile, target, binsize, binfile, streaming,
+                         resume, sampler=sampler, sparse=sparse)
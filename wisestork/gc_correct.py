@@ -26,7 +26,12 @@ import warnings
 import statsmodels.nonparametric.smoothers_lowess as statlow
 from pyfaidx import Fasta
 
-from .utils import BedLine, attempt_numeric
+from . import precision
+from .cache import (DEFAULT_CACHE_SIZE, cached_path, content_hash,
+                    fingerprint, open_cache)
+from .utils import (STDIO, BedTrack, SparseTrack, as_str, is_sparse_file,
+                    iter_bed_chunks, layout_fingerprint, open_output,
+                    read_track, write_track)
 from .gc import get_gc_for_bin, get_n_per_bin
 
 
@@ -49,23 +54,116 @@ def correct(inputs, fasta, frac_n=0.1, frac_r=0.0001, lowess_iter=3,
     GC-correct input bed lines.
     GC correction takes place with a local regression (LOWESS) on GC perc vs
     number of reads
-    :param inputs: list of BedLine namedtuples
+    :param inputs: BedTrack or list of BedLine namedtuples
     :param fasta: instance of pyfaidx.Fasta
     :param frac_n: maximal fraction on N-bases per bin
     :param frac_r: minimum fraction of reads per bin
     :param lowess_iter: amount of iterations of LOWESS function
     :param lowess_frac: fraction of input data used for LOWESS function
-    :return: corrected BedLines
+    :return: corrected BedTrack
     """
-    reads = []
+    if not isinstance(inputs, BedTrack):
+        inputs = BedTrack.from_bedlines(inputs)
+    mask, gcs = gc_filter(inputs, fasta, frac_n, frac_r)
+    return lowess_correct(inputs, mask, gcs, lowess_iter, lowess_frac)
+
+
+def gc_filter(inputs, fasta, frac_n=0.1, frac_r=0.0001):
+    """
+    Select the bins to correct, and get their GC content
+    :param inputs: BedTrack
+    :param fasta: instance of pyfaidx.Fasta
+    :param frac_n: maximal fraction on N-bases per bin
+    :param frac_r: minimum fraction of reads per bin
+    :return: 2-tuple of (boolean mask of selected bins,
+        array of GC content of the selected bins)
+    """
+    mask = np.zeros(len(inputs), dtype=bool)
     gcs = []
-    for line in inputs:
+    for i, line in enumerate(inputs):
+        line = line._replace(chromosome=as_str(line.chromosome))
         if filter_bin(line, fasta, frac_n, frac_r):
+            mask[i] = True
             gcs.append(get_gc_for_bin(fasta, line.chromosome, line))
-            reads.append(line.value)
+    return mask, np.array(gcs, np.float64)
+
+
+class GCTable(object):
+    """
+    N and GC content of every bin of a layout.
+    Looked up once, so that it can be shared by all samples with
+    the same bins instead of reading the reference for every sample.
+    """
+
+    def __init__(self, layout, ns, gcs):
+        """
+        Create instance of GCTable
+        :param layout: BedTrack of bins
+        :param ns: array of number of N bases per bin
+        :param gcs: array of number of GC bases per bin
+        """
+        self.layout = layout
+        self.ns = ns
+        self.gcs = gcs
+        self.fingerprint = layout_fingerprint(layout)
+
+    @classmethod
+    def from_fasta(cls, layout, fasta):
+        """
+        Look up the N and GC content of a layout
+        :param layout: BedTrack of bins
+        :param fasta: instance of pyfaidx.Fasta
+        :return: GCTable
+        """
+        ns = np.zeros(len(layout), np.int64)
+        gcs = np.zeros(len(layout), np.int64)
+        for i, line in enumerate(layout):
+            chromosome = as_str(line.chromosome)
+            ns[i] = get_n_per_bin(fasta, chromosome, line)
+            gcs[i] = get_gc_for_bin(fasta, chromosome, line)
+        return cls(layout.with_values(None), ns, gcs)
 
-    reads = np.array(reads, np.float)
-    gcs = np.array(gcs, np.float)
+    @property
+    def nbytes(self):
+        return (self.layout.chromosomes.nbytes + self.layout.starts.nbytes +
+                self.layout.ends.nbytes + self.ns.nbytes + self.gcs.nbytes)
+
+    def matches(self, track):
+        """
+        Whether a track has the bins of this table, in the same order
+        :param track: BedTrack
+        :return: Boolean
+        """
+        return layout_fingerprint(track) == self.fingerprint
+
+    def select(self, track, frac_n=0.1, frac_r=0.0001):
+        """
+        Same as gc_filter, with the GC content taken from the table
+        :param track: BedTrack with the bins of this table
+        :param frac_n: maximal fraction on N-bases per bin
+        :param frac_r: minimum fraction of reads per bin
+        :return: 2-tuple of (boolean mask of selected bins,
+            array of GC content of the selected bins)
+        """
+        if not self.matches(track):
+            raise ValueError("Track does not match the bins of the GC table")
+        sizes = track.ends - track.starts
+        mask = (self.ns < sizes * frac_n) & (track.values > sizes * frac_r)
+        return mask, self.gcs[mask].astype(np.float64)
+
+
+def lowess_correct(inputs, mask, gcs, lowess_iter=3, lowess_frac=0.1):
+    """
+    Divide the selected bins by a LOWESS fit of reads on GC content.
+    Other bins are set to 0
+    :param inputs: BedTrack
+    :param mask: boolean mask of selected bins (see gc_filter)
+    :param gcs: GC content of the selected bins
+    :param lowess_iter: amount of iterations of LOWESS function
+    :param lowess_frac: fraction of input data used for LOWESS function
+    :return: corrected BedTrack
+    """
+    reads = inputs.values[mask].astype(np.float64)
     if lowess_frac*len(reads) < 4 and len(reads) > 0:
         # need at least four data ponts
         warnings.warn("Too few data points for lowess. Raising lowess_frac")
@@ -75,27 +173,106 @@ def correct(inputs, fasta, frac_n=0.1, frac_r=0.0001, lowess_iter=3,
         delta = 0.01 * len(gcs)
     lowess = statlow.lowess(reads, gcs, return_sorted=False,
                             delta=delta, frac=lowess_frac,
-                            it=lowess_iter).tolist()
+                            it=lowess_iter)
 
-    corrected_lines = []
+    corrected = np.zeros(len(inputs), dtype=precision.value_dtype())
+    corrected[mask] = reads / lowess
+    return inputs.with_values(corrected)
 
-    for line in inputs:
-        if filter_bin(line, fasta, frac_n, frac_r):
-            corr_val = float(line.value) / lowess.pop(0)
-        else:
-            corr_val = 0
-        n_bed = BedLine(line.chromosome, line.start, line.end, corr_val)
-        corrected_lines.append(n_bed)
 
-    return corrected_lines
+def correct_chunks(chunks, fasta, frac_n=0.1, frac_r=0.0001, lowess_iter=3,
+                   lowess_frac=0.1):
+    """
+    GC-correct a track that is read in chunks.
+    The GC content of every chunk is looked up while the next chunks
+    are read ahead (see utils.prefetch). Same result as correct
+    :param chunks: iterable of BedTrack
+    :param fasta: instance of pyfaidx.Fasta
+    :param frac_n: maximal fraction on N-bases per bin
+    :param frac_r: minimum fraction of reads per bin
+    :param lowess_iter: amount of iterations of LOWESS function
+    :param lowess_frac: fraction of input data used for LOWESS function
+    :return: corrected BedTrack
+    """
+    tracks, masks, gcs = [], [], []
+    for chunk in chunks:
+        mask, gc = gc_filter(chunk, fasta, frac_n, frac_r)
+        tracks.append(chunk)
+        masks.append(mask)
+        gcs.append(gc)
+    if len(tracks) == 0:
+        return correct(BedTrack([], [], []), fasta, frac_n, frac_r,
+                       lowess_iter, lowess_frac)
+    return lowess_correct(BedTrack.concatenate(tracks), np.concatenate(masks),
+                          np.concatenate(gcs), lowess_iter, lowess_frac)
+
+
+def correct_table(track, table, frac_n=0.1, frac_r=0.0001, lowess_iter=3,
+                  lowess_frac=0.1):
+    """
+    GC-correct a track with the GC content from a GCTable.
+    Same result as correct with the fasta the table was made from
+    :param track: BedTrack with the bins of the table
+    :param table: GCTable
+    :param frac_n: maximal fraction on N-bases per bin
+    :param frac_r: minimum fraction of reads per bin
+    :param lowess_iter: amount of iterations of LOWESS function
+    :param lowess_frac: fraction of input data used for LOWESS function
+    :return: corrected BedTrack
+    """
+    mask, gcs = table.select(track, frac_n, frac_r)
+    return lowess_correct(track, mask, gcs, lowess_iter, lowess_frac)
+
+
+def correct_sparse(track, fasta, frac_n=0.1, frac_r=0.0001, lowess_iter=3,
+                   lowess_frac=0.1):
+    """
+    GC-correct a sparse track of counts.
+    Bins without reads never pass the read filter and are corrected
+    to 0, so only the stored bins are corrected. This gives the same
+    values as correcting the dense track
+    :param track: SparseTrack with a fill value of 0
+    :param fasta: instance of pyfaidx.Fasta
+    :param frac_n: maximal fraction on N-bases per bin
+    :param frac_r: minimum fraction of reads per bin
+    :param lowess_iter: amount of iterations of LOWESS function
+    :param lowess_frac: fraction of input data used for LOWESS function
+    :return: corrected SparseTrack
+    """
+    if track.fill != 0:
+        raise ValueError("Sparse tracks must have a fill value of 0")
+    corrected = correct(track.stored(), fasta, frac_n, frac_r, lowess_iter,
+                        lowess_frac).values
+    keep = corrected != 0
+    return track.with_values(corrected[keep], track.indices[keep])
 
 
-def gc_correct(input, output, reference, frac_n, frac_r, iter, frac_lowess):
-    fasta = Fasta(reference)
-    bed_lines = [BedLine(*map(attempt_numeric, x.split("\t"))) for
-                 x in open(input)]
-    corrected = correct(bed_lines, fasta, frac_n, frac_r, iter, frac_lowess)
+def gc_correct(input, output, reference, frac_n, frac_r, iter, frac_lowess,
+               cache_dir=None, cache_size=DEFAULT_CACHE_SIZE):
+    cache = open_cache(cache_dir, cache_size, input)
+    params = None
+    if cache is not None:
+        params = {"input": content_hash(input),
+                  "reference": fingerprint(reference), "frac_n": frac_n,
+                  "frac_r": frac_r, "iter": iter, "frac_lowess": frac_lowess,
+                  "precision": precision.precision()}
+    with cached_path(output, cache, "gc-correct", params) as target:
+        if target is None:
+            return
+        fasta = Fasta(reference)
+        if input == STDIO or is_sparse_file(input):
+            track = read_track(input)
+        else:
+            track = iter_bed_chunks(input)
+        if isinstance(track, SparseTrack):
+            corrected = correct_sparse(track, fasta, frac_n, frac_r, iter,
+                                       frac_lowess)
+        elif isinstance(track, BedTrack):
+            corrected = correct(track, fasta, frac_n, frac_r, iter,
+                                frac_lowess)
+        else:
+            corrected = correct_chunks(track, fasta, frac_n, frac_r, iter,
+                                       frac_lowess)
 
-    with open(output, "wb") as ohandle:
-        for line in corrected:
-            ohandle.write(bytes(str(line) + "\n", 'utf-8'))
+        with open_output(target) as ohandle:
+            write_track(ohandle, corrected, layout=True)
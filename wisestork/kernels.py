@@ -0,0 +1,313 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.kernels
+~~~~~~~~~~~~~~
+Compiled kernels for bin-level loops, with NumPy fallbacks.
+
+Numba is used when it is installed. The backend can be forced with
+use() or the WISESTORK_KERNELS environment variable, to 'numba',
+'numpy' or 'auto'. An invalid environment variable falls back to
+'auto' with a warning, so that importing never fails.
+
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import os
+import warnings
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+AUTO = "auto"
+NUMBA = "numba"
+NUMPY = "numpy"
+BACKENDS = (AUTO, NUMBA, NUMPY)
+BACKEND_ENV = "WISESTORK_KERNELS"
+MAD_SCALE = 1.4826
+
+_backend = NUMPY
+
+
+def available():
+    """
+    Whether compiled kernels can be used
+    :return: bool
+    """
+    return numba is not None
+
+
+def use(backend=AUTO):
+    """
+    Select the kernel backend
+    :param backend: 'auto' (numba when installed), 'numba' or 'numpy'
+    :raises ValueError: for an unknown backend, or numba when it is
+        not installed
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError("Unknown kernel backend: {0}".format(backend))
+    if backend == NUMBA and not available():
+        raise ValueError("Kernel backend numba requires numba "
+                         "to be installed")
+    if backend == AUTO:
+        backend = NUMBA if available() else NUMPY
+    _backend = backend
+
+
+def backend():
+    """
+    Name of the selected kernel backend
+    :return: 'numba' or 'numpy'
+    """
+    return _backend
+
+
+def compiled():
+    return _backend == NUMBA
+
+
+# NumPy kernels
+
+
+def count_overlaps_numpy(read_starts, read_ends, starts, ends):
+    read_starts = np.sort(read_starts)
+    read_ends = np.sort(read_ends)
+    return (np.searchsorted(read_starts, ends, "left") -
+            np.searchsorted(read_ends, starts, "right")).astype(np.int64)
+
+
+def filter_window_numpy(ids, values, target):
+    ids = ids[ids != target]
+    if len(ids) == 0:
+        return ids
+    values = values[ids]
+    stdev = np.std(values)
+    mean = np.mean(values)
+    keep = (mean+(3*stdev) > values) & (values > mean-(3*stdev))
+    return ids[keep]
+
+
+# Numba kernels. Defined only when numba is installed
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _count_overlaps_numba(read_starts, read_ends, starts, ends):
+        read_starts = np.sort(read_starts)
+        read_ends = np.sort(read_ends)
+        counts = np.empty(len(starts), np.int64)
+        for i in range(len(starts)):
+            counts[i] = (np.searchsorted(read_starts, ends[i]) -
+                         np.searchsorted(read_ends, starts[i], "right"))
+        return counts
+
+    @numba.njit(cache=True)
+    def _filter_window_numba(ids, values, target):
+        n = 0
+        total = 0.0
+        for i in ids:
+            if i != target:
+                total += values[i]
+                n += 1
+        out = np.empty(n, ids.dtype)
+        if n == 0:
+            return out
+        mean = total / n
+        sq = 0.0
+        for i in ids:
+            if i != target:
+                sq += (values[i] - mean) ** 2
+        stdev = np.sqrt(sq / n)
+        k = 0
+        for i in ids:
+            if i != target and \
+                    mean + 3 * stdev > values[i] > mean - 3 * stdev:
+                out[k] = i
+                k += 1
+        return out[:k]
+
+    @numba.njit(cache=True)
+    def _block_sum_numba(a, lo, n):
+        if n < 8:
+            res = 0.0
+            for i in range(lo, lo + n):
+                res += a[i]
+            return res
+        r = a[lo:lo+8].copy()
+        i = 8
+        while i < n - n % 8:
+            for j in range(8):
+                r[j] += a[lo+i+j]
+            i += 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + \
+            ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            res += a[lo+i]
+            i += 1
+        return res
+
+    @numba.njit(cache=True)
+    def _tree_sum_numba(a):
+        # blocks of up to 128 values in 8 partial sums, split in halves
+        # above that. Iterative, as numba can not cache recursion
+        los = np.empty(128, np.int64)
+        ns = np.empty(128, np.int64)
+        split = np.empty(128, np.bool_)
+        sums = np.empty(128, np.float64)
+        los[0], ns[0], split[0] = 0, len(a), False
+        top, n_sums = 1, 0
+        while top > 0:
+            top -= 1
+            lo, n = los[top], ns[top]
+            if split[top]:
+                n_sums -= 1
+                sums[n_sums-1] = sums[n_sums-1] + sums[n_sums]
+            elif n <= 128:
+                sums[n_sums] = _block_sum_numba(a, lo, n)
+                n_sums += 1
+            else:
+                n2 = n // 2
+                n2 -= n2 % 8
+                split[top] = True
+                los[top+1], ns[top+1], split[top+1] = lo + n2, n - n2, False
+                los[top+2], ns[top+2], split[top+2] = lo, n2, False
+                top += 3
+        return sums[0]
+
+    @numba.njit(cache=True)
+    def _pairwise_sum_numba(a, bufsize):
+        # numpy's add.reduce over a contiguous row: a pairwise sum per
+        # buffer of values, added up in order
+        res = _tree_sum_numba(a[:bufsize])
+        for start in range(bufsize, len(a), bufsize):
+            res += _tree_sum_numba(a[start:start+bufsize])
+        return res
+
+    @numba.njit(cache=True)
+    def _median_numba(vals):
+        s = np.sort(vals)
+        k = len(s)
+        return (s[(k - 1) // 2] + s[k // 2]) / 2
+
+    @numba.njit(cache=True)
+    def _z_scores_numba(matrix, neighbours, robust, bufsize):
+        n_samples, n = matrix.shape
+        width = neighbours.shape[1]
+        z = np.empty((n_samples, n), np.float64)
+        # padded rows as in ztest.z_scores: invalid entries are 0
+        row = np.empty(width, np.float64)
+        sq = np.empty(width, np.float64)
+        buf = np.empty(width, np.float64)
+        for s in range(n_samples):
+            for b in range(n):
+                k = 0
+                for j in range(width):
+                    idx = neighbours[b, j]
+                    if idx >= 0:
+                        row[j] = matrix[s, idx]
+                        buf[k] = row[j]
+                        k += 1
+                    else:
+                        row[j] = 0.0
+                if k == 0:
+                    z[s, b] = np.nan
+                    continue
+                if robust:
+                    location = _median_numba(buf[:k])
+                    scale = _median_numba(np.abs(buf[:k] - location)) * \
+                        MAD_SCALE
+                else:
+                    location = _pairwise_sum_numba(row, bufsize) / k
+                    for j in range(width):
+                        if neighbours[b, j] >= 0:
+                            dev = row[j] - location
+                            sq[j] = dev * dev
+                        else:
+                            sq[j] = 0.0
+                    scale = np.sqrt(_pairwise_sum_numba(sq, bufsize) / k)
+                if scale == 0:
+                    z[s, b] = np.nan
+                else:
+                    z[s, b] = (matrix[s, b] - location) / scale
+        return z
+
+
+def count_overlaps(read_starts, read_ends, starts, ends):
+    """
+    Number of reads overlapping each region (see count.count_overlaps)
+    :return: int64 array of counts per region
+    """
+    if compiled():
+        return _count_overlaps_numba(
+            np.ascontiguousarray(read_starts, np.int64),
+            np.ascontiguousarray(read_ends, np.int64),
+            np.ascontiguousarray(starts, np.int64),
+            np.ascontiguousarray(ends, np.int64))
+    return count_overlaps_numpy(read_starts, read_ends, starts, ends)
+
+
+def filter_window(ids, values, target):
+    """
+    Neighbours of a bin in a window, without the bin itself and
+    without outliers: values outside mean +/- 3 standard deviations
+    :param ids: array of bin ids in the window
+    :param values: array of values of all bins. Used in its own
+        dtype, as this is called for every bin
+    :param target: id of the bin
+    :return: filtered array of bin ids
+    """
+    if compiled():
+        return _filter_window_numba(np.asarray(ids), np.asarray(values),
+                                    target)
+    return filter_window_numpy(ids, values, target)
+
+
+def z_scores(matrix, neighbours, robust=False):
+    """
+    Compiled z-scores of a samples x bins matrix against a padded
+    neighbour matrix (see ztest.z_scores). Requires numba.
+    Sums are taken over the padded rows in the pairwise order of
+    numpy, so the result is identical to that of ztest.z_scores
+    :param matrix: samples x bins matrix
+    :param neighbours: padded neighbour matrix
+    :param robust: use median and MAD instead of mean and SD
+    :return: samples x bins matrix of z-scores
+    """
+    return _z_scores_numba(np.ascontiguousarray(matrix, np.float64),
+                           np.ascontiguousarray(neighbours, np.int64),
+                           robust, np.getbufsize())
+
+
+def use_environment():
+    """
+    Select the backend named by the WISESTORK_KERNELS environment
+    variable. An unknown or unavailable backend falls back to 'auto'
+    with a warning
+    """
+    try:
+        use(os.environ.get(BACKEND_ENV, AUTO))
+    except ValueError as e:
+        warnings.warn("{0}; using {1} instead".format(e, AUTO))
+        use(AUTO)
+
+
+use_environment()
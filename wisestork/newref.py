@@ -23,11 +23,33 @@ wisestork.newref
 """
 
 import math
+import os
+import shutil
+import sys
+
 import numpy as np
 
-from .utils import BedLine, get_bins, BedReader
+from .utils import (STDIO, BedLine, BedTrack, DEFAULT_CHUNK_SIZE,
+                    DEFAULT_PREFETCH, DEFAULT_WRITE_CHUNK, SparseTrack,
+                    as_str, format_layout, get_bins, iter_bed_chunks,
+                    layout_fingerprint, open_bed, open_output,
+                    peek_fingerprint, read_bed, rechunk, utf8)
+from . import kernels, precision
+from .checkpoint import Checkpoint, file_identity
+from .cohort import CohortStore, cohort_build, is_cohort
+from .ztest import ReferenceIndex, padded_neighbours
 from pyfaidx import Fasta
 
+MIN_READ_SIZE = 1 << 16
+DEFAULT_BLOCK_BYTES = 1 << 28
+
+MEDIAN = "median"
+PROFILE = "profile"
+EUCLIDEAN = "euclidean"
+CORRELATION = "correlation"
+
+SHARD_HEADER = b"#shard"
+
 
 def get_unique_bins(fasta, binsize):
     """
@@ -44,6 +66,19 @@ def get_unique_bins(fasta, binsize):
     return bins
 
 
+def get_positions(reference, binsize, binfile=None):
+    """
+    Get the bin layout, either from a reference or from a bin file
+    :param reference: instance of pyfaidx.Fasta
+    :param binsize: binsize
+    :param binfile: optional path to region BED file
+    :return: list of BedLine
+    """
+    if not binfile:
+        return get_unique_bins(reference, binsize)
+    return list(read_bed(binfile))
+
+
 def build_main_list(bins, binsize, reference, binfile=None):
     """
     Build main list of bins.
@@ -57,18 +92,304 @@ def build_main_list(bins, binsize, reference, binfile=None):
     :param reference: instance of pyfaidx.Fasta
     :return: list of bins (1 per position), sorted by median value
     """
-    if not binfile:
-        unique_positions = get_unique_bins(reference, binsize)
+    unique_positions = get_positions(reference, binsize, binfile)
+    if isinstance(bins, BedTrack):
+        values = bins.values
+    else:
+        values = np.array([x.value for x in bins])
+    if len(values) % len(unique_positions) != 0:
+        raise ValueError("Input files do not match the bin layout")
+    matrix = values.reshape(-1, len(unique_positions))
+    return sort_by_median(np.median(matrix, axis=0), unique_positions)
+
+
+def sort_by_median(medians, positions):
+    """
+    Sort bins by their median value over all samples
+    :param medians: array of per-bin medians
+    :param positions: list of BedLine (or BedTrack), one per bin
+    :return: list of bins (1 per position), sorted by median value
+    """
+    if len(medians) != len(positions):
+        raise ValueError("Input files do not match the bin layout")
+    order = np.argsort(medians, kind="stable")
+    return [positions[i]._replace(value=medians[i]) for i in order]
+
+
+def parse_shard(spec):
+    """
+    Parse a shard specification of the form i/N
+    :param spec: string, with 1 <= i <= N
+    :return: 2-tuple of (i, N)
+    """
+    try:
+        i, n = [int(x) for x in spec.split("/")]
+    except ValueError:
+        raise ValueError("Invalid shard {0}; expected i/N".format(spec))
+    if not 1 <= i <= n:
+        raise ValueError("Invalid shard {0}; i must be between 1 "
+                         "and N".format(spec))
+    return i, n
+
+
+def shard_bounds(shard, length):
+    """
+    Range of positions in the sorted list of bins covered by a shard.
+    Shards split the list into N consecutive ranges of nearly equal size
+    :param shard: 2-tuple of (i, N), or None for the whole list
+    :param length: length of the sorted list
+    :return: 2-tuple of (start, end) positions
+    """
+    if shard is None:
+        return 0, length
+    i, n = shard
+    return length * (i - 1) // n, length * i // n
+
+
+def save_medians(path, medians, layout):
+    """
+    Save per-bin medians and their bin layout as an npz file
+    :param path: path to medians file
+    :param medians: array of medians in layout order
+    :param layout: BedTrack or list of BedLine
+    """
+    if not isinstance(layout, BedTrack):
+        layout = BedTrack.from_bedlines(layout)
+    with open(path, "wb") as handle:
+        np.savez(handle, medians=medians, chromosomes=layout.chromosomes,
+                 starts=layout.starts, ends=layout.ends)
+
+
+def load_medians(path):
+    """
+    Load per-bin medians and their bin layout from an npz file
+    :param path: path to medians file
+    :return: 2-tuple of (array of medians, layout BedTrack)
+    """
+    with np.load(path) as data:
+        return data["medians"], BedTrack(data["chromosomes"],
+                                         data["starts"], data["ends"])
+
+
+def _is_store(inp):
+    return (not isinstance(inp, BedTrack) and inp != STDIO and
+            is_cohort(inp))
+
+
+def load_matrix(inputs):
+    """
+    Load the values of all input samples into one matrix.
+    Inputs may be gc-corrected BED files, BedTracks or cohort stores
+    :param inputs: list of paths and/or BedTracks
+    :return: 2-tuple of (samples x bins matrix, layout).
+        The layout is a BedTrack when at least one cohort store was
+        given, and None otherwise
+    """
+    rows = []
+    tracks = []
+    stores = []
+    for inp in inputs:
+        if _is_store(inp):
+            store = CohortStore(inp)
+            stores.append(store)
+            rows.append(store.matrix())
+        else:
+            if isinstance(inp, SparseTrack):
+                track = inp.to_dense()
+            else:
+                track = inp if isinstance(inp, BedTrack) else read_bed(inp)
+            tracks.append(track)
+            rows.append(track.values[np.newaxis, :])
+    if len(stores) == 0:
+        layout = None
+        if len(set(x.shape[1] for x in rows)) > 1:
+            raise ValueError("Input files do not match the bin layout")
     else:
-        reader = BedReader(binfile)
-        unique_positions = [x for x in reader]
-    median_bins = []
-    for i, u in enumerate(unique_positions):
-        working_bins = bins[i::len(unique_positions)]
-        med = np.median([x.value for x in working_bins])
-        median_bins.append(BedLine(u.chromosome, u.start, u.end, med))
+        layout = stores[0].layout
+        for other in [x.layout for x in stores[1:]] + tracks:
+            stores[0].check_layout(other)
+    return precision.as_values(np.concatenate(rows)), layout
+
+
+def bins_per_chunk(memory_limit, n_samples):
+    """
+    Number of bins that can be processed at once within a memory budget.
+    Every bin of a chunk costs one value per sample for the chunk
+    itself, one for the partitioned copy made by the median, and one
+    for the parsed input records.
+    :param memory_limit: budget in bytes, or None for no limit
+    :param n_samples: number of samples
+    :return: integer
+    """
+    if memory_limit is None:
+        return sys.maxsize
+    per_bin = max(n_samples, 1) * precision.value_dtype().itemsize * 3
+    return max(1, int(memory_limit // per_bin))
+
+
+def compute_medians(inputs, memory_limit=None):
+    """
+    Compute per-bin medians over all samples in consecutive bin ranges.
+    Cohort stores are memory-mapped and BED files are streamed in
+    lockstep, so that peak memory is bounded by the chunk size rather
+    than by samples x bins.
+    :param inputs: list of paths to gc-corrected BED files
+        and/or cohort stores, or in-memory BedTracks
+    :param memory_limit: approximate memory budget in bytes,
+        or None to process all bins at once
+    :return: 2-tuple of (array of medians, layout).
+        The layout is a BedTrack when at least one cohort store was
+        given, and None otherwise
+    """
+    stores = []
+    bed_paths = []
+    for inp in inputs:
+        if _is_store(inp):
+            stores.append(CohortStore(inp))
+        else:
+            bed_paths.append(inp)
+    for store in stores[1:]:
+        stores[0].check_layout(store.layout)
+    layout = stores[0].layout if stores else None
+    n_samples = sum(len(x) for x in stores) + len(bed_paths)
+    chunk_bins = bins_per_chunk(memory_limit, n_samples)
+    read_size = DEFAULT_CHUNK_SIZE
+    if memory_limit is not None and bed_paths:
+        # every reader holds its current chunk, the chunks read
+        # ahead and their parsed records
+        per_reader = 4 + DEFAULT_PREFETCH
+        read_size = int(min(max(memory_limit // (per_reader * len(bed_paths)),
+                                MIN_READ_SIZE), DEFAULT_CHUNK_SIZE))
+    readers = [rechunk([x] if isinstance(x, BedTrack) else
+                       [x.to_dense()] if isinstance(x, SparseTrack) else
+                       iter_bed_chunks(x, read_size), chunk_bins)
+               for x in bed_paths]
+    matrices = [x.matrix() for x in stores]
+
+    medians = []
+    offset = 0
+    while True:
+        tracks = [next(x, None) for x in readers]
+        present = [x for x in tracks if x is not None]
+        if layout is not None:
+            size = min(chunk_bins, len(layout) - offset)
+            expected = layout[offset:offset+size]
+        elif present:
+            size = len(present[0])
+            expected = present[0]
+        else:
+            break
+        if size == 0 and len(present) == 0:
+            break
+        for track in present:
+            if not (len(track) == size and
+                    np.array_equal(track.starts, expected.starts) and
+                    np.array_equal(track.ends, expected.ends)):
+                raise ValueError("Input files do not match the bin layout")
+        if len(present) != len(tracks) or size == 0:
+            raise ValueError("Input files do not match the bin layout")
+
+        block = np.empty((n_samples, size), dtype=precision.value_dtype())
+        row = 0
+        for matrix in matrices:
+            block[row:row+len(matrix)] = matrix[:, offset:offset+size]
+            row += len(matrix)
+        for track in present:
+            block[row] = track.values
+            row += 1
+        medians.append(np.median(block, axis=0))
+        offset += size
+
+    if len(medians) == 0:
+        return np.empty(0, dtype=precision.value_dtype()), layout
+    return np.concatenate(medians), layout
+
 
-    return sorted(median_bins, key=lambda x: x.value)
+def prepare_profiles(matrix, metric=EUCLIDEAN):
+    """
+    Transform a samples x bins matrix so that distances between bin
+    profiles follow from inner products.
+    For the correlation metric, profiles are centered and scaled to unit
+    length, so that the squared euclidean distance equals 2 - 2r.
+    Profiles without variance get NaN values and are never selected.
+    :param matrix: samples x bins matrix of values
+    :param metric: 'euclidean' or 'correlation'
+    :return: 2-tuple of (profiles matrix, squared norm per bin)
+    """
+    profiles = np.array(matrix, dtype=precision.value_dtype())
+    if metric == CORRELATION:
+        profiles -= profiles.mean(axis=0)
+        norms = np.sqrt(np.einsum("ij,ij->j", profiles, profiles))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            profiles /= norms
+    elif metric != EUCLIDEAN:
+        raise ValueError("Unknown metric: {0}".format(metric))
+    return profiles, np.einsum("ij,ij->j", profiles, profiles)
+
+
+def nearest_profiles(profiles, sq_norms, targets, k):
+    """
+    Find the k bins with the most similar profiles for a block of
+    target bins. Distances are computed with one matrix product per
+    block, and only the k smallest are partially sorted, so that the
+    full bins x bins distance matrix is never materialized.
+    :param profiles: profiles matrix from prepare_profiles
+    :param sq_norms: squared norms from prepare_profiles
+    :param targets: array of bin ids
+    :param k: number of neighbours per target
+    :return: list of neighbour id arrays, nearest first
+    """
+    n = profiles.shape[1]
+    k = min(k, n - 1)
+    if k <= 0:
+        return [np.empty(0, dtype=np.int64) for _ in targets]
+    dist = np.dot(profiles[:, targets].T, profiles)
+    dist *= -2
+    dist += sq_norms[targets][:, np.newaxis]
+    dist += sq_norms[np.newaxis, :]
+    dist[np.isnan(dist)] = np.inf
+    dist[np.arange(len(targets)), targets] = np.inf
+    part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    part_dist = np.take_along_axis(dist, part, axis=1)
+    ordered = np.take_along_axis(part, np.lexsort((part, part_dist)),
+                                 axis=1)
+    valid = np.isfinite(np.take_along_axis(dist, ordered, axis=1))
+    return [row[mask] for row, mask in zip(ordered, valid)]
+
+
+def profile_block_size(n_bins, memory_limit=None):
+    """
+    Number of target bins per block of profile distances.
+    Every target costs a row of distances, a partition index
+    and a temporary of the same size.
+    :param n_bins: total number of bins
+    :param memory_limit: budget in bytes, or None for the default
+    :return: integer
+    """
+    budget = DEFAULT_BLOCK_BYTES if memory_limit is None else memory_limit
+    return max(1, int(budget // (max(n_bins, 1) * 24)))
+
+
+def window_bounds(idx, length, n_bins):
+    """
+    Bounds of the window of neighbours around a position in the
+    sorted list of bins. Near the edges the window is shifted
+    so that it stays within the list.
+    :param idx: position in the sorted list
+    :param length: length of the sorted list
+    :param n_bins: window size
+    :return: 2-tuple of (start, end) positions
+    """
+    half = n_bins // 2
+    # starting edge; if distance from start less
+    # or equal to half the window size
+    if idx <= half:
+        return 0, min(n_bins, length)
+    # ending edge; if distance from end is less
+    # or equal to half the window size
+    if length - idx <= half:
+        return max(length - n_bins, 0), length
+    return idx - half, idx + int(math.ceil(n_bins / 2))
 
 
 class ReferenceBinGenerator(object):
@@ -79,35 +400,82 @@ class ReferenceBinGenerator(object):
     """
 
     def __init__(self, inputs, n_bins, reference, binsize=int(1e6),
-                 binfile=None):
+                 binfile=None, memory_limit=None, selection=MEDIAN,
+                 metric=EUCLIDEAN, medians=None, shard=None):
         """
         Create instance of ReferenceBinGenerator
         :param inputs: list of paths to files of gc-corrected bedgraph files
+            and/or cohort stores
         :param n_bins: number of neighbour bins to consider
+        :param memory_limit: optional memory budget in bytes for
+            computing the per-bin medians
+        :param selection: 'median' selects neighbours from a window of
+            bins sorted by median value. 'profile' selects the bins with
+            the most similar values across all samples
+        :param metric: distance metric for profile selection,
+            'euclidean' or 'correlation'
+        :param medians: optional precomputed 2-tuple of (medians, layout)
+            (see load_medians), used instead of reading the inputs.
+            Only for median selection
+        :param shard: optional 2-tuple of (i, N). Only the i-th of N
+            ranges of the sorted list of bins is iterated
         """
+        if selection not in (MEDIAN, PROFILE):
+            raise ValueError("Unknown selection mode: {0}".format(selection))
+        if medians is not None and selection != MEDIAN:
+            raise ValueError("Precomputed medians require median selection")
         self.inputs = inputs
+        self.memory_limit = memory_limit
         self.n_bins = n_bins
         self.fasta = Fasta(reference)
         self.binsize = binsize
         self.binfile = binfile
+        self.selection = selection
+        self.metric = metric
+        self.precomputed = medians
+        self.__block = []
+        self.__block_start = 0
         self.__bins = self.get_all_bins()
-        self.__idx = 0
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(len(self.order))
+        self.start, self.end = shard_bounds(shard, len(self.order))
+        self.__idx = self.start
 
     def get_all_bins(self):
-        bins = []
-        for inp in self.inputs:
-            tmp_reader = BedReader(inp)
-            bins += [x for x in tmp_reader]
-        return build_main_list(bins, self.binsize, self.fasta, self.binfile)
+        if self.selection == PROFILE:
+            matrix, layout = load_matrix(self.inputs)
+            medians = np.median(matrix, axis=0)
+            self.profiles, self.sq_norms = prepare_profiles(matrix,
+                                                            self.metric)
+        elif self.precomputed is not None:
+            medians, layout = self.precomputed
+        else:
+            medians, layout = compute_medians(self.inputs, self.memory_limit)
+        if layout is None:
+            layout = get_positions(self.fasta, self.binsize, self.binfile)
+        if len(medians) != len(layout):
+            raise ValueError("Input files do not match the bin layout")
+        self.layout = layout
+        self.medians = medians
+        self.order = np.argsort(medians, kind="stable")
+        return [layout[i]._replace(value=medians[i]) for i in self.order]
 
     def __next__(self):
-        if self.__idx == len(self.__bins):
+        target, ids = self.next_ids()
+        return (self.__bins[self.rank[target]],
+                [self.__bins[i] for i in self.rank[ids]])
+
+    def next_ids(self):
+        """
+        Next bin and its filtered neighbours, without creating BedLines
+        :return: 2-tuple of (layout id, array of layout ids)
+        """
+        if self.__idx == self.end:
             raise StopIteration
-        nearest = self.get_nearest_at_idx(self.__idx)
-        cur = self.__bins[self.__idx]
-        filtered = self.filter_bins(cur, nearest)
+        target = self.order[self.__idx]
+        ids = self.neighbours_at_idx(self.__idx)
         self.__idx += 1
-        return cur, filtered
+        return target, ids
 
     def next(self):
         return self.__next__()
@@ -115,19 +483,77 @@ class ReferenceBinGenerator(object):
     def __iter__(self):
         return self
 
+    @property
+    def position(self):
+        """
+        Position in the sorted list of the next bin
+        """
+        return self.__idx
+
+    def seek(self, idx):
+        """
+        Continue iteration at a position in the sorted list
+        :param idx: position, within the range of this generator
+        """
+        if not self.start <= idx <= self.end:
+            raise ValueError("Position {0} is outside of bins {1} to "
+                             "{2}".format(idx, self.start, self.end))
+        self.__idx = idx
+
     def get_nearest_at_idx(self, idx):
-        e_dist = len(self.__bins) - idx
-        # starting edge; if distance from start less
-        # or equal to half the window size
-        if idx == 0 or 0 < idx <= self.n_bins//2:
-            vals = self.__bins[:self.n_bins]
-        # ending edge; if distance from end is less
-        # or equal to half the window size
-        elif e_dist <= self.n_bins//2:
-            vals = self.__bins[-self.n_bins:]
-        else:
-            vals = self.__bins[idx-(self.n_bins//2):idx+int(math.ceil((self.n_bins/2)))]  # noqa
-        return vals
+        lo, hi = window_bounds(idx, len(self.__bins), self.n_bins)
+        return self.__bins[lo:hi]
+
+    def neighbours_at_idx(self, idx):
+        """
+        Layout ids of the filtered neighbours of the bin at a
+        position in the sorted list
+        :param idx: position in the sorted list
+        :return: array of layout ids
+        """
+        target = self.order[idx]
+        if self.selection == PROFILE:
+            return self.filter_ids(target, self.profile_neighbours(idx))
+        lo, hi = window_bounds(idx, len(self.__bins), self.n_bins)
+        window = self.order[lo:hi]
+        return self.filter_ids(target, window)
+
+    def all_neighbour_ids(self):
+        """
+        Filtered neighbours of every bin, without creating BedLines
+        :return: list of arrays of layout ids, in layout order
+        """
+        ids = [None] * len(self.order)
+        for idx in range(len(self.order)):
+            ids[self.order[idx]] = self.neighbours_at_idx(idx)
+        return ids
+
+    def profile_neighbours(self, idx):
+        """
+        Layout ids of the bins with the most similar profiles to the bin
+        at a position in the sorted list. Computed in blocks of
+        consecutive positions.
+        :param idx: position in the sorted list
+        :return: array of layout ids, nearest first
+        """
+        if not (self.__block_start <= idx <
+                self.__block_start + len(self.__block)):
+            size = profile_block_size(len(self.order), self.memory_limit)
+            self.__block_start = idx
+            self.__block = nearest_profiles(self.profiles, self.sq_norms,
+                                            self.order[idx:idx+size],
+                                            self.n_bins - 1)
+        return self.__block[idx - self.__block_start]
+
+    def filter_ids(self, target, ids):
+        """
+        Filter an array of reference bin ids.
+        Same exclusion criteria as filter_bins
+        :param target: layout id of the target bin
+        :param ids: array of layout ids
+        :return: filtered array of layout ids (may be empty)
+        """
+        return kernels.filter_window(ids, self.medians, target)
 
     def filter_bins(self, target_bin, bins):
         """
@@ -150,36 +576,223 @@ class ReferenceBinGenerator(object):
         return non_outliers
 
 
+def build_reference(inputs, reference, binsize, n_bins=250, binfile=None,
+                    memory_limit=None, selection=MEDIAN, metric=EUCLIDEAN):
+    """
+    Build a reference in memory
+    :param inputs: list of gc-corrected BedTracks, paths to BED files
+        and/or cohort stores
+    :param reference: path to reference Fasta
+    :param binsize: binsize
+    :param n_bins: number of neighbour bins to consider
+    :param binfile: optional path to region BED file
+    :param memory_limit: optional memory budget in bytes for
+        computing the per-bin medians
+    :param selection: neighbour selection mode, 'median' or 'profile'
+    :param metric: distance metric for profile selection
+    :return: ReferenceIndex, in layout order
+    """
+    gen = ReferenceBinGenerator(inputs, n_bins, reference, binsize,
+                                binfile, memory_limit, selection=selection,
+                                metric=metric)
+    return ReferenceIndex(layout_track(gen.layout),
+                          padded_neighbours(gen.all_neighbour_ids()))
+
+
+def layout_track(layout):
+    """
+    Bin layout as a BedTrack without values
+    :param layout: BedTrack or list of BedLine
+    :return: BedTrack
+    """
+    if not isinstance(layout, BedTrack):
+        layout = BedTrack.from_bedlines(layout).with_values(None)
+    return layout
+
+
+def fold_into_cohort(input_paths):
+    """
+    Append BED inputs to the single cohort store among the inputs
+    :param input_paths: paths to one cohort store and
+        any number of gc-corrected BED files
+    :return: list with the path to the cohort store
+    """
+    stores = [x for x in input_paths if x != STDIO and is_cohort(x)]
+    if len(stores) != 1:
+        raise ValueError("Updating a reference requires exactly one "
+                         "cohort store as input")
+    new_samples = [x for x in input_paths if x not in stores]
+    if new_samples:
+        cohort_build(new_samples, stores[0], append=True)
+    return stores
+
+
 def newref(input_paths, output_path, reference, binsize, n_bins=250,
-           binfile=None):
+           binfile=None, memory_limit=None, update=False,
+           selection=MEDIAN, metric=EUCLIDEAN, medians_path=None,
+           shard=None, resume=False):
     """
     Create a new reference bed file
-    :param input_paths: paths to gc-corrected BED files
+    :param input_paths: paths to gc-corrected BED files and/or cohort stores
     :param output_path: path to output bed file
     :param reference: path to reference Fasta
     :param binsize: binsize
     :param n_bins: number of neighbour bins to consider
+    :param binfile: optional path to region BED file
+    :param memory_limit: optional memory budget in bytes for
+        computing the per-bin medians
+    :param update: append the BED inputs to the single cohort store
+        among input_paths, and build the reference from that store
+    :param selection: neighbour selection mode, 'median' or 'profile'
+    :param metric: distance metric for profile selection
+    :param medians_path: optional path to a medians file written by
+        newref_medians, used instead of the inputs
+    :param shard: optional 2-tuple of (i, N). Only neighbour sets of
+        the i-th of N ranges of bins are written, to be combined
+        with newref_merge
+    :param resume: record a checkpoint after every chunk of written
+        bins, and continue from the checkpoint of an interrupted run
+        if there is one. Requires an output file and no input from
+        stdin, and can not be combined with update
     """
+    if list(input_paths).count(STDIO) > 1:
+        raise ValueError("Only one input can be read from stdin")
+    if update:
+        if resume:
+            raise ValueError("Can not resume an update")
+        input_paths = fold_into_cohort(input_paths)
+    medians = None if medians_path is None else load_medians(medians_path)
     gen = ReferenceBinGenerator(input_paths, n_bins, reference, binsize,
-                                binfile)
-    ohandle = open(output_path, "wb")
-    for x in gen:
-        chrom = x[0].chromosome
-        start = x[0].start
-        end = x[0].end
-        references = []
-        for record in x[1]:
-            fmt = "{0},{1},{2}"
-            if isinstance(record.chromosome, str):
-                references.append(fmt.format(record.chromosome,
-                                             record.start, record.end))
-            else:
-                references.append(fmt.format(record.chromosome.decode(),
-                                             record.start, record.end))
-        references = "|".join(references)
+                                binfile, memory_limit, selection=selection,
+                                metric=metric, medians=medians, shard=shard)
+    checkpoint = None
+    if resume:
+        if output_path == STDIO or STDIO in input_paths:
+            raise ValueError("Resuming requires an output file and no "
+                             "input from stdin")
+        checkpoint = Checkpoint(output_path, {
+            "command": "newref",
+            "inputs": [file_identity(x) for x in input_paths],
+            "medians": medians_path and file_identity(medians_path),
+            "reference": os.path.abspath(reference), "binsize": binsize,
+            "binfile": binfile and file_identity(binfile),
+            "n_bins": n_bins, "selection": selection, "metric": metric,
+            "shard": shard})
+    with (checkpoint.open(resume) if checkpoint is not None
+          else open_output(output_path)) as ohandle:
+        layout = layout_track(gen.layout)
+        if checkpoint is not None and checkpoint.progress is not None:
+            gen.seek(checkpoint.progress)
+        else:
+            if shard is not None:
+                ohandle.write(b"%s\t%d/%d\t%d\t%d\t%d\n" % (
+                    SHARD_HEADER, shard[0], shard[1], gen.start, gen.end,
+                    len(gen.order)))
+            ohandle.write(format_layout(layout_fingerprint(layout)))
+        targets, neighbours = [], []
+        while gen.position < gen.end:
+            target, ids = gen.next_ids()
+            targets.append(target)
+            neighbours.append(ids)
+            if len(targets) == DEFAULT_WRITE_CHUNK:
+                ohandle.write(format_reference_ids(layout, targets,
+                                                   neighbours))
+                targets, neighbours = [], []
+                if checkpoint is not None:
+                    checkpoint.update(ohandle, gen.position)
+        ohandle.write(format_reference_ids(layout, targets, neighbours))
 
-        if len(references) == 0:
-            references = np.nan
 
-        t = BedLine(chrom, start, end, references)
-        ohandle.write(bytes(t) + b"\n")
+def newref_medians(input_paths, output_path, reference, binsize,
+                   binfile=None, memory_limit=None):
+    """
+    Compute the per-bin medians of the inputs once, to be shared
+    by the shards of a reference build
+    :param input_paths: paths to gc-corrected BED files and/or cohort stores
+    :param output_path: path to output medians file
+    :param reference: path to reference Fasta
+    :param binsize: binsize
+    :param binfile: optional path to region BED file
+    :param memory_limit: optional memory budget in bytes
+    """
+    if list(input_paths).count(STDIO) > 1:
+        raise ValueError("Only one input can be read from stdin")
+    medians, layout = compute_medians(input_paths, memory_limit)
+    if layout is None:
+        layout = get_positions(Fasta(reference), binsize, binfile)
+    if len(medians) != len(layout):
+        raise ValueError("Input files do not match the bin layout")
+    save_medians(output_path, medians, layout)
+
+
+def read_shard_header(handle):
+    """
+    Read the header line of a shard
+    :param handle: binary handle positioned at the start of a shard
+    :return: 5-tuple of (i, N, start, end, total)
+    """
+    fields = handle.readline().rstrip(b"\n").split(b"\t")
+    if len(fields) != 5 or fields[0] != SHARD_HEADER:
+        raise ValueError("Not a reference shard")
+    i, n = parse_shard(fields[1].decode())
+    return (i, n) + tuple(int(x) for x in fields[2:])
+
+
+def newref_merge(shard_paths, output_path):
+    """
+    Concatenate the shards of a reference build into one
+    reference dictionary
+    :param shard_paths: paths to shard outputs of newref, in any order
+    :param output_path: path to output bed file
+    """
+    headers = []
+    fingerprints = set()
+    for path in shard_paths:
+        with open_bed(path) as handle:
+            headers.append(read_shard_header(handle) + (path,))
+            fingerprints.add(peek_fingerprint(handle))
+    headers.sort()
+    n_shards = set(x[1] for x in headers)
+    totals = set(x[4] for x in headers)
+    if len(n_shards) != 1 or len(totals) != 1:
+        raise ValueError("Shards are not from the same reference build")
+    if len(fingerprints) != 1:
+        raise ValueError("Shards have different bin layouts")
+    fingerprint = fingerprints.pop()
+    n_shards, total = n_shards.pop(), totals.pop()
+    if [x[0] for x in headers] != list(range(1, n_shards + 1)):
+        raise ValueError("Expected shards 1 to {0} exactly once".format(
+            n_shards))
+    for i, (_, _, start, end, _, path) in enumerate(headers):
+        if (start, end) != shard_bounds((i + 1, n_shards), total):
+            raise ValueError("Shard {0} does not cover its range".format(
+                path))
+    with open_output(output_path) as ohandle:
+        if fingerprint is not None:
+            ohandle.write(format_layout(fingerprint))
+        for header in headers:
+            with open_bed(header[-1]) as handle:
+                handle.readline()
+                if fingerprint is not None:
+                    handle.readline()
+                shutil.copyfileobj(handle, ohandle)
+
+
+def format_reference_ids(layout, targets, neighbours):
+    """
+    Format reference dictionary records. The reference bins of a
+    record are written as their layout positions joined by `|`,
+    followed by the layout position of the record itself
+    :param layout: BedTrack of bins
+    :param targets: list of layout ids of target bins
+    :param neighbours: list of arrays of layout ids of their reference bins
+    :return: bytes
+    """
+    targets = np.asarray(targets, dtype=np.int64)
+    refs = ["|".join(map(str, x.tolist())) if len(x) > 0 else "nan"
+            for x in neighbours]
+    lines = ["{0}\t{1}\t{2}\t{3}\t{4}\n".format(*x) for x in zip(
+        (as_str(x) for x in layout.chromosomes[targets].tolist()),
+        layout.starts[targets].tolist(), layout.ends[targets].tolist(),
+        refs, targets.tolist())]
+    return utf8("".join(lines))
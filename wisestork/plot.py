@@ -0,0 +1,161 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.plot
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .utils import as_str, read_bed
+
+DEFAULT_WIDTH = 1600
+DEFAULT_HEIGHT = 400
+DEFAULT_DPI = 100
+
+
+def pixel_aggregate(positions, values, lower, upper, width):
+    """
+    Aggregate values into pixel columns.
+    Every column gets the minimum, maximum and mean of the finite
+    values whose position falls in it, so that drawing the result
+    costs the same regardless of the number of bins.
+    :param positions: array of positions
+    :param values: array of values
+    :param lower: position of left edge of first column
+    :param upper: position of right edge of last column
+    :param width: number of columns
+    :return: 4-tuple of arrays of length width: column centers,
+        minima, maxima and means. Empty columns are NaN
+    """
+    values = np.asarray(values, dtype=np.float64)
+    keep = np.isfinite(values) & (positions >= lower) & (positions < upper)
+    scale = width / float(upper - lower)
+    cols = ((positions[keep] - lower) * scale).astype(np.int64)
+    cols = np.minimum(cols, width - 1)
+    values = values[keep]
+    counts = np.bincount(cols, minlength=width)
+    sums = np.bincount(cols, weights=values, minlength=width)
+    order = np.argsort(cols, kind="mergesort")
+    cols, values = cols[order], values[order]
+    occupied = np.flatnonzero(counts)
+    first = np.searchsorted(cols, occupied)
+    mins = np.full(width, np.nan)
+    maxs = np.full(width, np.nan)
+    means = np.full(width, np.nan)
+    if len(occupied) > 0:
+        mins[occupied] = np.minimum.reduceat(values, first)
+        maxs[occupied] = np.maximum.reduceat(values, first)
+        means[occupied] = sums[occupied] / counts[occupied]
+    centers = lower + (np.arange(width) + 0.5) / scale
+    return centers, mins, maxs, means
+
+
+def genome_positions(track, chromosome=None):
+    """
+    Positions of bin midpoints along the plotted axis
+    :param track: BedTrack grouped by chromosome
+    :param chromosome: optional chromosome to restrict to
+    :return: 4-tuple of (selected BedTrack, positions, axis extent,
+        list of (chromosome, offset) of chromosome starts)
+    """
+    runs = track.chromosome_runs()
+    if chromosome is not None:
+        runs = [x for x in runs if as_str(x[0]) == as_str(chromosome)]
+        if len(runs) == 0:
+            raise ValueError("Chromosome {0} not in track".format(
+                as_str(chromosome)))
+        _, a, b = runs[0]
+        selected = track[a:b]
+        positions = (selected.starts + selected.ends) / 2.0
+        return selected, positions, (selected.starts.min(),
+                                     selected.ends.max()), []
+    offsets = []
+    positions = np.empty(len(track))
+    offset = 0
+    for chrom, a, b in runs:
+        offsets.append((chrom, offset))
+        positions[a:b] = offset + (track.starts[a:b] +
+                                   track.ends[a:b]) / 2.0
+        offset += track.ends[a:b].max()
+    return track, positions, (0, max(offset, 1)), offsets
+
+
+def render(track, output_path, chromosome=None, width=DEFAULT_WIDTH,
+           height=DEFAULT_HEIGHT, dpi=DEFAULT_DPI, label="Value",
+           title=None):
+    """
+    Plot a track to an image file.
+    Values are aggregated to one min/max envelope and mean per pixel
+    column of the image before drawing.
+    :param track: BedTrack of counts, corrected values or z-scores
+    :param output_path: path to image. The format follows the extension
+    :param chromosome: optional chromosome to plot. Default is the
+        whole genome
+    :param width: width in pixels
+    :param height: height in pixels
+    :param dpi: resolution
+    :param label: y-axis label
+    :param title: optional title
+    """
+    selected, positions, (lower, upper), offsets = genome_positions(
+        track, chromosome)
+    centers, mins, maxs, means = pixel_aggregate(
+        positions, selected.values, lower, upper, width)
+
+    fig = Figure(figsize=(width / float(dpi), height / float(dpi)), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.fill_between(centers, mins, maxs, color="#9ecae1", linewidth=0)
+    ax.plot(centers, means, color="#08519c", linewidth=0.8)
+    ax.set_xlim(lower, upper)
+    ax.set_ylabel(label)
+    if offsets:
+        bounds = [x[1] for x in offsets[1:]]
+        for x in bounds:
+            ax.axvline(x, color="#bbbbbb", linewidth=0.5)
+        edges = [x[1] for x in offsets] + [upper]
+        ax.set_xticks([(a + b) / 2.0 for a, b in zip(edges[:-1], edges[1:])])
+        ax.set_xticklabels([as_str(x[0]) for x in offsets], rotation=90,
+                           fontsize="small")
+        ax.tick_params(axis="x", length=0)
+    else:
+        ax.set_xlabel("Position on {0}".format(as_str(chromosome)))
+    if title is not None:
+        ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(output_path, dpi=dpi)
+
+
+def plot(input_path, output_path, chromosome=None, width=DEFAULT_WIDTH,
+         height=DEFAULT_HEIGHT, dpi=DEFAULT_DPI, label="Value", title=None):
+    """
+    Plot a BED track
+    :param input_path: path to BED file, or '-' for stdin
+    :param output_path: path to image
+    :param chromosome: optional chromosome to plot
+    :param width: width in pixels
+    :param height: height in pixels
+    :param dpi: resolution
+    :param label: y-axis label
+    :param title: optional title
+    """
+    render(read_bed(input_path), output_path, chromosome, width, height,
+           dpi, label, title)
@@ -0,0 +1,114 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.precision
+~~~~~~~~~~~~~~
+Numeric precision of the arrays that flow through the pipeline.
+
+With double precision, counts are int64 and values float64. With
+single precision, counts are uint32 and corrected values, medians
+and z-scores float32, which halves the memory of samples x bins
+matrices. Intermediate sums are still accumulated in double
+precision. The precision is selected with use() or the
+WISESTORK_PRECISION environment variable. An invalid environment
+variable falls back to double precision with a warning.
+
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import os
+import warnings
+
+import numpy as np
+
+DOUBLE = "double"
+SINGLE = "single"
+PRECISIONS = (DOUBLE, SINGLE)
+PRECISION_ENV = "WISESTORK_PRECISION"
+
+_DTYPES = {
+    DOUBLE: (np.dtype(np.int64), np.dtype(np.float64)),
+    SINGLE: (np.dtype(np.uint32), np.dtype(np.float32))
+}
+
+_precision = DOUBLE
+
+
+def use(precision=DOUBLE):
+    """
+    Select the numeric precision
+    :param precision: 'double' or 'single'
+    """
+    global _precision
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision: {0}".format(precision))
+    _precision = precision
+
+
+def precision():
+    """
+    Name of the selected precision
+    :return: 'double' or 'single'
+    """
+    return _precision
+
+
+def count_dtype():
+    """
+    dtype of read counts
+    """
+    return _DTYPES[_precision][0]
+
+
+def value_dtype():
+    """
+    dtype of corrected values, medians and z-scores
+    """
+    return _DTYPES[_precision][1]
+
+
+def as_counts(values):
+    """
+    Convert counts to the selected precision
+    :param values: array of counts
+    :return: array
+    """
+    return np.asarray(values).astype(count_dtype(), copy=False)
+
+
+def as_values(values):
+    """
+    Convert values to the selected precision
+    :param values: array of values
+    :return: array
+    """
+    return np.asarray(values).astype(value_dtype(), copy=False)
+
+
+def use_environment():
+    """
+    Select the precision named by the WISESTORK_PRECISION environment
+    variable. An unknown precision falls back to double with a warning
+    """
+    try:
+        use(os.environ.get(PRECISION_ENV, DOUBLE))
+    except ValueError as e:
+        warnings.warn("{0}; using {1} instead".format(e, DOUBLE))
+        use(DOUBLE)
+
+
+use_environment()
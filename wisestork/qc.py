@@ -0,0 +1,206 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.qc
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+from .utils import as_str, open_output
+
+FLAG_UNMAPPED = 0x4
+FLAG_SECONDARY = 0x100
+FLAG_QCFAIL = 0x200
+FLAG_DUPLICATE = 0x400
+FLAG_SUPPLEMENTARY = 0x800
+MAX_MAPQ = 255
+TALLY_SIZE = 1 << 16
+JSON_SUFFIX = ".json"
+METRICS_HEADER = "#metric\tvalue\n"
+
+
+def mapd(values):
+    """
+    Median absolute pairwise difference of neighbouring bins, on
+    log2 counts normalized to their median. Bins without reads are
+    left out. Lower is more even.
+    :param values: array of counts
+    :return: float, or NaN with fewer than two bins with reads
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[values > 0]
+    if len(values) < 2:
+        return float("nan")
+    log = np.log2(values / np.median(values))
+    return float(np.median(np.abs(np.diff(log))))
+
+
+class ReadMetrics(object):
+    """
+    Alignment and coverage metrics of a BAM file, accumulated while
+    its reads are counted.
+
+    Reads are observed as they pass by, so the metrics cost no extra
+    pass over the file. Flags, mapping qualities and reference ids
+    are buffered and tallied per block of reads.
+    """
+
+    def __init__(self, chromosomes):
+        """
+        Create instance of ReadMetrics
+        :param chromosomes: list of chromosome names in header order
+        """
+        self.chromosomes = list(chromosomes)
+        self.total = 0
+        self.unmapped = 0
+        self.secondary = 0
+        self.supplementary = 0
+        self.duplicate = 0
+        self.qcfail = 0
+        self.mapq = np.zeros(MAX_MAPQ + 1, np.int64)
+        self.per_chromosome = np.zeros(len(self.chromosomes), np.int64)
+        self.counts = []
+
+    def observe(self, reads):
+        """
+        Tally reads as they are consumed
+        :param reads: iterable of pysam.AlignedSegment
+        :return: generator of the same reads
+        """
+        flags, mapqs, rids = [], [], []
+        for read in reads:
+            flags.append(read.flag)
+            mapqs.append(read.mapping_quality)
+            rids.append(read.reference_id)
+            if len(flags) == TALLY_SIZE:
+                self.tally(flags, mapqs, rids)
+                flags, mapqs, rids = [], [], []
+            yield read
+        self.tally(flags, mapqs, rids)
+
+    def tally(self, flags, mapqs, rids):
+        """
+        Add a block of reads to the metrics
+        :param flags: list of SAM flags
+        :param mapqs: list of mapping qualities
+        :param rids: list of reference ids, -1 for reads without one
+        """
+        if len(flags) == 0:
+            return
+        flags = np.array(flags, np.int64)
+        unmapped = (flags & FLAG_UNMAPPED) > 0
+        self.total += len(flags)
+        self.unmapped += int(unmapped.sum())
+        self.secondary += int(((flags & FLAG_SECONDARY) > 0).sum())
+        self.supplementary += int(((flags & FLAG_SUPPLEMENTARY) > 0).sum())
+        self.duplicate += int(((flags & FLAG_DUPLICATE) > 0).sum())
+        self.qcfail += int(((flags & FLAG_QCFAIL) > 0).sum())
+        mapqs = np.array(mapqs, np.int64)[~unmapped]
+        self.mapq += np.bincount(mapqs, minlength=MAX_MAPQ + 1)
+        rids = np.array(rids, np.int64)[~unmapped]
+        self.per_chromosome += np.bincount(
+            rids[rids >= 0], minlength=len(self.chromosomes))
+
+    def add_counts(self, track):
+        """
+        Add a count track, to measure coverage evenness across bins
+        :param track: BedTrack with counts
+        """
+        self.counts.append(np.asarray(track.values, dtype=np.int64))
+
+    def to_dict(self):
+        """
+        Metrics as an ordered dict
+        :return: OrderedDict of metric name: value
+        """
+        mapped = self.total - self.unmapped
+        counts = (np.concatenate(self.counts) if self.counts
+                  else np.zeros(0, np.int64))
+        result = OrderedDict()
+        result["total_reads"] = self.total
+        result["mapped_reads"] = mapped
+        result["unmapped_reads"] = self.unmapped
+        result["mapped_fraction"] = _fraction(mapped, self.total)
+        result["duplicate_fraction"] = _fraction(self.duplicate, self.total)
+        result["secondary_fraction"] = _fraction(self.secondary, self.total)
+        result["supplementary_fraction"] = _fraction(self.supplementary,
+                                                     self.total)
+        result["qcfail_fraction"] = _fraction(self.qcfail, self.total)
+        quals = np.arange(MAX_MAPQ + 1)
+        result["mean_mapq"] = (float((self.mapq * quals).sum() / mapped)
+                               if mapped else float("nan"))
+        result["bins"] = len(counts)
+        result["empty_bin_fraction"] = _fraction(int((counts == 0).sum()),
+                                                 len(counts))
+        if len(counts) > 0 and counts.mean() > 0:
+            result["bin_cv"] = float(counts.std() / counts.mean())
+        else:
+            result["bin_cv"] = float("nan")
+        result["bin_mapd"] = mapd(counts)
+        result["mapq"] = OrderedDict(
+            (str(q), int(self.mapq[q])) for q in np.flatnonzero(self.mapq))
+        result["chromosomes"] = OrderedDict(
+            (as_str(ch), int(n)) for ch, n in zip(self.chromosomes,
+                                                  self.per_chromosome))
+        return result
+
+
+def _fraction(numerator, denominator):
+    return numerator / float(denominator) if denominator else float("nan")
+
+
+def format_metrics(metrics):
+    """
+    Format metrics as TSV. Nested metrics are flattened
+    to 'mapq_<quality>' and 'chromosome_<name>'
+    :param metrics: output of ReadMetrics.to_dict
+    :return: bytes
+    """
+    rows = []
+    for key, value in metrics.items():
+        if key == "mapq":
+            rows += [("mapq_" + q, n) for q, n in value.items()]
+        elif key == "chromosomes":
+            rows += [("chromosome_" + ch, n) for ch, n in value.items()]
+        else:
+            rows.append((key, value))
+    return (METRICS_HEADER + "".join("%s\t%r\n" % x for x in rows)).encode()
+
+
+def write_metrics(path, metrics):
+    """
+    Write metrics to a file. Paths ending in .json get JSON,
+    other paths TSV
+    :param path: path to output, or '-' for stdout
+    :param metrics: ReadMetrics
+    """
+    result = metrics.to_dict()
+    if path.endswith(JSON_SUFFIX):
+        # NaN is not valid JSON
+        result = OrderedDict(
+            (k, None if isinstance(v, float) and np.isnan(v) else v)
+            for k, v in result.items())
+        data = (json.dumps(result, indent=2) + "\n").encode()
+    else:
+        data = format_metrics(result)
+    with open_output(path) as ohandle:
+        ohandle.write(data)
@@ -0,0 +1,162 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.segment
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from .utils import BedTrack, open_output, read_bed, write_bed
+
+DEFAULT_THRESHOLD = 5.0
+DEFAULT_MIN_BINS = 5
+MAD_SCALE = 1.4826
+
+
+def noise_level(values):
+    """
+    Robust estimate of the standard deviation of a piecewise constant
+    signal, from the median absolute difference of consecutive values
+    :param values: array of finite values
+    :return: float
+    """
+    if len(values) < 2:
+        return 1.0
+    diffs = np.abs(np.diff(values))
+    sigma = MAD_SCALE * np.median(diffs) / np.sqrt(2)
+    if sigma == 0:
+        sigma = np.std(values)
+    return sigma if sigma > 0 else 1.0
+
+
+def best_split(cumsum, start, end, min_bins):
+    """
+    Best single change point of a segment.
+
+    With prefix sums, the t-statistic of every split point of a
+    segment is computed in one vectorized pass.
+    :param cumsum: prefix sums of values, with a leading zero
+    :param start: first index of segment
+    :param end: last index of segment + 1
+    :param min_bins: minimum number of values on either side of a split
+    :return: 2-tuple of (split index, statistic in units of noise),
+        or (None, 0.0) if the segment can not be split
+    """
+    n = end - start
+    if n < 2 * min_bins:
+        return None, 0.0
+    k = np.arange(min_bins, n - min_bins + 1)
+    total = cumsum[end] - cumsum[start]
+    left = cumsum[start + k] - cumsum[start]
+    diff = left / k - (total - left) / (n - k)
+    stat = np.abs(diff) / np.sqrt(1.0 / k + 1.0 / (n - k))
+    best = int(np.argmax(stat))
+    return start + int(k[best]), float(stat[best])
+
+
+def segment_values(values, threshold=DEFAULT_THRESHOLD,
+                   min_bins=DEFAULT_MIN_BINS):
+    """
+    Segment an array of values by recursive binary segmentation.
+    A segment is split at its best change point for as long as the
+    t-statistic of that split exceeds the threshold.
+    :param values: array of finite values
+    :param threshold: minimum t-statistic of a split, in units of
+        the estimated noise level
+    :param min_bins: minimum number of values per segment
+    :return: sorted array of segment boundaries, starting with 0 and
+        ending with len(values)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    cumsum = np.concatenate([[0.0], np.cumsum(values)])
+    cutoff = threshold * noise_level(values)
+    bounds = [0, len(values)]
+    stack = [(0, len(values))]
+    while stack:
+        start, end = stack.pop()
+        split, stat = best_split(cumsum, start, end, min_bins)
+        if split is None or stat < cutoff:
+            continue
+        bounds.append(split)
+        stack.append((start, split))
+        stack.append((split, end))
+    return np.unique(bounds)
+
+
+def segment_chromosome(args):
+    """
+    Segment the values of one chromosome.
+    Bins without a finite value are skipped.
+    :param args: 5-tuple of (chromosome, starts, ends, values,
+        (threshold, min_bins))
+    :return: BedTrack of segments with their mean value
+    """
+    chromosome, starts, ends, values, (threshold, min_bins) = args
+    finite = np.isfinite(values)
+    starts, ends, values = starts[finite], ends[finite], values[finite]
+    if len(values) == 0:
+        return BedTrack([], [], [])
+    bounds = segment_values(values, threshold, min_bins)
+    cumsum = np.concatenate([[0.0], np.cumsum(values)])
+    means = (cumsum[bounds[1:]] - cumsum[bounds[:-1]]) / np.diff(bounds)
+    return BedTrack(np.full(len(means), chromosome), starts[bounds[:-1]],
+                    ends[bounds[1:] - 1], means)
+
+
+def segment_track(track, threshold=DEFAULT_THRESHOLD,
+                  min_bins=DEFAULT_MIN_BINS, threads=1):
+    """
+    Segment a track of z-scores, one chromosome at a time
+    :param track: BedTrack of z-scores, grouped by chromosome
+    :param threshold: minimum t-statistic of a split
+    :param min_bins: minimum number of bins per segment
+    :param threads: number of processes used to segment chromosomes
+        in parallel
+    :return: BedTrack of segments
+    """
+    values = track.values.astype(np.float64)
+    jobs = [(chrom, track.starts[a:b], track.ends[a:b], values[a:b],
+             (threshold, min_bins))
+            for chrom, a, b in track.chromosome_runs()]
+    if threads > 1 and len(jobs) > 1:
+        with Pool(min(threads, len(jobs))) as pool:
+            segments = pool.map(segment_chromosome, jobs)
+    else:
+        segments = [segment_chromosome(x) for x in jobs]
+    return BedTrack.concatenate(segments)
+
+
+def segment(input_path, output_path, threshold=DEFAULT_THRESHOLD,
+            min_bins=DEFAULT_MIN_BINS, threads=1):
+    """
+    Segment a z-score BED file
+    :param input_path: path to z-score BED file, or '-' for stdin
+    :param output_path: path to output BED file, or '-' for stdout
+    :param threshold: minimum t-statistic of a split
+    :param min_bins: minimum number of bins per segment
+    :param threads: number of processes
+    """
+    track = read_bed(input_path)
+    print("Segmenting", file=sys.stderr)
+    segments = segment_track(track, threshold, min_bins, threads)
+    with open_output(output_path) as ohandle:
+        write_bed(ohandle, segments)
@@ -0,0 +1,320 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.serve
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import http.client
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .cohort import sample_name
+from .utils import (STDIO, format_bed, format_layout, layout_fingerprint,
+                    open_bed, open_output, parse_bed, read_bed)
+from .ztest import MEAN, ReferenceIndex
+
+DEFAULT_HOST = "127.0.0.1"
+
+
+def parse_reference_spec(spec):
+    """
+    Parse a reference specification of the form name=path.
+    Without a name, the name is derived from the file name
+    :param spec: string
+    :return: 2-tuple of (name, path)
+    """
+    if "=" in spec:
+        name, path = spec.split("=", 1)
+        return name, path
+    return sample_name(spec), spec
+
+
+def is_loopback(host):
+    """
+    Whether a host name or address only resolves to loopback addresses
+    :param host: host name or IP address
+    :return: Boolean
+    """
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return len(infos) > 0 and all(
+        ipaddress.ip_address(x[4][0].split("%")[0]).is_loopback
+        for x in infos)
+
+
+class ScoringService(object):
+    """
+    Set of preloaded reference dictionaries that scores jobs.
+    A job names a loaded reference and either a query path or inline
+    BED data, and optionally an output path. Without an output path
+    the z-scores are returned as BED text.
+    The service has no authentication, so job paths may be confined
+    to a root directory.
+    """
+
+    def __init__(self, references, root=None):
+        """
+        Load reference dictionaries
+        :param references: dict of name: path to dictionary BED file
+        :param root: optional directory that job paths must be in.
+            Without a root, jobs may read and write any path
+        """
+        self.references = {name: ReferenceIndex.load(path)
+                           for name, path in references.items()}
+        self.root = None if root is None else os.path.realpath(root)
+
+    def check_path(self, path):
+        """
+        Check that a job path is a file within the root directory.
+        '-' is refused, as it would read the stdin or write the stdout
+        of the service; inline BED data replaces stdin for jobs
+        :param path: path
+        :return: path
+        :raises ValueError: on '-', or when the path is outside the root
+        """
+        if path == STDIO:
+            raise ValueError("Jobs can not use stdin or stdout; send "
+                             "BED data inline instead")
+        if self.root is not None:
+            real = os.path.realpath(path)
+            if os.path.commonpath([self.root, real]) != self.root:
+                raise ValueError("Path is outside of the service root: "
+                                 "{0}".format(path))
+        return path
+
+    def run(self, job):
+        """
+        Run a scoring job
+        :param job: dict with keys 'reference' (optional when only one
+            reference is loaded), 'input' (path) or 'bed' (BED text),
+            'output' (optional path) and 'statistic' (optional)
+        :return: dict with either 'output' or 'bed'
+        :raises ValueError: on invalid jobs
+        """
+        name = job.get("reference")
+        if name is None and len(self.references) == 1:
+            name = next(iter(self.references))
+        if name not in self.references:
+            raise ValueError("Unknown reference: {0}".format(name))
+        if job.get("output"):
+            self.check_path(job["output"])
+        if "bed" in job:
+            track = parse_bed(job["bed"].encode())
+        elif "input" in job:
+            track = read_bed(self.check_path(job["input"]))
+        else:
+            raise ValueError("Job must have an input or bed")
+        scored = self.references[name].score(track,
+                                             job.get("statistic", MEAN))
+        text = format_layout(layout_fingerprint(scored)) + format_bed(scored)
+        if job.get("output"):
+            with open_output(job["output"]) as ohandle:
+                ohandle.write(text)
+            return {"output": job["output"]}
+        return {"bed": text.decode()}
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler for a ScoringService.
+    GET /references lists the loaded references,
+    POST /score runs a job
+    """
+    service = None
+
+    def address_string(self):
+        # unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format, *args):
+        print(format % args, file=sys.stderr)
+
+    def send_json(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/references":
+            self.send_json(404, {"error": "Not found"})
+            return
+        self.send_json(200, {"references": sorted(self.service.references)})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length).decode())
+            result = self.service.run(job)
+        except (ValueError, KeyError, OSError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(200, result)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, socket_path=None, host=DEFAULT_HOST, port=None):
+    """
+    Create a server for a scoring service. The Unix socket is only
+    accessible to its owner
+    :param service: ScoringService
+    :param socket_path: path to Unix socket. Takes precedence over port
+    :param host: host to bind to when serving over TCP. Must be a
+        loopback address, as jobs are not authenticated
+    :param port: TCP port
+    :return: server instance
+    :raises ValueError: on a host that is not a loopback address
+    """
+    handler = type("BoundScoringHandler", (ScoringHandler,),
+                   {"service": service})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        # created with mode 600, so it is never open to other users
+        umask = os.umask(0o177)
+        try:
+            return UnixHTTPServer(socket_path, handler)
+        finally:
+            os.umask(umask)
+    if port is None:
+        raise ValueError("Either a socket path or a port is required")
+    if not is_loopback(host):
+        raise ValueError("Refusing to serve on {0}: only loopback "
+                         "addresses are allowed".format(host))
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(references, socket_path=None, host=DEFAULT_HOST, port=None,
+          root=None):
+    """
+    Load reference dictionaries and serve scoring jobs until interrupted
+    :param references: list of reference specifications (name=path)
+    :param socket_path: path to Unix socket
+    :param host: loopback host to bind to when serving over TCP
+    :param port: TCP port
+    :param root: directory that job paths must be in.
+        Defaults to the working directory
+    """
+    service = ScoringService(dict(parse_reference_spec(x)
+                                  for x in references),
+                             os.getcwd() if root is None else root)
+    server = make_server(service, socket_path, host, port)
+    print("Serving references: {0}".format(
+        ", ".join(sorted(service.references))), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(job, socket_path=None, host=DEFAULT_HOST, port=None):
+    """
+    Send a job to a scoring service
+    :param job: job dict (see ScoringService.run)
+    :param socket_path: path to Unix socket
+    :param host: host of service when using TCP
+    :param port: TCP port
+    :return: result dict
+    :raises ValueError: when the service rejects the job
+    """
+    if socket_path is not None:
+        conn = UnixHTTPConnection(socket_path)
+    elif port is not None:
+        conn = http.client.HTTPConnection(host, port)
+    else:
+        raise ValueError("Either a socket path or a port is required")
+    try:
+        body = json.dumps(job).encode()
+        conn.request("POST", "/score", body,
+                     {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        result = json.loads(response.read().decode())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise ValueError(result.get("error", "Scoring failed"))
+    return result
+
+
+def submit(input_path, output_path, reference=None, statistic=MEAN,
+           socket_path=None, host=DEFAULT_HOST, port=None):
+    """
+    Submit a query BED file to a scoring service
+    :param input_path: query bed file path, or '-' for stdin
+    :param output_path: output bed file path, or '-' for stdout
+    :param reference: name of loaded reference. Optional when the
+        service has only one reference
+    :param statistic: 'mean' or 'robust'
+    :param socket_path: path to Unix socket
+    :param host: host of service when using TCP
+    :param port: TCP port
+    """
+    job = {"statistic": statistic}
+    if reference is not None:
+        job["reference"] = reference
+    if input_path == STDIO:
+        with open_bed(STDIO) as handle:
+            job["bed"] = handle.read().decode()
+    else:
+        job["input"] = os.path.abspath(input_path)
+    if output_path != STDIO:
+        job["output"] = os.path.abspath(output_path)
+    result = request(job, socket_path, host, port)
+    if output_path == STDIO:
+        with open_output(STDIO) as ohandle:
+            ohandle.write(result["bed"].encode())
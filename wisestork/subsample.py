@@ -0,0 +1,180 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.subsample
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import zlib
+
+import numpy as np
+
+HASH_RANGE = 1 << 32
+MAX_WINDOWS = 16  # sampled windows per region
+# every fetch from a BAM index starts reading at a 16 kb boundary,
+# so windows are spaced well apart to read fewer reads than the region
+WINDOW_SPACING = 1 << 16
+
+
+def read_hash(name, seed=0):
+    """
+    Deterministic hash of a read name, uniform over [0, 2^32).
+    Both reads of a pair share a name, and so a hash
+    :param name: query name
+    :param seed: seed, to draw a different subsample
+    :return: int
+    """
+    return zlib.crc32(name.encode(), seed)
+
+
+class ReadSampler(object):
+    """
+    Deterministic subsample of the reads of a BAM file.
+
+    With an index, only windows spread over every region are fetched,
+    together covering about the fraction of the region, so only about
+    the fraction of the reads is read (see region_windows and
+    count.sample_regions).
+    Without an index, all reads are read, and a read is kept when the
+    hash of its name falls below the fraction of its chromosome, so
+    the subsample is the same on every run and pairs are kept or
+    dropped together. Counts of the subsample are scaled back by the
+    inverse fraction.
+    """
+
+    def __init__(self, fractions, seed=0, mapped=None):
+        """
+        Create instance of ReadSampler
+        :param fractions: array of fraction of reads to keep, per
+            reference id in header order
+        :param seed: seed of the read name hash
+        :param mapped: optional array of mapped reads per reference id,
+            from the index. Required for sampling regions
+        """
+        self.fractions = np.clip(np.asarray(fractions, dtype=np.float64),
+                                 0, 1)
+        self.thresholds = [int(x * HASH_RANGE) for x in self.fractions]
+        self.seed = seed
+        self.mapped = None if mapped is None else np.asarray(mapped,
+                                                             np.float64)
+
+    @property
+    def indexed(self):
+        """
+        Whether regions can be sampled from the index
+        """
+        return self.mapped is not None
+
+    @classmethod
+    def from_bam(cls, samfile, fraction=None, max_reads=None, seed=0):
+        """
+        Sampler for a BAM file. With max_reads, the fraction of every
+        chromosome is chosen from the index statistics so that about
+        max_reads reads of it are kept
+        :param samfile: an instance of pysam.AlignmentFile
+        :param fraction: fraction of reads to keep
+        :param max_reads: approximate number of reads to keep per
+            chromosome. Requires an index
+        :param seed: seed of the read name hash
+        :return: ReadSampler
+        """
+        n_refs = len(samfile.references)
+        fractions = np.ones(n_refs)
+        if fraction is not None:
+            if not 0 < fraction <= 1:
+                raise ValueError("Fraction must be in (0, 1]")
+            fractions[:] = fraction
+        mapped = None
+        if samfile.has_index():
+            mapped = np.array([x.mapped for x in
+                               samfile.get_index_statistics()],
+                              dtype=np.float64)
+        if max_reads is not None:
+            if mapped is None:
+                raise ValueError("Sampling a number of reads requires an "
+                                 "indexed BAM file")
+            with np.errstate(divide="ignore"):
+                fractions = np.minimum(fractions, max_reads / mapped)
+        return cls(fractions, seed, mapped)
+
+    def region_windows(self, rid, starts, ends, n_windows=None):
+        """
+        Windows to count per region of a reference sequence.
+        Every region is split into strata of equal length, and a window
+        of the fraction of a stratum is placed at a random offset
+        within it. Weighting the reads starting in a window by the
+        inverse of its share of the stratum estimates the reads
+        starting in the region without bias, however unevenly they
+        are spread within it
+        :param rid: reference id
+        :param starts: array of region start positions
+        :param ends: array of region end positions
+        :param n_windows: number of windows per region. Defaults to one
+            per WINDOW_SPACING of the shortest region, up to MAX_WINDOWS
+        :return: 3-tuple of (window starts, window ends, window
+            weights), arrays of shape (regions, windows).
+            None when all reads of the reference sequence are kept
+        """
+        if self.fractions[rid] >= 1:
+            return None
+        starts = np.asarray(starts, np.int64)[:, np.newaxis]
+        lengths = np.asarray(ends, np.int64)[:, np.newaxis] - starts
+        if n_windows is None:
+            shortest = int(lengths.min()) if len(lengths) > 0 else 0
+            n_windows = min(max(shortest // WINDOW_SPACING, 1), MAX_WINDOWS)
+        bounds = starts + lengths * np.arange(n_windows + 1) // n_windows
+        strata = np.diff(bounds, axis=1)
+        widths = np.minimum(np.maximum(np.rint(
+            self.fractions[rid] * lengths / n_windows), 1), strata)
+        rng = np.random.default_rng([self.seed, rid])
+        offsets = np.floor(rng.random(strata.shape) *
+                           (strata - widths + 1)).astype(np.int64)
+        win_starts = bounds[:, :-1] + offsets
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weights = np.where(widths > 0, strata / widths, 0)
+        return (win_starts, win_starts + widths.astype(np.int64),
+                weights)
+
+    def filter(self, reads):
+        """
+        Keep the reads of the subsample.
+        Reads without a reference id are passed through
+        :param reads: iterable of pysam.AlignedSegment
+        :return: generator of pysam.AlignedSegment
+        """
+        thresholds = self.thresholds
+        seed = self.seed
+        for read in reads:
+            rid = read.reference_id
+            if rid < 0 or read_hash(read.query_name, seed) < thresholds[rid]:
+                yield read
+
+    def scale(self, track, rid):
+        """
+        Scale the counts of a subsample back to full depth
+        :param track: BedTrack with counts
+        :param rid: reference id of the track
+        :return: BedTrack with scaled integer counts
+        """
+        fraction = self.fractions[rid]
+        if fraction >= 1:
+            return track
+        if fraction <= 0:
+            return track.with_values(np.zeros(len(track), np.int64))
+        return track.with_values(
+            np.rint(track.values / fraction).astype(np.int64))
@@ -24,9 +24,33 @@ wisestork.utils
 
 
 from collections import namedtuple
+from contextlib import contextmanager
+from itertools import chain, repeat
+import gzip
+import hashlib
+import io
+import math
+import queue
+import sys
+import threading
+import warnings
+
+import numpy as np
 
 Bin = namedtuple("Bin", ["start", "end"])
 
+STDIO = "-"
+GZIP_MAGIC = b"\x1f\x8b"
+DEFAULT_CHUNK_SIZE = 1 << 24  # bytes per read buffer
+DEFAULT_WRITE_CHUNK = 1 << 16  # records per formatted write
+DEFAULT_PREFETCH = 2  # chunks read ahead in the background
+SPARSE_MAGIC = b"#sparse"
+RUN_PREFIX = b"#run\t"
+LAYOUT_PREFIX = b"#layout\t"
+FINGERPRINT_LENGTH = 16  # hex digits of a layout fingerprint
+HEADER_PEEK = 1 << 12  # bytes searched for header lines
+BYTES_PER_RECORD = 32  # approximate size of a BED line
+
 
 def utf8(value):
     if isinstance(value, bytes):
@@ -106,35 +130,804 @@ def get_bins(chromosome_length, binsize):
     return [Bin(s, e) for s, e in zip(starts, ends)]
 
 
+def bin_track(chromosome, chromosome_length, binsize):
+    """
+    Get a BedTrack of consecutive bins for a given chromosome
+    :param chromosome: chromosome name
+    :param chromosome_length: integer
+    :param binsize: integer
+    :return: BedTrack with NaN values. Start = 0-based
+    """
+    starts = np.arange(0, chromosome_length, binsize, dtype=np.int64)
+    ends = np.minimum(starts + binsize, chromosome_length)
+    return BedTrack(np.full(len(starts), utf8(chromosome)), starts, ends)
+
+
 class BedReader(object):
     """
     Iterator for reading bed files
     Returns instances of BedLine
 
     If no value is found in the 4th column, val = 'NA'
+
+    Deprecated: a thin wrapper over read_bed, which reads the whole
+    file into a BedTrack at once
     """
 
     def __init__(self, filename):
+        warnings.warn("BedReader is deprecated, use read_bed instead",
+                      DeprecationWarning, stacklevel=2)
         self.filename = filename
-        self.__handle = open(self.filename, 'rb')
+        self.__lines = iter(read_bed(filename))
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        try:
-            line = self.__handle.readline()
-        except StopIteration:
-            self.__handle.close()
-            raise StopIteration
-        contents = line.strip().split(b"\t")
-        if len(contents) == 3:
-            return BedLine(*map(attempt_numeric, contents), value='NA')
-        elif len(contents) == 4:
-            return BedLine(*map(attempt_numeric, contents))
-        else:
-            self.__handle.close()
-            raise StopIteration
+        line = next(self.__lines)
+        if isinstance(line.value, float) and math.isnan(line.value):
+            return line._replace(value='NA')
+        return line
 
     def next(self):
         return self.__next__()
+
+
+class BedTrack(object):
+    """
+    Column-oriented collection of BED records.
+
+    Chromosomes are stored as a bytes array, starts and ends as int64
+    arrays and values as a numeric array (or an object array of bytes
+    for non-numeric value columns). Indexing with an integer returns a
+    BedLine, indexing with a slice or mask returns a new BedTrack.
+    """
+    __slots__ = ("chromosomes", "starts", "ends", "values")
+
+    def __init__(self, chromosomes, starts, ends, values=None):
+        self.chromosomes = np.asarray(chromosomes, dtype=np.bytes_)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        if values is None:
+            values = np.full(len(self.starts), np.nan)
+        self.values = np.asarray(values)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            value = self.values[item]
+            if isinstance(value, np.generic):
+                value = value.item()
+            return BedLine(bytes(self.chromosomes[item]),
+                           int(self.starts[item]), int(self.ends[item]),
+                           value)
+        return BedTrack(self.chromosomes[item], self.starts[item],
+                        self.ends[item], self.values[item])
+
+    def with_values(self, values):
+        """
+        Return a track with the same regions and different values
+        :param values: array of values, same length as this track
+        :return: BedTrack
+        """
+        return BedTrack(self.chromosomes, self.starts, self.ends, values)
+
+    def chromosome_runs(self):
+        """
+        Index ranges of consecutive records on the same chromosome
+        :return: list of (chromosome, first index, last index + 1)
+        :raises ValueError: when records of a chromosome are not
+            consecutive
+        """
+        if len(self) == 0:
+            return []
+        breaks = np.flatnonzero(self.chromosomes[1:] !=
+                                self.chromosomes[:-1]) + 1
+        bounds = np.concatenate([[0], breaks, [len(self)]])
+        runs = [(bytes(self.chromosomes[a]), int(a), int(b))
+                for a, b in zip(bounds[:-1], bounds[1:])]
+        if len(set(x[0] for x in runs)) != len(runs):
+            raise ValueError("Records are not grouped by chromosome")
+        return runs
+
+    @classmethod
+    def from_bedlines(cls, lines):
+        """
+        Build a track from an iterable of BedLine namedtuples
+        :param lines: iterable of BedLine
+        :return: BedTrack
+        """
+        lines = list(lines)
+        return cls([utf8(x.chromosome) for x in lines],
+                   [x.start for x in lines], [x.end for x in lines],
+                   _values_array([x.value for x in lines]))
+
+    @classmethod
+    def concatenate(cls, tracks):
+        """
+        Concatenate several tracks into one
+        :param tracks: iterable of BedTrack
+        :return: BedTrack
+        """
+        tracks = list(tracks)
+        if len(tracks) == 0:
+            return cls([], [], [])
+        if len(tracks) == 1:
+            return tracks[0]
+        return cls(np.concatenate([x.chromosomes for x in tracks]),
+                   np.concatenate([x.starts for x in tracks]),
+                   np.concatenate([x.ends for x in tracks]),
+                   np.concatenate([x.values for x in tracks]))
+
+
+class SparseTrack(object):
+    """
+    BED track over a known layout that only stores the values
+    that differ from a fill value, usually zero.
+
+    The layout is stored as runs of consecutive bins of equal size,
+    so that a layout of fixed-size bins costs one run per chromosome.
+    Each run has a chromosome, a start, an end and a bin size; its
+    last bin may be shorter. Non-fill values are stored by their
+    index in the layout.
+    """
+    __slots__ = ("run_chromosomes", "run_starts", "run_ends", "run_sizes",
+                 "offsets", "indices", "values", "fill")
+
+    def __init__(self, run_chromosomes, run_starts, run_ends, run_sizes,
+                 indices, values, fill=0):
+        self.run_chromosomes = np.asarray(run_chromosomes, dtype=np.bytes_)
+        self.run_starts = np.asarray(run_starts, dtype=np.int64)
+        self.run_ends = np.asarray(run_ends, dtype=np.int64)
+        self.run_sizes = np.asarray(run_sizes, dtype=np.int64)
+        lengths = -(-(self.run_ends - self.run_starts) // self.run_sizes)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(
+            np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.values = np.asarray(values)
+        self.fill = fill
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @classmethod
+    def from_dense(cls, track, fill=0):
+        """
+        Build a sparse track from a BedTrack
+        :param track: BedTrack with numeric values
+        :param fill: value that is not stored
+        :return: SparseTrack
+        :raises ValueError: when bins of a chromosome overlap
+        """
+        runs = layout_runs(track)
+        keep = np.flatnonzero(track.values != fill)
+        return cls(*runs, indices=keep, values=track.values[keep],
+                   fill=fill)
+
+    def positions(self, indices):
+        """
+        Chromosomes, starts and ends of bins of the layout
+        :param indices: array of bin indices
+        :return: 3-tuple of arrays
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        run = np.searchsorted(self.offsets, indices, "right") - 1
+        starts = (self.run_starts[run] +
+                  (indices - self.offsets[run]) * self.run_sizes[run])
+        ends = np.minimum(starts + self.run_sizes[run], self.run_ends[run])
+        return self.run_chromosomes[run], starts, ends
+
+    def layout(self, start=0, end=None):
+        """
+        Bins of the layout, without values
+        :param start: first bin index
+        :param end: last bin index + 1, or None for all bins
+        :return: BedTrack with NaN values
+        """
+        end = len(self) if end is None else end
+        return BedTrack(*self.positions(np.arange(start, end)))
+
+    def to_dense(self, start=0, end=None):
+        """
+        Expand to a BedTrack holding every bin
+        :param start: first bin index
+        :param end: last bin index + 1, or None for all bins
+        :return: BedTrack
+        """
+        end = len(self) if end is None else end
+        dtype = np.result_type(self.values.dtype, np.asarray(self.fill))
+        values = np.full(end - start, self.fill, dtype=dtype)
+        lo, hi = np.searchsorted(self.indices, [start, end])
+        values[self.indices[lo:hi] - start] = self.values[lo:hi]
+        return self.layout(start, end).with_values(values)
+
+    def stored(self):
+        """
+        Only the bins with non-fill values
+        :return: BedTrack
+        """
+        return BedTrack(*self.positions(self.indices), values=self.values)
+
+    def index_of(self, chromosomes, starts, ends):
+        """
+        Layout indices of bins
+        :param chromosomes: array of chromosome names
+        :param starts: array of start positions
+        :param ends: array of end positions
+        :return: int64 array of indices
+        :raises ValueError: when a bin is not in the layout
+        """
+        chromosomes = np.asarray(chromosomes, dtype=np.bytes_)
+        starts = np.asarray(starts, dtype=np.int64)
+        if len(starts) == 0:
+            return np.empty(0, dtype=np.int64)
+        if len(self.run_starts) == 0:
+            raise ValueError("Records do not match the sparse layout")
+        _, codes = np.unique(np.concatenate(
+            [self.run_chromosomes, chromosomes]), return_inverse=True)
+        run_keys = (codes[:len(self.run_starts)] << 40) + self.run_starts
+        keys = (codes[len(self.run_starts):] << 40) + starts
+        order = np.argsort(run_keys, kind="stable")
+        run = order[np.maximum(np.searchsorted(run_keys[order], keys,
+                                               "right") - 1, 0)]
+        indices = (self.offsets[run] +
+                   (starts - self.run_starts[run]) // self.run_sizes[run])
+        found = self.positions(np.clip(indices, 0, len(self) - 1))
+        if not (np.array_equal(found[0], chromosomes) and
+                np.array_equal(found[1], starts) and
+                np.array_equal(found[2], ends) and
+                np.all(indices < self.offsets[run + 1])):
+            raise ValueError("Records do not match the sparse layout")
+        return indices
+
+    def with_values(self, values, indices=None):
+        """
+        Return a sparse track with the same layout and different values
+        :param values: array of values of the stored bins
+        :param indices: optional array of bin indices of the values.
+            Defaults to the stored bins of this track
+        :return: SparseTrack
+        """
+        indices = self.indices if indices is None else indices
+        return SparseTrack(self.run_chromosomes, self.run_starts,
+                           self.run_ends, self.run_sizes, indices, values,
+                           self.fill)
+
+
+def layout_runs(track):
+    """
+    Compress the bins of a track into runs of consecutive bins
+    of equal size. A shorter bin ends a run
+    :param track: BedTrack
+    :return: 4-tuple of arrays of (chromosomes, starts, ends, bin sizes)
+    :raises ValueError: when bins of a chromosome overlap
+    """
+    runs = _bin_runs(track)
+    order = np.lexsort((runs[1], runs[0]))
+    chroms, starts, ends = (runs[0][order], runs[1][order], runs[2][order])
+    if np.any((chroms[1:] == chroms[:-1]) & (starts[1:] < ends[:-1])):
+        raise ValueError("Sparse tracks can not hold overlapping bins")
+    return runs
+
+
+def _bin_runs(track):
+    n = len(track)
+    sizes = track.ends - track.starts
+    if n == 0:
+        return (np.empty(0, np.bytes_), np.empty(0, np.int64),
+                np.empty(0, np.int64), np.empty(0, np.int64))
+    same = np.zeros(n, dtype=bool)
+    same[1:] = ((track.chromosomes[1:] == track.chromosomes[:-1]) &
+                (track.starts[1:] == track.ends[:-1]) &
+                (sizes[1:] <= sizes[:-1]))
+    firsts = np.flatnonzero(~same)
+    # a bin may only continue a run when the previous bin has the
+    # full size of the run
+    run_of = np.cumsum(~same) - 1
+    full = sizes == sizes[firsts][run_of]
+    same[1:] &= full[:-1]
+    firsts = np.flatnonzero(~same)
+    lasts = np.concatenate([firsts[1:], [n]]) - 1
+    return (track.chromosomes[firsts], track.starts[firsts],
+            track.ends[lasts], sizes[firsts])
+
+
+def layout_fingerprint(track):
+    """
+    Fingerprint of the bin layout of a track: a hash of its chromosome
+    names, starts and ends, in order. Tracks with equal fingerprints
+    have the same bins at the same positions, so that their values
+    can be combined by integer position.
+    The hash is taken over the runs of consecutive bins of equal size
+    (see layout_runs), which a SparseTrack already stores
+    :param track: BedTrack or SparseTrack
+    :return: hex string
+    """
+    if isinstance(track, SparseTrack):
+        runs = (track.run_chromosomes, track.run_starts, track.run_ends,
+                track.run_sizes)
+    else:
+        runs = _bin_runs(track)
+    digest = hashlib.sha256(b"%d\n" % len(runs[1]))
+    digest.update(b"\0".join(runs[0].tolist()) + b"\n")
+    for column in runs[1:]:
+        digest.update(column.astype("<i8").tobytes())
+    return digest.hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def format_layout(fingerprint):
+    """
+    Header line of a layout fingerprint
+    :param fingerprint: fingerprint (see layout_fingerprint)
+    :return: bytes
+    """
+    return LAYOUT_PREFIX + fingerprint.encode() + b"\n"
+
+
+def peek_fingerprint(handle):
+    """
+    Layout fingerprint in the header of an open BED file,
+    without consuming it
+    :param handle: binary file-like object supporting peek
+    :return: fingerprint, or None when the header has none
+    """
+    for line in handle.peek(HEADER_PEEK).split(b"\n")[:-1]:
+        if not line.startswith(b"#"):
+            break
+        if line.startswith(LAYOUT_PREFIX):
+            return line[len(LAYOUT_PREFIX):].rstrip(b"\r").decode()
+    return None
+
+
+class BinIndex(object):
+    """
+    Positions of bins in a layout, found by comparing integer codes of
+    their chromosomes, starts and ends. No key is built per bin.
+    """
+
+    def __init__(self, layout):
+        """
+        Create instance of BinIndex
+        :param layout: BedTrack of bins
+        """
+        names = np.unique(layout.chromosomes)
+        self.codes = {x: i for i, x in enumerate(names.tolist())}
+        keys = self._keys(np.searchsorted(names, layout.chromosomes),
+                          layout.starts)
+        self.order = np.lexsort((layout.ends, keys))
+        self.keys = keys[self.order]
+        self.ends = layout.ends[self.order]
+
+    @staticmethod
+    def _keys(codes, starts):
+        return (np.asarray(codes, dtype=np.int64) << 40) + starts
+
+    def positions(self, chromosomes, starts, ends):
+        """
+        Positions of bins in the layout
+        :param chromosomes: array of chromosome names
+        :param starts: array of start positions
+        :param ends: array of end positions
+        :return: int64 array of positions. When a bin is in the layout
+            more than once, its first position
+        :raises ValueError: when a bin is not in the layout
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if len(starts) == 0:
+            return np.empty(0, dtype=np.int64)
+        names, inverse = np.unique(np.asarray(chromosomes, dtype=np.bytes_),
+                                   return_inverse=True)
+        codes = np.array([self.codes.get(x, -1) for x in names.tolist()],
+                         dtype=np.int64)[inverse]
+        keys = self._keys(codes, starts)
+        lo = np.searchsorted(self.keys, keys, "left")
+        hi = np.searchsorted(self.keys, keys, "right")
+        found = np.minimum(lo, len(self.keys) - 1)
+        match = (codes >= 0) & (lo < hi) & (self.ends[found] == ends)
+        # several bins with the same start: search their ends
+        for i in np.flatnonzero(~match & (hi - lo > 1)):
+            j = lo[i] + np.searchsorted(self.ends[lo[i]:hi[i]], ends[i])
+            if j < hi[i] and self.ends[j] == ends[i]:
+                found[i] = j
+                match[i] = True
+        if not np.all(match):
+            raise ValueError("Bins are not in the layout")
+        return self.order[found]
+
+
+def format_sparse(track, layout=False):
+    """
+    Format a SparseTrack as sparse BED text: a '#sparse' header line
+    with the fill value, one '#run' line per run of the layout, and
+    BED lines of the stored bins
+    :param track: SparseTrack
+    :param layout: add a '#layout' line with the layout fingerprint
+        after the '#sparse' line
+    :return: bytes
+    """
+    fill = _format_value(np.array([track.fill]))
+    header = "%s\t%s\n" % (SPARSE_MAGIC.decode(), fill[0] % fill[1][0])
+    if layout:
+        header += format_layout(layout_fingerprint(track)).decode()
+    runs = "".join("#run\t%s\t%d\t%d\t%d\n" % x for x in zip(
+        track.run_chromosomes.astype(np.str_).tolist(),
+        track.run_starts.tolist(), track.run_ends.tolist(),
+        track.run_sizes.tolist()))
+    return (header + runs).encode()
+
+
+def parse_sparse(buffer):
+    """
+    Parse sparse BED text (see format_sparse)
+    :param buffer: bytes
+    :return: SparseTrack
+    """
+    lines = buffer.replace(b"\r", b"").split(b"\n")
+    if not lines[0].startswith(SPARSE_MAGIC):
+        raise ValueError("Not a sparse BED file")
+    fields = lines[0].split(b"\t")
+    fill = attempt_numeric(fields[1]) if len(fields) > 1 else 0
+    runs = [x[len(RUN_PREFIX):].split(b"\t") for x in lines
+            if x.startswith(RUN_PREFIX)]
+    if any(len(x) != 4 for x in runs):
+        raise ValueError("Malformed sparse BED run")
+    columns = list(zip(*runs)) if runs else [[], [], [], []]
+    track = SparseTrack(columns[0], [int(x) for x in columns[1]],
+                        [int(x) for x in columns[2]],
+                        [int(x) for x in columns[3]], [],
+                        np.empty(0, np.int64), fill)
+    stored = parse_bed(buffer)
+    indices = track.index_of(stored.chromosomes, stored.starts, stored.ends)
+    values = stored.values
+    if len(stored) == 0:
+        values = np.empty(0, np.asarray(fill).dtype)
+    order = np.argsort(indices, kind="stable")
+    return track.with_values(values[order], indices[order])
+
+
+def is_sparse(handle):
+    """
+    Whether an open BED file is sparse, without consuming it
+    :param handle: binary file-like object supporting peek
+    :return: bool
+    """
+    return handle.peek(len(SPARSE_MAGIC))[:len(SPARSE_MAGIC)] == SPARSE_MAGIC
+
+
+def is_sparse_file(path):
+    """
+    Whether a BED file is sparse
+    :param path: path to (possibly compressed) BED file
+    :return: bool
+    """
+    with open_bed(path) as handle:
+        return is_sparse(handle)
+
+
+def _values_array(values):
+    arr = np.asarray(values)
+    if arr.dtype.kind in "SUO":
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = [utf8(x) if isinstance(x, str) else x for x in values]
+    return arr
+
+
+def parse_value_column(tokens):
+    """
+    Convert a list of value tokens to the narrowest fitting array.
+    Integers are tried first, then floats. When neither fits, an object
+    array of the raw bytes is returned.
+    :param tokens: list of bytes
+    :return: numpy array
+    """
+    raw = np.array(tokens, dtype=np.bytes_)
+    for dtype in (np.int64, np.float64):
+        try:
+            return raw.astype(dtype)
+        except ValueError:
+            continue
+    arr = np.empty(len(tokens), dtype=object)
+    arr[:] = tokens
+    return arr
+
+
+def parse_bed(buffer):
+    """
+    Parse a buffer of complete BED lines into a BedTrack.
+    Blank lines and lines starting with '#' are skipped. Lines with
+    three columns get NaN as value. Columns beyond the fourth are ignored.
+    :param buffer: bytes containing whole lines
+    :return: BedTrack
+    :raises ValueError: on lines with an inconsistent number of columns
+        or non-integer positions
+    """
+    lines = [x for x in buffer.replace(b"\r", b"").split(b"\n")
+             if x.strip() and not x.startswith(b"#")]
+    if len(lines) == 0:
+        return BedTrack([], [], [])
+    n_tabs = list(map(bytes.count, lines, repeat(b"\t")))
+    n_fields = n_tabs[0] + 1
+    if n_fields < 3:
+        raise ValueError("Malformed BED line: {0!r}".format(lines[0]))
+    if n_tabs.count(n_tabs[0]) != len(n_tabs):
+        bad = next(x for x, n in zip(lines, n_tabs) if n != n_tabs[0])
+        raise ValueError("Inconsistent number of BED columns "
+                         "at line: {0!r}".format(bad))
+    tokens = b"\t".join(lines).split(b"\t")
+    try:
+        starts = np.array(tokens[1::n_fields], dtype=np.bytes_)
+        ends = np.array(tokens[2::n_fields], dtype=np.bytes_)
+        starts = starts.astype(np.int64)
+        ends = ends.astype(np.int64)
+    except ValueError as e:
+        raise ValueError("Malformed BED positions: {0}".format(e))
+    if n_fields == 3:
+        values = None
+    else:
+        values = parse_value_column(tokens[3::n_fields])
+    return BedTrack(tokens[0::n_fields], starts, ends, values)
+
+
+@contextmanager
+def open_bed(path):
+    """
+    Open a BED file for binary reading.
+    Plain, gzip and BGZF-compressed files are detected by their magic bytes.
+    A path of '-' reads from standard input, which is left open.
+    :param path: path to file, or '-'
+    :return: context manager yielding a binary file-like object
+    """
+    if path == STDIO:
+        stream = sys.stdin.buffer
+        if not hasattr(stream, "peek"):
+            stream = io.BufferedReader(stream)
+        if stream.peek(2)[:2] == GZIP_MAGIC:
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+        yield stream
+        return
+    with open(path, "rb") as handle:
+        magic = handle.read(2)
+    if magic == GZIP_MAGIC:
+        handle = gzip.open(path, "rb")
+    else:
+        handle = open(path, "rb")
+    with handle:
+        yield handle
+
+
+@contextmanager
+def open_output(path):
+    """
+    Open an output file for binary writing.
+    A path of '-' writes to standard output, which is flushed but left open.
+    :param path: path to file, or '-'
+    :return: context manager yielding a binary file-like object
+    """
+    if path == STDIO:
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+        return
+    with open(path, "wb") as handle:
+        yield handle
+
+
+def prefetch(iterable, depth=DEFAULT_PREFETCH):
+    """
+    Iterate over an iterable in a background thread.
+    Up to depth items are produced ahead of the consumer, so that
+    reading, decompressing and parsing the next chunks overlaps with
+    the work on the current one. Exceptions are raised in the
+    consumer. When the consumer stops early, the producer is closed
+    :param iterable: iterable, e.g. a generator of chunks
+    :param depth: maximum number of items read ahead.
+        0 iterates in the calling thread
+    :return: generator of the items of iterable
+    """
+    if depth <= 0:
+        for item in iterable:
+            yield item
+        return
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    break
+            else:
+                put((False, None))
+        except BaseException as e:
+            put((None, e))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            status, item = items.get()
+            if status is None:
+                raise item
+            if not status:
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+def iter_bed_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE,
+                    depth=DEFAULT_PREFETCH):
+    """
+    Iterate over a BED file in BedTrack chunks.
+    Chunks are read, decompressed and parsed ahead in a background
+    thread (see prefetch).
+    Sparse BED files are expanded to every bin of their layout
+    :param path: path to (possibly compressed) BED file, or '-'
+    :param chunk_size: number of bytes to read per chunk
+    :param depth: number of chunks read ahead, or 0 to read in
+        the calling thread
+    :return: generator of BedTrack
+    """
+    return prefetch(_read_bed_chunks(path, chunk_size), depth)
+
+
+def _read_bed_chunks(path, chunk_size):
+    with open_bed(path) as handle:
+        if is_sparse(handle):
+            sparse = parse_sparse(handle.read())
+            step = max(1, chunk_size // BYTES_PER_RECORD)
+            for start in range(0, len(sparse), step):
+                yield sparse.to_dense(start, min(start + step, len(sparse)))
+            return
+        for track in _iter_handle_chunks(handle, chunk_size):
+            yield track
+
+
+def _iter_handle_chunks(handle, chunk_size):
+    for block in iter_line_blocks(handle, chunk_size):
+        track = parse_bed(block)
+        if len(track) > 0:
+            yield track
+
+
+def iter_line_blocks(handle, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read an open file in blocks of whole lines
+    :param handle: binary file-like object
+    :param chunk_size: number of bytes to read per block
+    :return: generator of bytes
+    """
+    remainder = b""
+    while True:
+        block = handle.read(chunk_size)
+        if not block:
+            break
+        block = remainder + block
+        cut = block.rfind(b"\n") + 1
+        remainder = block[cut:]
+        if cut > 0:
+            yield block[:cut]
+    if remainder.strip():
+        yield remainder
+
+
+def rechunk(tracks, n_rows):
+    """
+    Re-block an iterable of BedTracks into tracks of a fixed length
+    :param tracks: iterable of BedTrack
+    :param n_rows: number of records per yielded track.
+        The last track may be shorter
+    :return: generator of BedTrack
+    """
+    buffer = []
+    buffered = 0
+    for track in tracks:
+        buffer.append(track)
+        buffered += len(track)
+        while buffered >= n_rows:
+            merged = BedTrack.concatenate(buffer)
+            yield merged[:n_rows]
+            buffer = [merged[n_rows:]]
+            buffered -= n_rows
+    if buffered > 0:
+        yield BedTrack.concatenate(buffer)
+
+
+def read_bed(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a complete BED file into a BedTrack.
+    Sparse BED files are expanded to every bin of their layout
+    :param path: path to (possibly compressed) BED file, or '-'
+    :param chunk_size: number of bytes to read per chunk
+    :return: BedTrack
+    """
+    return BedTrack.concatenate(iter_bed_chunks(path, chunk_size))
+
+
+def read_track(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a complete BED file as stored: a SparseTrack for sparse
+    BED files, and a BedTrack otherwise
+    :param path: path to (possibly compressed) BED file, or '-'
+    :param chunk_size: number of bytes to read per chunk
+    :return: BedTrack or SparseTrack
+    """
+    with open_bed(path) as handle:
+        if is_sparse(handle):
+            return parse_sparse(handle.read())
+        return BedTrack.concatenate(prefetch(
+            _iter_handle_chunks(handle, chunk_size)))
+
+
+def _format_value(values):
+    if values.dtype.kind in "iu":
+        return "%d", values.tolist()
+    if values.dtype == np.float32:
+        # shortest representation that round-trips in single precision
+        return "%s", values.astype(np.str_).tolist()
+    if values.dtype.kind == "f":
+        return "%r", values.tolist()
+    return "%s", [as_str(x) for x in values]
+
+
+def format_bed(track):
+    """
+    Format a BedTrack as BED text
+    :param track: BedTrack
+    :return: bytes
+    """
+    if len(track) == 0:
+        return b""
+    fmt, values = _format_value(track.values)
+    row = "%s\t%d\t%d\t" + fmt + "\n"
+    fields = zip(track.chromosomes.astype(np.str_).tolist(),
+                 track.starts.tolist(), track.ends.tolist(), values)
+    return ((row * len(track)) % tuple(chain.from_iterable(fields))).encode()
+
+
+def write_bed(handle, track, chunk_size=DEFAULT_WRITE_CHUNK):
+    """
+    Write a BedTrack to an open binary handle in chunks
+    :param handle: binary file-like object
+    :param track: BedTrack
+    :param chunk_size: number of records formatted per write
+    """
+    for i in range(0, len(track), chunk_size):
+        handle.write(format_bed(track[i:i+chunk_size]))
+    handle.flush()
+
+
+def write_track(handle, track, chunk_size=DEFAULT_WRITE_CHUNK, layout=False):
+    """
+    Write a BedTrack as BED, or a SparseTrack as sparse BED
+    :param handle: binary file-like object
+    :param track: BedTrack or SparseTrack
+    :param chunk_size: number of records formatted per write
+    :param layout: start with a '#layout' header line holding the
+        layout fingerprint of the track
+    """
+    if isinstance(track, SparseTrack):
+        handle.write(format_sparse(track, layout))
+        track = track.stored()
+    elif layout:
+        handle.write(format_layout(layout_fingerprint(track)))
+    write_bed(handle, track, chunk_size)
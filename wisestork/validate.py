@@ -0,0 +1,177 @@
+#    Copyright (C) 2016-2019  Sander Bollen
+#
+#    This file is part of wisestork
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see {http://www.gnu.org/licenses/}.
+"""
+wisestork.validate
+~~~~~~~~~~~~~~
+:copyright: (c) 2016-2019 Sander Bollen
+:license: GPL-3.0
+"""
+import sys
+import warnings
+
+import numpy as np
+
+from . import precision
+from .cohort import CohortStore, is_cohort, sample_name
+from .utils import STDIO, as_str, open_output, read_bed, write_bed
+from .ztest import MEAN, ReferenceIndex, z_scores
+
+DEFAULT_CUTOFF = 3.0
+DEFAULT_MAX_FRACTION = 0.1
+BIN_HEADER = "#chromosome\tstart\tend\tmean\tsd\toutlier_fraction\tunstable\n"
+SAMPLE_HEADER = "#sample\tn_bins\tmean\tsd\tmad\toutlier_fraction\n"
+
+
+def load_samples(inputs):
+    """
+    Load the values of gc-corrected samples
+    :param inputs: paths to gc-corrected BED files and/or cohort stores
+    :return: 3-tuple of (list of sample names, samples x bins matrix,
+        layout BedTrack)
+    """
+    names, rows, layouts = [], [], []
+    for inp in inputs:
+        if inp != STDIO and is_cohort(inp):
+            store = CohortStore(inp)
+            names += store.samples
+            rows.append(store.matrix())
+            layouts.append(store.layout)
+        else:
+            track = read_bed(inp)
+            names.append(sample_name(inp))
+            rows.append(precision.as_values(track.values[np.newaxis, :]))
+            layouts.append(track)
+    if len(rows) == 0:
+        raise ValueError("No samples to validate")
+    layout = layouts[0]
+    for other in layouts[1:]:
+        if not (len(other) == len(layout) and
+                np.array_equal(other.starts, layout.starts) and
+                np.array_equal(other.ends, layout.ends) and
+                np.array_equal(other.chromosomes, layout.chromosomes)):
+            raise ValueError("Input files do not match the bin layout")
+    return names, np.concatenate(rows), layout.with_values(None)
+
+
+def bin_statistics(z, cutoff=DEFAULT_CUTOFF,
+                   max_fraction=DEFAULT_MAX_FRACTION):
+    """
+    Noise statistics of every bin over all samples.
+    A bin is unstable when more than max_fraction of the samples
+    with a z-score have an absolute z-score of at least cutoff
+    :param z: samples x bins matrix of z-scores
+    :param cutoff: absolute z-score of an outlier
+    :param max_fraction: maximum fraction of outlier samples of
+        a stable bin
+    :return: 4-tuple of arrays of (mean, standard deviation,
+        outlier fraction, unstable)
+    """
+    finite = np.isfinite(z)
+    counts = finite.sum(axis=0)
+    filled = np.where(finite, z, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=0) / counts
+        dev = np.where(finite, z - mean, 0)
+        sd = np.sqrt((dev * dev).sum(axis=0) / counts)
+        fraction = (np.abs(filled) >= cutoff).sum(axis=0) / counts
+    unstable = (counts > 0) & (fraction > max_fraction)
+    return mean, sd, fraction, unstable
+
+
+def sample_statistics(z, cutoff=DEFAULT_CUTOFF):
+    """
+    Noise statistics of every sample over all bins
+    :param z: samples x bins matrix of z-scores
+    :param cutoff: absolute z-score of an outlier
+    :return: 5-tuple of arrays of (number of bins with a z-score,
+        mean, standard deviation, median absolute deviation,
+        outlier fraction)
+    """
+    counts = np.isfinite(z).sum(axis=1)
+    with warnings.catch_warnings():
+        # samples without any z-score give NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(z, axis=1)
+        sd = np.nanstd(z, axis=1)
+        median = np.nanmedian(z, axis=1)
+        mad = np.nanmedian(np.abs(z - median[:, np.newaxis]), axis=1)
+        fraction = (np.abs(np.nan_to_num(z)) >= cutoff).sum(axis=1) / counts
+    return counts, mean, sd, mad, fraction
+
+
+def format_bin_statistics(layout, stats):
+    """
+    Format per-bin statistics as TSV
+    :param layout: BedTrack of bins
+    :param stats: output of bin_statistics
+    :return: bytes
+    """
+    mean, sd, fraction, unstable = stats
+    fmt = "%s\t%d\t%d\t%r\t%r\t%r\t%d\n"
+    rows = zip([as_str(x) for x in layout.chromosomes.tolist()],
+               layout.starts.tolist(), layout.ends.tolist(), mean.tolist(),
+               sd.tolist(), fraction.tolist(), unstable.astype(int).tolist())
+    return (BIN_HEADER + "".join(fmt % x for x in rows)).encode()
+
+
+def format_sample_statistics(names, stats):
+    """
+    Format per-sample statistics as TSV
+    :param names: list of sample names
+    :param stats: output of sample_statistics
+    :return: bytes
+    """
+    fmt = "%s\t%d\t%r\t%r\t%r\t%r\n"
+    rows = zip(names, *[x.tolist() for x in stats])
+    return (SAMPLE_HEADER + "".join(fmt % x for x in rows)).encode()
+
+
+def validate(input_paths, database_path, bins_output, samples_output=None,
+             unstable_output=None, statistic=MEAN, cutoff=DEFAULT_CUTOFF,
+             max_fraction=DEFAULT_MAX_FRACTION):
+    """
+    Score every sample of a cohort against a reference and report
+    the noise of every bin and every sample
+    :param input_paths: paths to gc-corrected BED files and/or
+        cohort stores
+    :param database_path: path to reference dictionary
+    :param bins_output: path to per-bin statistics TSV, or '-'
+    :param samples_output: optional path to per-sample statistics TSV
+    :param unstable_output: optional path to BED file of unstable bins
+    :param statistic: 'mean' or 'robust'
+    :param cutoff: absolute z-score of an outlier
+    :param max_fraction: maximum fraction of outlier samples of
+        a stable bin
+    """
+    index = ReferenceIndex.load(database_path)
+    names, matrix, layout = load_samples(input_paths)
+    print("Calculating Z-scores of {0} samples".format(len(names)),
+          file=sys.stderr)
+    z = z_scores(matrix, index.align(layout), statistic)
+    bins = bin_statistics(z, cutoff, max_fraction)
+    print("{0} of {1} bins unstable".format(int(bins[3].sum()), len(layout)),
+          file=sys.stderr)
+    with open_output(bins_output) as ohandle:
+        ohandle.write(format_bin_statistics(layout, bins))
+    if samples_output is not None:
+        with open_output(samples_output) as ohandle:
+            ohandle.write(format_sample_statistics(
+                names, sample_statistics(z, cutoff)))
+    if unstable_output is not None:
+        unstable = layout[bins[3]].with_values(bins[2][bins[3]])
+        with open_output(unstable_output) as ohandle:
+            write_bed(ohandle, unstable)
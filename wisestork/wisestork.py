@@ -22,11 +22,21 @@ wisestork.wisestork
 :license: GPL-3.0
 """
 
+import os
+
 import click
 
+from . import kernels, precision
+from .batch import batch, physical_memory
+from .cache import DEFAULT_CACHE_SIZE
+from .cohort import cohort_build
 from .count import count
 from .gc_correct import gc_correct
-from .newref import newref
+from .newref import newref, newref_medians, newref_merge, parse_shard
+from .plot import DEFAULT_DPI, DEFAULT_HEIGHT, DEFAULT_WIDTH, plot
+from .segment import DEFAULT_MIN_BINS, DEFAULT_THRESHOLD, segment
+from .serve import DEFAULT_HOST, is_loopback, serve, submit
+from .validate import DEFAULT_CUTOFF, DEFAULT_MAX_FRACTION, validate
 from .ztest import ztest
 from . import version as wiseguy_version
 
@@ -44,6 +54,35 @@ shared_options = [
 ]
 
 
+cache_options = [
+    click.option("--cache-dir", type=click.Path(file_okay=False),
+                 default=None, envvar="WISESTORK_CACHE_DIR",
+                 help="Directory of cached results. When the inputs and "
+                      "parameters match an earlier run, its output is "
+                      "reused. Can also be set with WISESTORK_CACHE_DIR"),
+    click.option("--cache-size", type=click.IntRange(1, None),
+                 default=DEFAULT_CACHE_SIZE >> 20,
+                 help="Maximum size of the cache in MiB. Least recently "
+                      "used results are removed first. "
+                      "Default = {0}".format(DEFAULT_CACHE_SIZE >> 20)),
+    click.option("--no-cache", is_flag=True,
+                 help="Do not use the cache, even if a cache directory "
+                      "is set")
+]
+
+
+def cache_settings(kwargs):
+    """
+    Cache directory and size from parsed cache options
+    :param kwargs: parsed options
+    :return: 2-tuple of (cache directory or None, size in bytes)
+    """
+    cache_dir = kwargs.get("cache_dir", None)
+    if kwargs.get("no_cache", False):
+        cache_dir = None
+    return cache_dir, kwargs.get("cache_size", DEFAULT_CACHE_SIZE >> 20) << 20
+
+
 def generic_option(options):
     """
     Decorator to add generic options to Click CLI's
@@ -60,10 +99,42 @@ def generic_option(options):
 
 @click.command(short_help="Count coverages")
 @generic_option(shared_options)
-@click.option("--output", "-O", type=click.Path(), required=True,
-              help="Path to output BED file")
-@click.option("--input", "-I", type=click.Path(exists=True), required=True,
-              help="Path to input BAM file")
+@generic_option(cache_options)
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to output BED file, or - for stdout")
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True,
+              help="Path to input BAM file, or - for a sorted BAM on stdin")
+@click.option("--resume", is_flag=True,
+              help="Continue an interrupted run from its checkpoint")
+@click.option("--by-read-group", "-G", is_flag=True,
+              help="Count reads per read group in a single pass. The "
+                   "output path must contain {group}")
+@click.option("--group-tag", type=click.STRING, default=None,
+              help="Count reads per value of this tag in a single pass, "
+                   "instead of per read group. The output path must "
+                   "contain {group}")
+@click.option("--metrics", "-m", type=click.Path(allow_dash=True),
+              default=None,
+              help="Path to QC metrics file, written from the same pass "
+                   "over the reads as the counts. Paths ending in .json "
+                   "get JSON, other paths TSV")
+@click.option("--fraction", type=click.FloatRange(0, 1), default=None,
+              help="Read about this fraction of the reads, and estimate "
+                   "the counts at full depth. With an index, every bin "
+                   "is estimated from windows spread over it. Without one, "
+                   "reads are sampled by name, so pairs stay together")
+@click.option("--max-reads", type=click.IntRange(1, None), default=None,
+              help="Count a deterministic subsample of about this many "
+                   "reads per chromosome, and scale the counts to full "
+                   "depth. Requires an indexed BAM file")
+@click.option("--seed", type=click.INT, default=0,
+              help="Seed of the subsample by name, for input without "
+                   "an index. Default = 0")
+@click.option("--sparse", is_flag=True,
+              help="Write a sparse BED file, which holds the bin layout "
+                   "and only the bins with reads")
 def count_cli(**kwargs):
     """
     Take a BAM file, and calculate the number of reads per bin.
@@ -72,23 +143,63 @@ def count_cli(**kwargs):
 
     \b
     Your BAM file _must_ be indexed and _must_ contain chromosome
-    lengths and names in the header.
+    lengths and names in the header. A BAM streamed on stdin does
+    not need an index, but must be sorted by coordinate.
+
+    \b
+    When counting from a BAM file to an output file by bin size,
+    a checkpoint is kept next to the output after every
+    chromosome. An interrupted run continues with --resume.
+
+    \b
+    A BAM file holding several read groups can be counted
+    per read group in one pass with --by-read-group, writing
+    one BED file per group, e.g. with -O counts/{group}.bed.
+
+    \b
+    With --metrics, read counts, mapping qualities, duplicate and
+    secondary fractions, per-chromosome totals and coverage
+    evenness are collected during the same pass.
+
+    \b
+    For fast triage, --fraction or --max-reads read only a
+    deterministic part of the reads of an indexed BAM file.
     """
     input = kwargs.get("input", None)
     output = kwargs.get("output", None)
     binsize = kwargs.get("binsize", 50000)
     reference = kwargs.get("reference", None)
     regions = kwargs.get("bin_file", None)
-    count(input=input, output=output, binsize=binsize, reference=reference,
-          binfile=regions)
+    group_tag = kwargs.get("group_tag", None)
+    if group_tag is None and kwargs.get("by_read_group", False):
+        group_tag = "RG"
+    if output == "-" and kwargs.get("metrics", None) == "-":
+        raise click.UsageError("--output and --metrics can not both "
+                               "be stdout")
+    try:
+        cache_dir, cache_size = cache_settings(kwargs)
+        count(input=input, output=output, binsize=binsize,
+              reference=reference, binfile=regions,
+              resume=kwargs.get("resume", False), group_tag=group_tag,
+              cache_dir=cache_dir, cache_size=cache_size,
+              metrics_output=kwargs.get("metrics", None),
+              fraction=kwargs.get("fraction", None),
+              max_reads=kwargs.get("max_reads", None),
+              seed=kwargs.get("seed", 0),
+              sparse=kwargs.get("sparse", False))
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 
 @click.command(short_help="GC correct")
 @generic_option(shared_options)
-@click.option("--output", "-O", type=click.Path(), required=True,
-              help="Path to output BED file")
-@click.option("--input", "-I", type=click.Path(exists=True), required=True,
-              help="Path to input BED file")
+@generic_option(cache_options)
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to output BED file, or - for stdout")
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True,
+              help="Path to input BED file, or - for stdin")
 @click.option("--frac-n", "-n", type=click.FLOAT, default=0.1,
               help="Maximum fraction of N-bases per bin. Default = 0.1")
 @click.option("--frac-r", "-r", type=click.FLOAT, default=0.0001,
@@ -109,19 +220,29 @@ def gcc_cli(**kwargs):
     frac_r = kwargs.get("frac_r", 0.0001)
     iter = kwargs.get("iter", 3)
     frac_lowess = kwargs.get("frac_lowess", 0.1)
+    cache_dir, cache_size = cache_settings(kwargs)
     gc_correct(input=input_path, output=output, reference=reference,
                frac_r=frac_r, frac_n=frac_n, iter=iter,
-               frac_lowess=frac_lowess)
+               frac_lowess=frac_lowess, cache_dir=cache_dir,
+               cache_size=cache_size)
 
 
 @click.command(short_help="Calculate Z-scores")
 @generic_option(shared_options)
-@click.option("--input", "-I", type=click.Path(exists=True), required=True,
-              help="Path to input BED file")
-@click.option("--output", "-O", type=click.Path(), required=True,
-              help="Path to output BED file")
-@click.option("--dictionary-file", "-D", type=click.Path(), required=True,
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True,
+              help="Path to input BED file, or - for stdin")
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to output BED file, or - for stdout")
+@click.option("--dictionary-file", "-D", type=click.Path(exists=True),
+              required=True,
               help="Path to dictionary BED file")
+@click.option("--statistic", type=click.Choice(["mean", "robust"]),
+              default="mean",
+              help="Location and scale of reference bins. 'mean' uses "
+                   "mean and standard deviation, 'robust' uses median and "
+                   "median absolute deviation. Default = mean")
 def zscore_cli(**kwargs):
     """
     Calculate Z-scores from GC-corrected BED files.
@@ -129,28 +250,208 @@ def zscore_cli(**kwargs):
     \b
     You must supply a "reference dictionary" BED file
     containing locations of reference bins.
-    This reference dictionary must be gzipped and
-    indexed with tabix.
+    This reference dictionary must be sorted in the same
+    order as the query BED file.
 
     \b
-    Your query BED file should also be gzipped and
-    indexed with tabix
+    Both files may be plain, gzipped or bgzipped.
     """
     input_path = kwargs.get("input", None)
     output_path = kwargs.get("output", None)
     database = kwargs.get("dictionary_file", None)
+    statistic = kwargs.get("statistic", "mean")
     ztest(input_path=input_path, output_path=output_path,
-          database_path=database)
+          database_path=database, statistic=statistic)
 
 
-@click.command(short_help="Create new reference")
+@click.command(short_help="Run a batch of samples")
 @generic_option(shared_options)
-@click.option("--input", "-I", type=click.Path(exists=True), required=True,
-              multiple=True, help="Path(s) to input BEDs")
+@click.option("--manifest", "-M", type=click.Path(exists=True),
+              required=True,
+              help="Path to manifest of samples. One sample per line, "
+                   "as a name and a BAM path separated by a tab, or "
+                   "only a BAM path")
+@click.option("--output", "-O", type=click.Path(file_okay=False),
+              required=True,
+              help="Path to output directory")
+@click.option("--dictionary-file", "-D", type=click.Path(exists=True),
+              required=True,
+              help="Path to dictionary BED file")
+@click.option("--frac-n", "-n", type=click.FLOAT, default=0.1,
+              help="Maximum fraction of N-bases per bin. Default = 0.1")
+@click.option("--frac-r", "-r", type=click.FLOAT, default=0.0001,
+              help="Minimum fraction of reads per bin. Default = 0.0001")
+@click.option("--iter", "-t", type=click.INT, default=3,
+              help="Number of iterations for LOWESS function. Default = 3")
+@click.option("--frac-lowess", "-l", type=click.FLOAT, default=0.1,
+              help="Fraction of data to use for LOWESS function. "
+                   "Default = 0.1")
+@click.option("--statistic", type=click.Choice(["mean", "robust"]),
+              default="mean",
+              help="Location and scale of reference bins. Default = mean")
+@click.option("--jobs", "-j", type=click.IntRange(1, None), default=None,
+              help="Maximum number of worker processes. "
+                   "Default = number of CPUs")
+@click.option("--memory-limit", "-m", type=click.IntRange(1, None),
+              default=None,
+              help="Memory budget in MiB. Stages are only started when "
+                   "their estimated memory fits the budget. "
+                   "Default = physical memory")
+def batch_cli(**kwargs):
+    """
+    Count, GC-correct and calculate Z-scores for a batch of BAM files.
+
+    \b
+    Samples are processed in a pool of worker processes.
+    The GC content of the bins and the reference dictionary
+    are loaded once and shared by all workers. A stage is
+    started when a worker is free and its estimated memory
+    fits the budget. Every sample gets <name>.count.bed,
+    <name>.gc.bed and <name>.z.bed in the output directory.
+    """
+    memory_limit = kwargs.get("memory_limit", None)
+    if memory_limit is not None:
+        memory_limit *= 1024 * 1024
+    else:
+        memory_limit = physical_memory()
+    try:
+        batch(manifest=kwargs.get("manifest", None),
+              output_dir=kwargs.get("output", None),
+              reference=kwargs.get("reference", None),
+              database_path=kwargs.get("dictionary_file", None),
+              binsize=kwargs.get("binsize", 50000),
+              binfile=kwargs.get("bin_file", None),
+              frac_n=kwargs.get("frac_n", 0.1),
+              frac_r=kwargs.get("frac_r", 0.0001),
+              iter=kwargs.get("iter", 3),
+              frac_lowess=kwargs.get("frac_lowess", 0.1),
+              statistic=kwargs.get("statistic", "mean"),
+              jobs=kwargs.get("jobs", None) or os.cpu_count() or 1,
+              memory_limit=memory_limit)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@click.command(short_help="Segment Z-scores")
+@click.version_option(version=wiseguy_version())
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True,
+              help="Path to Z-score BED file, or - for stdin")
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to output BED file, or - for stdout")
+@click.option("--threshold", "-t", type=click.FloatRange(0, None),
+              default=DEFAULT_THRESHOLD,
+              help="Minimum t-statistic of a change point, in units of the "
+                   "estimated noise. Default = {0}".format(DEFAULT_THRESHOLD))
+@click.option("--min-bins", "-n", type=click.IntRange(1, None),
+              default=DEFAULT_MIN_BINS,
+              help="Minimum number of bins per segment. "
+                   "Default = {0}".format(DEFAULT_MIN_BINS))
+@click.option("--threads", "-j", type=click.IntRange(1, None), default=1,
+              help="Number of chromosomes to segment in parallel. "
+                   "Default = 1")
+def segment_cli(**kwargs):
+    """
+    Segment a Z-score BED file into regions of constant Z-score.
+
+    \b
+    Every chromosome is segmented by recursive binary
+    segmentation. The output BED file contains one record
+    per segment, with the mean Z-score of its bins.
+    Bins without a Z-score are ignored.
+    """
+    segment(input_path=kwargs.get("input", None),
+            output_path=kwargs.get("output", None),
+            threshold=kwargs.get("threshold", DEFAULT_THRESHOLD),
+            min_bins=kwargs.get("min_bins", DEFAULT_MIN_BINS),
+            threads=kwargs.get("threads", 1))
+
+
+@click.command(short_help="Plot a track")
+@click.version_option(version=wiseguy_version())
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True,
+              help="Path to count, gc-corrected or Z-score BED file, "
+                   "or - for stdin")
 @click.option("--output", "-O", type=click.Path(), required=True,
-              help="Path to output BED file")
+              help="Path to output image. The format follows the "
+                   "extension, e.g. .png, .svg or .pdf")
+@click.option("--chromosome", "-c", type=click.STRING, default=None,
+              help="Plot only this chromosome. Default = whole genome")
+@click.option("--width", type=click.IntRange(1, None),
+              default=DEFAULT_WIDTH,
+              help="Width in pixels. Default = {0}".format(DEFAULT_WIDTH))
+@click.option("--height", type=click.IntRange(1, None),
+              default=DEFAULT_HEIGHT,
+              help="Height in pixels. Default = {0}".format(DEFAULT_HEIGHT))
+@click.option("--dpi", type=click.IntRange(1, None), default=DEFAULT_DPI,
+              help="Resolution. Default = {0}".format(DEFAULT_DPI))
+@click.option("--label", "-l", type=click.STRING, default="Value",
+              help="Y-axis label. Default = Value")
+@click.option("--title", "-t", type=click.STRING, default=None,
+              help="Optional plot title")
+def plot_cli(**kwargs):
+    """
+    Plot a BED track of counts, gc-corrected values or Z-scores.
+
+    \b
+    Values are reduced to their minimum, maximum and mean
+    per pixel column before drawing, so plotting time and
+    file size depend on the image width rather than the
+    number of bins.
+    """
+    try:
+        plot(input_path=kwargs.get("input", None),
+             output_path=kwargs.get("output", None),
+             chromosome=kwargs.get("chromosome", None),
+             width=kwargs.get("width", DEFAULT_WIDTH),
+             height=kwargs.get("height", DEFAULT_HEIGHT),
+             dpi=kwargs.get("dpi", DEFAULT_DPI),
+             label=kwargs.get("label", "Value"),
+             title=kwargs.get("title", None))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@click.command(short_help="Create new reference")
+@generic_option(shared_options)
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              multiple=True,
+              help="Path(s) to input BEDs or cohort stores. "
+                   "One of these may be - for stdin. Not needed with "
+                   "--medians")
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to output BED file, or - for stdout")
 @click.option("--n-bins", "-n", type=click.INT, default=250,
               help="Amount of neighbours bins to consider per bin")
+@click.option("--memory-limit", "-m", type=click.IntRange(1, None),
+              default=None,
+              help="Approximate memory budget in MiB. When given, inputs "
+                   "are processed in chunks of bins that fit this budget")
+@click.option("--update", "-u", is_flag=True,
+              help="Append the input BEDs to the single input cohort store "
+                   "and build the reference from the updated store")
+@click.option("--selection", type=click.Choice(["median", "profile"]),
+              default="median",
+              help="Neighbour selection. 'median' takes a window of bins "
+                   "sorted by median value, 'profile' takes the bins with "
+                   "the most similar values across all samples. "
+                   "Default = median")
+@click.option("--metric", type=click.Choice(["euclidean", "correlation"]),
+              default="euclidean",
+              help="Distance metric for profile selection. "
+                   "Default = euclidean")
+@click.option("--medians", type=click.Path(exists=True), default=None,
+              help="Path to medians file from newref-medians, used "
+                   "instead of the inputs. Only for median selection")
+@click.option("--shard", type=click.STRING, default=None,
+              help="Only write the i-th of N ranges of bins, as i/N. "
+                   "Shards are combined with newref-merge")
+@click.option("--resume", is_flag=True,
+              help="Keep a checkpoint while writing, and continue an "
+                   "interrupted run from its checkpoint")
 def newref_cli(**kwargs):
     """
     Create a new reference dictionary BED file.
@@ -162,6 +463,10 @@ def newref_cli(**kwargs):
 
     \b
     You must short and then tabix the output after running this tool.
+
+    \b
+    With --resume, a checkpoint is kept next to the output file.
+    An interrupted run continues when repeated with --resume.
     """
     input_path = kwargs.get("input", None)
     output_path = kwargs.get("output", None)
@@ -169,13 +474,263 @@ def newref_cli(**kwargs):
     binsize = kwargs.get("binsize", 50000)
     n_bins = kwargs.get("n_bins", 250)
     regions = kwargs.get("bin_file", None)
-    newref(input_paths=input_path, output_path=output_path,
-           reference=reference_fasta,
-           binsize=binsize, n_bins=n_bins, binfile=regions)
+    memory_limit = kwargs.get("memory_limit", None)
+    if memory_limit is not None:
+        memory_limit *= 1024 * 1024
+    update = kwargs.get("update", False)
+    selection = kwargs.get("selection", "median")
+    metric = kwargs.get("metric", "euclidean")
+    medians_path = kwargs.get("medians", None)
+    if not input_path and medians_path is None:
+        raise click.UsageError("Either --input or --medians is required")
+    shard = kwargs.get("shard", None)
+    try:
+        if shard is not None:
+            shard = parse_shard(shard)
+        newref(input_paths=input_path, output_path=output_path,
+               reference=reference_fasta,
+               binsize=binsize, n_bins=n_bins, binfile=regions,
+               memory_limit=memory_limit, update=update,
+               selection=selection, metric=metric,
+               medians_path=medians_path, shard=shard,
+               resume=kwargs.get("resume", False))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@click.command(short_help="Compute per-bin medians")
+@generic_option(shared_options)
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True, multiple=True,
+              help="Path(s) to input BEDs or cohort stores. "
+                   "One of these may be - for stdin")
+@click.option("--output", "-O", type=click.Path(), required=True,
+              help="Path to output medians file")
+@click.option("--memory-limit", "-m", type=click.IntRange(1, None),
+              default=None,
+              help="Approximate memory budget in MiB")
+def newref_medians_cli(**kwargs):
+    """
+    Compute the per-bin medians of the reference samples.
+
+    \b
+    The medians file is shared by all shards of a
+    reference build (see newref --medians and --shard).
+    """
+    memory_limit = kwargs.get("memory_limit", None)
+    if memory_limit is not None:
+        memory_limit *= 1024 * 1024
+    newref_medians(input_paths=kwargs.get("input", None),
+                   output_path=kwargs.get("output", None),
+                   reference=kwargs.get("reference", None),
+                   binsize=kwargs.get("binsize", 50000),
+                   binfile=kwargs.get("bin_file", None),
+                   memory_limit=memory_limit)
+
+
+@click.command(short_help="Merge reference shards")
+@click.version_option(version=wiseguy_version())
+@click.option("--input", "-I", type=click.Path(exists=True), required=True,
+              multiple=True,
+              help="Paths to all shard outputs of newref, in any order")
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to output BED file, or - for stdout")
+def newref_merge_cli(**kwargs):
+    """
+    Merge the shards of a reference build into one
+    reference dictionary.
+
+    \b
+    All shards 1 to N of the same build must be given.
+    """
+    try:
+        newref_merge(shard_paths=kwargs.get("input", None),
+                     output_path=kwargs.get("output", None))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@click.command(short_help="Validate a reference")
+@click.version_option(version=wiseguy_version())
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True, multiple=True,
+              help="Path(s) to gc-corrected BEDs or cohort stores of the "
+                   "reference samples")
+@click.option("--dictionary-file", "-D", type=click.Path(exists=True),
+              required=True,
+              help="Path to dictionary BED file")
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to per-bin statistics TSV, or - for stdout")
+@click.option("--sample-output", "-s", type=click.Path(allow_dash=True),
+              default=None,
+              help="Optional path to per-sample statistics TSV")
+@click.option("--unstable-output", "-u", type=click.Path(allow_dash=True),
+              default=None,
+              help="Optional path to BED file of unstable bins")
+@click.option("--statistic", type=click.Choice(["mean", "robust"]),
+              default="mean",
+              help="Location and scale of reference bins. Default = mean")
+@click.option("--cutoff", "-c", type=click.FloatRange(0, None),
+              default=DEFAULT_CUTOFF,
+              help="Absolute Z-score of an outlier. "
+                   "Default = {0}".format(DEFAULT_CUTOFF))
+@click.option("--max-fraction", "-f", type=click.FloatRange(0, 1),
+              default=DEFAULT_MAX_FRACTION,
+              help="Bins with more than this fraction of outlier samples "
+                   "are unstable. Default = {0}".format(DEFAULT_MAX_FRACTION))
+def validate_cli(**kwargs):
+    """
+    Validate a reference dictionary against its own samples.
+
+    \b
+    Z-scores of all samples are calculated in one pass.
+    Per bin, the mean and standard deviation of the Z-scores
+    over all samples and the fraction of outlier samples are
+    reported. Bins with too many outliers are flagged as
+    unstable. Per sample, the spread of its Z-scores is
+    reported.
+    """
+    validate(input_paths=kwargs.get("input", None),
+             database_path=kwargs.get("dictionary_file", None),
+             bins_output=kwargs.get("output", None),
+             samples_output=kwargs.get("sample_output", None),
+             unstable_output=kwargs.get("unstable_output", None),
+             statistic=kwargs.get("statistic", "mean"),
+             cutoff=kwargs.get("cutoff", DEFAULT_CUTOFF),
+             max_fraction=kwargs.get("max_fraction", DEFAULT_MAX_FRACTION))
+
+
+@click.command(short_help="Build cohort matrix")
+@click.version_option(version=wiseguy_version())
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True, multiple=True,
+              help="Path(s) to gc-corrected input BEDs")
+@click.option("--output", "-O", type=click.Path(), required=True,
+              help="Path to cohort store directory")
+@click.option("--name", "-N", type=click.STRING, multiple=True,
+              help="Sample name(s), one per input. "
+                   "Default = input file names")
+@click.option("--append", "-a", is_flag=True,
+              help="Append samples to an existing cohort store")
+def cohort_build_cli(**kwargs):
+    """
+    Pack gc-corrected BED files into a cohort store.
+
+    \b
+    A cohort store holds a memory-mappable samples x bins
+    matrix, the shared bin layout and the sample names.
+    It can be passed to newref in place of the individual
+    BED files.
+    """
+    input_paths = kwargs.get("input", None)
+    output_path = kwargs.get("output", None)
+    names = kwargs.get("name", None)
+    append = kwargs.get("append", False)
+    cohort_build(input_paths=input_paths, output_path=output_path,
+                 names=names, append=append)
+
+
+service_options = [
+    click.option("--socket", "-S", type=click.Path(), default=None,
+                 help="Path to Unix socket of the service"),
+    click.option("--port", "-P", type=click.IntRange(1, 65535),
+                 default=None,
+                 help="TCP port of the service, when not using a socket"),
+    click.option("--host", type=click.STRING, default=DEFAULT_HOST,
+                 help="Loopback host of the service. "
+                      "Default = " + DEFAULT_HOST)
+]
+
+
+@click.command(short_help="Serve Z-score jobs")
+@click.version_option(version=wiseguy_version())
+@generic_option(service_options)
+@click.option("--dictionary-file", "-D", type=click.STRING, required=True,
+              multiple=True,
+              help="Reference dictionary to load, as name=path or path. "
+                   "May be given multiple times")
+@click.option("--root", type=click.Path(exists=True, file_okay=False),
+              default=None,
+              help="Directory that input and output paths of jobs must "
+                   "be in. Default = working directory")
+def serve_cli(**kwargs):
+    """
+    Run a resident Z-score service.
+
+    \b
+    Reference dictionaries are loaded once, after which
+    scoring jobs are accepted over a Unix socket or a
+    localhost TCP port until interrupted.
+    Jobs are submitted with the submit subcommand.
+    Jobs are not authenticated, so the service only binds
+    to loopback addresses and only reads and writes paths
+    under its root directory.
+    """
+    socket_path = kwargs.get("socket", None)
+    port = kwargs.get("port", None)
+    if socket_path is None and port is None:
+        raise click.UsageError("Either --socket or --port is required")
+    host = kwargs.get("host", DEFAULT_HOST)
+    if socket_path is None and not is_loopback(host):
+        raise click.UsageError("--host must be a loopback address")
+    serve(references=kwargs.get("dictionary_file", ()),
+          socket_path=socket_path, host=host, port=port,
+          root=kwargs.get("root", None))
+
+
+@click.command(short_help="Submit Z-score job")
+@click.version_option(version=wiseguy_version())
+@generic_option(service_options)
+@click.option("--input", "-I", type=click.Path(exists=True, allow_dash=True),
+              required=True,
+              help="Path to input BED file, or - for stdin")
+@click.option("--output", "-O", type=click.Path(allow_dash=True),
+              required=True,
+              help="Path to output BED file, or - for stdout")
+@click.option("--dictionary", "-D", type=click.STRING, default=None,
+              help="Name of the loaded reference dictionary. Optional "
+                   "when the service has loaded only one")
+@click.option("--statistic", type=click.Choice(["mean", "robust"]),
+              default="mean",
+              help="Location and scale of reference bins. Default = mean")
+def submit_cli(**kwargs):
+    """
+    Calculate Z-scores with a running service.
+
+    \b
+    Paths are resolved to absolute paths, and are read
+    and written by the service process.
+    """
+    socket_path = kwargs.get("socket", None)
+    port = kwargs.get("port", None)
+    if socket_path is None and port is None:
+        raise click.UsageError("Either --socket or --port is required")
+    try:
+        submit(input_path=kwargs.get("input", None),
+               output_path=kwargs.get("output", None),
+               reference=kwargs.get("dictionary", None),
+               statistic=kwargs.get("statistic", "mean"),
+               socket_path=socket_path,
+               host=kwargs.get("host", DEFAULT_HOST), port=port)
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 
 @click.group()
 @click.version_option()
+@click.option("--kernels", type=click.Choice(kernels.BACKENDS),
+              default=None, envvar=kernels.BACKEND_ENV,
+              help="Backend of the bin-level kernels. 'numba' uses "
+                   "compiled kernels and requires numba, 'numpy' the "
+                   "pure NumPy kernels, 'auto' numba when installed. "
+                   "Defaults to $WISESTORK_KERNELS, or auto")
+@click.option("--precision", type=click.Choice(precision.PRECISIONS),
+              default=None, envvar=precision.PRECISION_ENV,
+              help="Numeric precision. 'single' stores counts as uint32 "
+                   "and values as float32, halving the memory of large "
+                   "matrices. Defaults to $WISESTORK_PRECISION, or double")
 def cli(**kwargs):
     """
     Discover CNVs from BAM files.
@@ -191,17 +746,41 @@ def cli(**kwargs):
      - count: count coverage per bin
      - gc-correct: GC-correct bins
      - zscore: calculate Z-scores
+     - batch: count, GC-correct and score a manifest of BAM files
+     - segment: Segment Z-scores
+     - plot: Plot a track
      - newref: Generate a new reference dictionary of bin similarities
+     - newref-medians: Compute per-bin medians for sharded newref
+     - newref-merge: Merge the shards of a reference build
+     - validate: Validate a reference against its own samples
+     - cohort-build: Pack gc-corrected BED files into a cohort store
+     - serve: Run a resident Z-score service
+     - submit: Calculate Z-scores with a running service
 
     """
-    pass
+    if kwargs.get("kernels", None) is not None:
+        try:
+            kernels.use(kwargs["kernels"])
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    if kwargs.get("precision", None) is not None:
+        precision.use(kwargs["precision"])
 
 
 def main():
     cli.add_command(count_cli, "count")
     cli.add_command(gcc_cli, "gc-correct")
     cli.add_command(zscore_cli, "zscore")
+    cli.add_command(batch_cli, "batch")
+    cli.add_command(segment_cli, "segment")
+    cli.add_command(plot_cli, "plot")
     cli.add_command(newref_cli, "newref")
+    cli.add_command(newref_medians_cli, "newref-medians")
+    cli.add_command(newref_merge_cli, "newref-merge")
+    cli.add_command(validate_cli, "validate")
+    cli.add_command(cohort_build_cli, "cohort-build")
+    cli.add_command(serve_cli, "serve")
+    cli.add_command(submit_cli, "submit")
     cli()
 
 
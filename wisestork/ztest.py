@@ -22,14 +22,23 @@ wisestork.ztest
 :license: GPL-3.0
 """
 
-import gzip
-from math import isnan
 import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import progressbar
 
-from .utils import BedLine, utf8
+from . import kernels, precision
+from .utils import (DEFAULT_WRITE_CHUNK, BedTrack, BinIndex, SparseTrack,
+                    iter_line_blocks, layout_fingerprint, open_bed,
+                    open_output, parse_bed, peek_fingerprint, prefetch,
+                    read_bed, write_track)
+
+MEAN = "mean"
+ROBUST = "robust"
+MAD_SCALE = 1.4826
+REFERENCE_FIELDS = 5  # bin, neighbour positions and own layout position
+MAX_ALIGNMENTS = 8  # query layouts whose neighbour matrix is kept
 
 
 def get_z_score(bin, reference_bins):
@@ -50,80 +59,353 @@ def get_z_score(bin, reference_bins):
     return Z
 
 
-def ztest(input_path, output_path, database_path):
+def padded_neighbours(neighbour_lists):
+    """
+    Convert a list of neighbour index lists to a padded matrix
+    :param neighbour_lists: list of lists of bin indices
+    :return: int64 matrix of shape (bins, max neighbours),
+        padded with -1
+    """
+    lengths = np.array([len(x) for x in neighbour_lists], dtype=np.int64)
+    if lengths.sum() > 0:
+        ids = np.concatenate([x for x in neighbour_lists if len(x) > 0])
+    else:
+        ids = np.empty(0, dtype=np.int64)
+    return pad_neighbours(ids, lengths)
+
+
+def pad_neighbours(ids, lengths, rows=None):
+    """
+    Convert concatenated neighbour lists to a padded matrix
+    :param ids: array of the bin indices of all lists, list after list
+    :param lengths: array of the length of every list
+    :param rows: optional array of the matrix row of every list.
+        Defaults to the order of the lists
+    :return: int64 matrix of shape (bins, max neighbours),
+        padded with -1
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    width = int(lengths.max()) if len(lengths) > 0 else 0
+    matrix = np.full((len(lengths), width), -1, dtype=np.int64)
+    if rows is None:
+        rows = np.arange(len(lengths))
+    if lengths.sum() > 0:
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        cols = np.arange(len(offsets)) - offsets
+        matrix[np.repeat(rows, lengths), cols] = ids
+    return matrix
+
+
+def _row_medians(matrix, counts):
+    """
+    Median of every row of a matrix whose invalid entries are +inf.
+    Rows with the same number of valid values are partitioned together
+    around their middle positions. Rows without values give NaN
+    :param matrix: 2D array
+    :param counts: number of valid values per row
+    :return: array of medians
+    """
+    med = np.full(len(counts), np.nan)
+    for count in np.unique(counts):
+        if count == 0:
+            continue
+        rows = counts == count
+        mid = [(count - 1) // 2, count // 2]
+        part = np.partition(matrix[rows], mid, axis=1)
+        med[rows] = (part[:, mid[0]] + part[:, mid[1]]) / 2
+    return med
+
+
+def z_scores(values, neighbours, statistic=MEAN, chunk_size=None):
+    """
+    Z-scores of all bins at once.
+    For every bin, the values of its neighbours are gathered into a
+    padded matrix, so that the location and scale of all bins are
+    computed with row-wise array operations.
+    With the mean statistic, location is the mean and scale the
+    standard deviation. With the robust statistic, location is the
+    median and scale the median absolute deviation, scaled to be
+    consistent with the standard deviation of a normal distribution.
+    :param values: array of values per bin, or a samples x bins matrix
+        to score several samples in one pass
+    :param neighbours: padded neighbour matrix (see padded_neighbours)
+    :param statistic: 'mean' or 'robust'
+    :param chunk_size: number of bins per chunk.
+        Defaults to a chunk of roughly 64 MiB
+    :return: array of z-scores, of the same shape as values.
+        NaN where a bin has no neighbours or the scale is zero
+    """
+    if statistic not in (MEAN, ROBUST):
+        raise ValueError("Unknown statistic: {0}".format(statistic))
+    values = precision.as_values(values)
+    matrix = np.atleast_2d(values)
+    if kernels.compiled():
+        z = precision.as_values(kernels.z_scores(matrix, neighbours,
+                                                 statistic == ROBUST))
+        return z[0] if values.ndim == 1 else z
+    n_samples = matrix.shape[0]
+    n, width = neighbours.shape
+    if chunk_size is None:
+        chunk_size = max(1, (1 << 23) // max(width * n_samples, 1))
+    z = np.empty((n_samples, n), dtype=values.dtype)
+    for start in range(0, n, chunk_size):
+        idx = neighbours[start:start+chunk_size]
+        valid = idx >= 0
+        counts = valid.sum(axis=1)
+        # accumulate in double precision, whatever the storage. Rows
+        # are contiguous, so that sums are pairwise per row, as in the
+        # compiled kernel
+        gathered = np.ascontiguousarray(matrix[:, np.where(valid, idx, 0)],
+                                        dtype=np.float64)
+        if statistic == MEAN:
+            gathered[:, ~valid] = 0
+            with np.errstate(invalid="ignore", divide="ignore"):
+                location = gathered.sum(axis=2) / counts
+                dev = gathered - location[:, :, np.newaxis]
+                dev[:, ~valid] = 0
+                scale = np.sqrt((dev * dev).sum(axis=2) / counts)
+        else:
+            gathered[:, ~valid] = np.inf
+            rows = gathered.reshape(-1, width)
+            row_counts = np.tile(counts, n_samples)
+            location = _row_medians(rows, row_counts)
+            dev = np.abs(rows - location[:, np.newaxis])
+            scale = _row_medians(dev, row_counts) * MAD_SCALE
+            location = location.reshape(n_samples, -1)
+            scale = scale.reshape(n_samples, -1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            chunk = (matrix[:, start:start+chunk_size] - location) / scale
+        chunk[(counts == 0) | (scale == 0)] = np.nan
+        z[:, start:start+chunk_size] = chunk
+    return z[0] if values.ndim == 1 else z
+
+
+class ReferenceIndex(object):
+    """
+    Reference dictionary prepared for scoring.
+    Holds the bin layout of the database and, for every bin,
+    the indices of its reference bins as a padded matrix.
+    Query tracks must have exactly the same bins, in any order.
+    The layout fingerprint of every query is computed from its bins.
+    A query with the fingerprint of the index is scored as is; other
+    orders are matched up once per fingerprint.
+    """
+
+    def __init__(self, layout, neighbours, fingerprint=None):
+        """
+        Create instance of ReferenceIndex
+        :param layout: BedTrack of database bins
+        :param neighbours: padded neighbour matrix (see padded_neighbours)
+        :param fingerprint: optional layout fingerprint of the
+            database bins. Computed when not given
+        """
+        self.layout = layout
+        self.neighbours = neighbours
+        if fingerprint is None:
+            fingerprint = layout_fingerprint(layout)
+        self.fingerprint = fingerprint
+        self._aligned = {}
+
+    @classmethod
+    def load(cls, database_path):
+        """
+        Load a reference dictionary file
+        :param database_path: path to (possibly gzipped) dictionary BED
+        :return: ReferenceIndex
+        """
+        print("Building index", file=sys.stderr)
+        with open_bed(database_path) as handle:
+            fingerprint = peek_fingerprint(handle)
+            if fingerprint is not None:
+                layout, neighbours = read_positional(handle, fingerprint)
+                return cls(layout, neighbours, fingerprint)
+        database = read_bed(database_path)
+        return cls(database.with_values(None), resolve_references(database))
+
+    def __len__(self):
+        return len(self.layout)
+
+    def align(self, track):
+        """
+        Neighbour matrix in the bin order of a query track.
+        Dictionaries need not be in query order, so bins of a query
+        with another layout fingerprint are matched up by position.
+        The fingerprint is always computed from the bins of the track,
+        never taken from a file header, which may be stale after
+        the file was sorted or edited
+        :param track: BedTrack or SparseTrack
+        :return: padded neighbour matrix indexing into the query
+        :raises ValueError: when the query does not have the bins
+            of this reference
+        """
+        if not len(track) == len(self.layout):
+            raise ValueError("Reference and query bed files "
+                             "are of different size!")
+        fingerprint = layout_fingerprint(track)
+        if fingerprint == self.fingerprint:
+            return self.neighbours
+        aligned = self._aligned.get(fingerprint)
+        if aligned is None:
+            aligned = self._match(track)
+            if len(self._aligned) >= MAX_ALIGNMENTS:
+                self._aligned.clear()
+            self._aligned[fingerprint] = aligned
+        return aligned
+
+    def _match(self, track):
+        if isinstance(track, SparseTrack):
+            track = track.layout()
+        try:
+            query_to_db = BinIndex(self.layout).positions(
+                track.chromosomes, track.starts, track.ends)
+        except ValueError:
+            raise ValueError("Reference and query bed files "
+                             "have different bins!")
+        db_to_query = np.full(len(query_to_db), -1, dtype=np.int64)
+        db_to_query[query_to_db] = np.arange(len(query_to_db))
+        if np.any(db_to_query < 0):
+            raise ValueError("Reference and query bed files "
+                             "have different bins!")
+        neighbours = self.neighbours[query_to_db]
+        return np.where(neighbours >= 0,
+                        db_to_query[np.maximum(neighbours, 0)], -1)
+
+    def score(self, track, statistic=MEAN):
+        """
+        Z-scores of a query track
+        :param track: BedTrack or SparseTrack of gc-corrected values
+        :param statistic: 'mean' or 'robust'
+        :return: BedTrack of z-scores
+        """
+        neighbours = self.align(track)
+        if isinstance(track, SparseTrack):
+            track = track.to_dense()
+        return track.with_values(z_scores(track.values, neighbours,
+                                          statistic))
+
+
+def parse_reference_block(buffer):
+    """
+    Parse records of a dictionary with a layout fingerprint.
+    Every record holds a bin, the layout positions of its reference
+    bins joined by '|' (or nan), and the layout position of the bin
+    :param buffer: bytes containing whole lines
+    :return: 3-tuple of (BedTrack of bins with their layout positions
+        as values, array of number of reference bins per record,
+        array of all reference positions)
+    :raises ValueError: on malformed records
+    """
+    lines = [x for x in buffer.replace(b"\r", b"").split(b"\n")
+             if x.strip() and not x.startswith(b"#")]
+    tokens = b"\t".join(lines).split(b"\t") if lines else []
+    if len(tokens) != REFERENCE_FIELDS * len(lines):
+        raise ValueError("Malformed reference dictionary")
+    refs = [x for x in tokens[3::REFERENCE_FIELDS] if x != b"nan"]
+    lengths = np.array([0 if x == b"nan" else x.count(b"|") + 1
+                        for x in tokens[3::REFERENCE_FIELDS]], dtype=np.int64)
+    ids = np.empty(0, dtype=np.int64)
+    if refs:
+        with warnings.catch_warnings():
+            # a malformed list ends parsing early, checked below
+            warnings.simplefilter("ignore", DeprecationWarning)
+            ids = np.fromstring(b"|".join(refs), dtype=np.int64, sep="|")
+    try:
+        columns = [np.array(tokens[i::REFERENCE_FIELDS],
+                            dtype=np.bytes_).astype(np.int64)
+                   for i in (1, 2, 4)]
+    except ValueError as e:
+        raise ValueError("Malformed reference dictionary: {0}".format(e))
+    if len(ids) != lengths.sum():
+        raise ValueError("Malformed reference bins in dictionary")
+    bins = BedTrack(tokens[0::REFERENCE_FIELDS], columns[0], columns[1],
+                    columns[2])
+    return bins, lengths, ids
+
+
+def read_positional(handle, fingerprint):
+    """
+    Read the records of a dictionary with a layout fingerprint.
+    Records are put in layout order, so that their reference
+    positions index the layout directly
+    :param handle: open dictionary file, at its header
+    :param fingerprint: layout fingerprint from the header
+    :return: 2-tuple of (BedTrack of the layout, padded neighbour matrix)
+    :raises ValueError: when the records do not form the layout
+        of the fingerprint
+    """
+    tracks, lengths, ids = [], [], []
+    for bins, n, refs in map(parse_reference_block,
+                             prefetch(iter_line_blocks(handle))):
+        tracks.append(bins)
+        lengths.append(n)
+        ids.append(refs)
+    bins = BedTrack.concatenate(tracks)
+    positions = bins.values.astype(np.int64)
+    ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    n = len(bins)
+    seen = np.zeros(n, dtype=bool)
+    if np.any((positions < 0) | (positions >= n)):
+        raise ValueError("Dictionary positions are not a bin layout")
+    seen[positions] = True
+    if not np.all(seen) or np.any((ids < 0) | (ids >= n)):
+        raise ValueError("Dictionary positions are not a bin layout")
+    order = np.argsort(positions)
+    layout = BedTrack(bins.chromosomes[order], bins.starts[order],
+                      bins.ends[order])
+    if layout_fingerprint(layout) != fingerprint:
+        raise ValueError("Dictionary bins do not match "
+                         "its layout fingerprint")
+    neighbours = pad_neighbours(ids, np.concatenate(lengths) if lengths
+                                else [], positions)
+    return layout, neighbours
+
+
+def resolve_references(database, chunk_size=DEFAULT_WRITE_CHUNK):
+    """
+    Resolve the reference bins of a dictionary without a layout
+    fingerprint to database indices. Such dictionaries write reference
+    bins as chromosome,start,end joined by '|'. They are parsed as BED
+    a chunk of records at a time and looked up with a BinIndex
+    :param database: BedTrack of a reference dictionary
+    :param chunk_size: number of records resolved at once
+    :return: padded neighbour matrix indexing into the database
+    """
+    lookup = BinIndex(database)
+    lengths = np.zeros(len(database), dtype=np.int64)
+    ids = []
+    for start in range(0, len(database), chunk_size):
+        values = database.values[start:start+chunk_size]
+        has = [isinstance(x, bytes) and x != b"nan" for x in values]
+        refs = [x for x, h in zip(values, has) if h]
+        if not refs:
+            continue
+        lengths[start + np.flatnonzero(has)] = [x.count(b"|") + 1
+                                                for x in refs]
+        text = b"\n".join(refs).replace(b"|", b"\n").replace(b",", b"\t")
+        bins = parse_bed(text + b"\n")
+        ids.append(lookup.positions(bins.chromosomes, bins.starts,
+                                    bins.ends))
+    ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    return pad_neighbours(ids, lengths)
+
+
+def ztest(input_path, output_path, database_path, statistic=MEAN):
     """
-    Calculate z scores from gzipped bed file and database bed file
+    Calculate z scores from a (possibly gzipped) bed file and database
+    bed file
     :param input_path: query bed file path
     :param output_path: output bed file path
     :param database_path: database file path
+    :param statistic: 'mean' for mean/standard deviation or 'robust'
+        for median/median absolute deviation
     :return: -
     """
-    ohandle = open(output_path, "wb")
-    refdict = build_reference_index(database_path)
-    with gzip.open(input_path) as ihandle:
-        bedlines = [BedLine.fromline(x) for x in ihandle]
-
-    if not len(bedlines) == len(refdict):
-        raise ValueError("Reference and query bed files "
-                         "are of different size!")
-
-    print("Calculating Z-scores")
-    bar = progressbar.ProgressBar(max_value=len(bedlines))
-
-    for i, x in enumerate(bedlines):
-        bar.update(i)
-        key = create_key(x)
-        reference_bins = [bedlines[i] for i in refdict[key]]
-        z = get_z_score(x, reference_bins)
-        n = BedLine(x.chromosome.decode(), x.start, x.end, z)
-        ohandle.write(bytes(n) + b"\n")
-    bar.finish()
-    ohandle.close()
-
-
-def create_key(bedline):
-    return b"|".join(map(utf8, [bedline.chromosome, bedline.start,
-                                bedline.end]))
-
-
-def build_reference_index(database_path):
-    """
-    Build a reference index from a database path.
-
-    The index is a dictionary of type :
-    {key: [list of indices]}
-
-    where the key is a bed region, and the indices are indices of similar
-    bins. Naturally, this means that query bed files _must_ be of
-    _exactly_ the same size as the database, and the sorting order _must_
-    also be identical.
-
-    :param database_path:
-    :return: index dictionary
-    """
-    print("Building index", file=sys.stderr)
-    n = 0
-    d = {}
-    with gzip.open(database_path) as db_handle:
-        for i, line in enumerate(db_handle):
-            b = BedLine.fromline(line)
-            key = create_key(b)
-            d[key] = i
-            n = i + 1
-    refdict = {}
-    with gzip.open(database_path) as db_handle2:
-        bar = progressbar.ProgressBar(max_value=n)
-        for o, l in enumerate(db_handle2):
-            bar.update(o)
-            b = BedLine.fromline(l)
-            key2 = create_key(b)
-            if isinstance(b.value, float) and isnan(b.value):
-                refdict[key2] = []
-            else:
-                it = [BedLine.fromline(x, b",") for x in b.value.split(b"|")]
-                keys = list(map(create_key, it))
-                idxs = [d[x] for x in keys]
-                refdict[key2] = idxs
-        bar.finish()
-
-    return refdict
+    # the query is read while the database is loaded
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        query = pool.submit(read_bed, input_path)
+        index = ReferenceIndex.load(database_path)
+        bedlines = query.result()
+    print("Calculating Z-scores", file=sys.stderr)
+    scored = index.score(bedlines, statistic)
+    with open_output(output_path) as ohandle:
+        write_track(ohandle, scored, layout=True)